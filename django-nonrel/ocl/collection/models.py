@@ -161,12 +161,15 @@ class Collection(ConceptContainerModel):
         if len(references) > 0:
             head = CollectionVersion.get_head_of(self)
             children_to_reduce = reduce(self._reduce_func, references, children_to_reduce)
-            head.concepts = list(set(head.concepts) - set(children_to_reduce['concept_ids']))
-            head.mappings = list(set(head.mappings) - set(children_to_reduce['mapping_ids']))
-            head.references = filter(lambda ref: ref.expression not in references, head.references)
+
+            def write():
+                head.concepts = list(set(head.concepts) - set(children_to_reduce['concept_ids']))
+                head.mappings = list(set(head.mappings) - set(children_to_reduce['mapping_ids']))
+                head.references = filter(lambda ref: ref.expression not in references, head.references)
+                head.full_clean()
+                head.save()
+            head.retry_on_conflict(write)
             self.references = head.references
-            head.full_clean()
-            head.save()
             self.full_clean()
             self.save()
         return [children_to_reduce['concept_ids'], children_to_reduce['mapping_ids']]
@@ -247,8 +250,6 @@ class CollectionReference(models.Model):
 class CollectionVersion(ConceptContainerVersionModel):
     references = ListField(EmbeddedModelField('CollectionReference'))
     collection_type = models.TextField(blank=True)
-    concepts = ListField()
-    mappings = ListField()
     retired = models.BooleanField(default=False)
     active_concepts = models.IntegerField(default=0)
     active_mappings = models.IntegerField(default=0)
@@ -257,9 +258,9 @@ class CollectionVersion(ConceptContainerVersionModel):
 
     def fill_data_for_reference(self, a_reference):
         if a_reference.concepts:
-            self.concepts = self.concepts + list([concept.id for concept in a_reference.concepts])
+            self.concepts.extend([concept.id for concept in a_reference.concepts])
         if a_reference.mappings:
-            self.mappings = self.mappings + list([mapping.id for mapping in a_reference.mappings])
+            self.mappings.extend([mapping.id for mapping in a_reference.mappings])
         self.references.append(a_reference)
 
     def seed_concepts(self):
@@ -348,9 +349,14 @@ class CollectionVersion(ConceptContainerVersionModel):
     @classmethod
     def persist_changes(cls, obj, **kwargs):
         col_reference = kwargs.pop('col_reference', False)
-        if col_reference:
+        if not col_reference:
+            return super(CollectionVersion, cls).persist_changes(obj, **kwargs)
+
+        # References are embedded in the version, so a concurrent change means adding it to the stored version again
+        def write():
             obj.fill_data_for_reference(col_reference)
-        return super(CollectionVersion, cls).persist_changes(obj, **kwargs)
+            return super(CollectionVersion, cls).persist_changes(obj, **dict(kwargs))
+        return obj.retry_on_conflict(write)
 
     def update_version_data(self, obj=None):
         if obj:
@@ -141,8 +141,11 @@ class CollectionDetailSerializer(CollectionCreateOrUpdateSerializer):
             self._errors.update(errors)
         else:
             head_obj = obj.get_head()
-            head_obj.update_version_data(obj)
-            head_obj.save()
+
+            def write():
+                head_obj.update_version_data(obj)
+                head_obj.save()
+            head_obj.retry_on_conflict(write)
 
 
 class CollectionVersionListSerializer(ResourceVersionSerializer):
@@ -12,7 +12,8 @@ from oclapi.models import LOOKUP_CONCEPT_CLASSES
 
 class OpenMRSConceptValidator(BaseConceptValidator):
     def __init__(self, **kwargs):
-        self.name_registry = kwargs.pop('name_registry')
+        self.repo_id = kwargs.pop('repo_id')
+        self.name_index = kwargs.pop('name_index', None)
         self.reference_values = kwargs.pop('reference_values')
 
     def validate_concept_based(self, concept):
@@ -69,8 +70,12 @@ class OpenMRSConceptValidator(BaseConceptValidator):
                 'names': [message_with_name_details(error_message, name)]})
 
     def no_other_record_has_same_name(self, name, self_id):
-        key = name.locale + name.name
-        return key not in self.name_registry or self.name_registry[key] == [self_id]
+        if self.name_index is not None:
+            concept_ids = self.name_index.concept_ids_with_name(name.locale, name.name)
+        else:
+            from concepts.models import ConceptNameEntry
+            concept_ids = ConceptNameEntry.concept_ids_with_name(self.repo_id, name.locale, name.name)
+        return all(concept_id == self_id for concept_id in concept_ids)
 
     def short_name_cannot_be_marked_as_locale_preferred(self, concept):
         short_preferred_names_in_concept = filter(
@@ -1,16 +1,32 @@
 """ Concepts importer module """
 import json
 import logging
+import os
+import shutil
+import sys
+import tempfile
+import zlib
+from collections import OrderedDict
 from datetime import datetime
+from multiprocessing import Pool
 
+import haystack
+from bson import ObjectId
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.management import CommandError
-
-from concepts.models import Concept, ConceptVersion
-from concepts.serializers import ConceptDetailSerializer, ConceptVersionUpdateSerializer
-from oclapi.management.commands import MockRequest, ImportActionHelper
-from sources.models import SourceVersion
+from django.core.management.base import OutputWrapper
+from django.core.validators import EMPTY_VALUES, RegexValidator
+from django.db import connections
+from django.utils.encoding import smart_text
+from haystack.signals import BaseSignalProcessor
+
+from concepts.models import Concept, ConceptVersion, LocalizedText
+from mappings.models import MappingVersion
+from oclapi.management.commands import ImportActionHelper, ImportCheckpoint, ImportIndexUpdater
+from oclapi.models import NAMESPACE_REGEX, VersionMembership
+from oclapi.utils import update_all_in_index
+from sources.models import Source, SourceVersion
 
 __author__ = 'misternando,paynejd'
 logger = logging.getLogger('batch')
@@ -26,16 +42,132 @@ class InvalidStateException(Exception):
     pass
 
 
+class ConceptDataDecoder(object):
+    """
+    Turns the JSON data of an import line into concept and concept version field values.
+    Applies the same checks as ConceptDetailSerializer and ConceptVersionUpdateSerializer,
+    without setting up the DRF fields for every line.
+    """
+    CONCEPT_FIELDS = ('mnemonic', 'external_id', 'concept_class', 'datatype', 'extras', 'retired', 'names',
+                      'descriptions')
+    VERSION_FIELDS = ('external_id', 'concept_class', 'datatype', 'extras', 'retired', 'names', 'descriptions')
+    CHAR_FIELDS = ('external_id', 'concept_class', 'datatype', 'update_comment')
+    LOCALIZED_TEXT_FIELDS = (('names', 'name'), ('descriptions', 'description'))
+    TRUE_VALUES = ('true', 't', 'True', '1')
+    FALSE_VALUES = ('false', 'f', 'False', '0')
+    PREFERRED_VALUES = (True, 'True', 'true', 'TRUE')
+    REQUIRED_MESSAGE = 'This field is required.'
+    INVALID_MESSAGE = 'Invalid value.'
+    mnemonic_validator = RegexValidator(regex=NAMESPACE_REGEX)
+
+    @classmethod
+    def new_concept(cls, data):
+        """ Returns an unsaved concept, as ConceptDetailSerializer would restore it """
+        values = cls.decode(data, require_mnemonic=True)
+        concept = Concept()
+        for field in cls.CONCEPT_FIELDS:
+            if field in values:
+                setattr(concept, field, values[field])
+        return concept
+
+    @classmethod
+    def update_concept_version(cls, concept_version, data):
+        """ Applies the data to a clone of a concept version, as ConceptVersionUpdateSerializer would """
+        values = cls.decode(data)
+        for field in cls.VERSION_FIELDS:
+            if field in values:
+                setattr(concept_version, field, values[field])
+        concept_version.update_comment = values.get('update_comment')
+        return concept_version
+
+    @classmethod
+    def decode(cls, data, require_mnemonic=False):
+        """ Returns the values of the fields present in the data; raises ValidationError with the errors by field """
+        if not isinstance(data, dict):
+            raise ValidationError({'non_field_errors': ['Invalid data']})
+        values = {}
+        errors = {}
+        if require_mnemonic:
+            try:
+                values['mnemonic'] = cls.decode_mnemonic(data.get('id'))
+            except ValidationError as exc:
+                errors['id'] = exc.messages
+        for field in cls.CHAR_FIELDS:
+            if field in data:
+                values[field] = cls.decode_char(data[field])
+        if 'retired' in data:
+            values['retired'] = cls.decode_boolean(data['retired'])
+        if 'extras' in data:
+            values['extras'] = data['extras']
+        for field, name_attr in cls.LOCALIZED_TEXT_FIELDS:
+            if field in data:
+                try:
+                    values[field] = cls.decode_localized_texts(data[field], name_attr)
+                except ValidationError as exc:
+                    errors[field] = exc.messages
+        if errors:
+            raise ValidationError(errors)
+        return values
+
+    @classmethod
+    def decode_mnemonic(cls, value):
+        if value in EMPTY_VALUES:
+            raise ValidationError(cls.REQUIRED_MESSAGE)
+        value = cls.decode_char(value)
+        cls.mnemonic_validator(value)
+        return value
+
+    @staticmethod
+    def decode_char(value):
+        if isinstance(value, basestring) or value is None:
+            return value
+        return smart_text(value)
+
+    @classmethod
+    def decode_boolean(cls, value):
+        if value in cls.TRUE_VALUES:
+            return True
+        if value in cls.FALSE_VALUES:
+            return False
+        return bool(value)
+
+    @classmethod
+    def decode_localized_texts(cls, value, name_attr):
+        if not value:
+            return value
+        if not isinstance(value, list):
+            raise ValidationError(cls.INVALID_MESSAGE)
+        return [cls.decode_localized_text(element, name_attr) for element in value]
+
+    @classmethod
+    def decode_localized_text(cls, element, name_attr):
+        if not element or not isinstance(element, dict):
+            raise ValidationError(cls.INVALID_MESSAGE)
+        name = element.get(name_attr)
+        locale = element.get('locale')
+        if not isinstance(name, unicode) or not isinstance(locale, unicode):
+            raise ValidationError(cls.INVALID_MESSAGE)
+        localized_text = LocalizedText(name=name, locale=locale, type=element.get('%s_type' % name_attr))
+        external_id = element.get('external_id')
+        if external_id:
+            localized_text.external_id = external_id
+        localized_text.locale_preferred = element.get('locale_preferred', False) in cls.PREFERRED_VALUES
+        return localized_text
+
+
 class ValidationLogger:
-    def __init__(self, output_file_name='bulk_import_validation_errors_%s.csv' % datetime.now().strftime('%Y%m%d%H%M%S'), output=None):
+    def __init__(self, output_file_name='bulk_import_validation_errors_%s.csv' % datetime.now().strftime('%Y%m%d%H%M%S'), output=None,
+                 append=False):
         self.count = 0
         self.output = output
         self.output_file_name = output_file_name
+        # A resumed import adds to the report of the lines handled before the checkpoint instead of truncating it
+        self.append = append
 
     def append_concept(self, data, errors):
         if self.count is 0:
-            self.init_output()
-            self.output.write(u'MNEMONIC;ERROR;JSON')
+            if self.init_output():
+                self.output.write(u'MNEMONIC;ERROR;JSON')
 
         self.count += 1
 
@@ -44,8 +176,14 @@ class ValidationLogger:
             self.output.write(csv_line.encode('utf-8'))
 
     def init_output(self):
-        if self.output is None:
-            self.output = open(self.output_file_name, 'w+')
+        """ Opens the report if needed, and returns whether it still needs a header """
+        if self.output is not None:
+            return True
+        if self.append and os.path.exists(self.output_file_name) and os.path.getsize(self.output_file_name):
+            self.output = open(self.output_file_name, 'a')
+            return False
+        self.output = open(self.output_file_name, 'w+')
+        return True
 
     def close(self):
         if not self.output:
@@ -54,11 +192,86 @@ class ValidationLogger:
         self.output.close()
 
 
+class CollectingValidationLogger(object):
+    """ Keeps validation errors in memory, so that a worker process can hand them over to the coordinator """
+    def __init__(self):
+        self.errors = []
+
+    def append_concept(self, data, errors):
+        self.errors.append((data, errors))
+
+    def close(self):
+        pass
+
+
+class DeferredSourceVersion(object):
+    """
+    Stands in for the HEAD source version within an import worker process.
+    Records the membership changes instead of saving them, so that a single coordinator can apply them.
+    """
+    def __init__(self, source_version):
+        self.id = source_version.id
+        self.concepts = []
+        self.replaced = {}
+
+    def update_concept_version(self, concept_version):
+        previous_version = concept_version.previous_version
+        if previous_version:
+            self.replaced[previous_version.id] = concept_version.id
+        else:
+            self.concepts.append(concept_version.id)
+        concept_version.save()
+        if previous_version:
+            previous_version.save()
+
+    def add_members(self, attribute, resource_version_ids):
+        self.concepts.extend(resource_version_ids)
+
+    def replace_members(self, attribute, replacements):
+        self.replaced.update(replacements)
+
+    def save(self):
+        pass
+
+
+def import_concepts_partition(args):
+    """ Pool worker - imports one partition of the input file and returns the resulting changes """
+    source_id, user_id, partition_file_name, options = args
+
+    # Do not share the database sockets of the parent process
+    for connection in connections.all():
+        connection.close()
+
+    source = Source.objects.get(id=source_id)
+    user = User.objects.get(id=user_id)
+    importer = ConceptsImporter(source, open(partition_file_name, 'rb'), user,
+                                OutputWrapper(sys.stdout), OutputWrapper(sys.stderr),
+                                validation_logger=CollectingValidationLogger())
+    return importer.import_partition(**options)
+
+
 class ConceptsImporter(object):
+    BULK_CHUNK_SIZE = 100
+
     def __init__(self, source, concepts_file, user, output_stream, error_stream, save_validation_errors=True, validation_logger=None):
         """ Initialize mapping importer """
         self.source = source
+        self.chunk_size = None
+        self.deferred_source_version = None
+        self.checkpoint = None
+        self.index_updater = None
+        self.concepts_cache = None
+        self.concept_versions_cache = None
+        self.concepts_versions_map = {}
+        self.concept_hashes = {}
+        self.concept_ids = {}
+        self.new_concepts = OrderedDict()
+        self.retired_changes = OrderedDict()
+        self.deferred_failures = {}
+        self.concept_validators = None
+        self.name_index = None
         self.concepts_file = concepts_file
+        self.lines_handled = 0
         self.stdout = output_stream
         self.stderr = error_stream
         self.user = user
@@ -82,21 +295,339 @@ class ConceptsImporter(object):
         if flush:
             self.stderr.flush()
 
-    def import_concepts(self, new_version=False, total=0, test_mode=False, deactivate_old_records=False, **kwargs):
+    def import_concepts(self, new_version=False, total=0, test_mode=False, deactivate_old_records=False, chunk_size=None,
+                        workers=None, checkpoint=None, resume=False, **kwargs):
         self.action_count = {}
         self.test_mode = test_mode
+        self.chunk_size = chunk_size
+        self.checkpoint = None if test_mode else checkpoint
         self.info('Import concepts to source...')
-        self.handle_new_source_version(new_version)
 
-        # Load the JSON file line by line and import each line
+        state = self.checkpoint.load() if self.checkpoint and resume else None
+        if state and workers and workers > 1:
+            raise CommandError('Imports with multiple workers cannot be resumed.')
+
+        # Without inline indexing, only the versions saved by this import are reindexed at the end
+        if not test_mode and ImportIndexUpdater.is_needed():
+            self.index_updater = ImportIndexUpdater(ConceptVersion, MappingVersion)
+            self.index_updater.start()
+        try:
+            # Load the JSON file line by line and import each line
+            self.user = User.objects.filter(is_superuser=True)[0]
+            if state:
+                lines_handled, position = self.resume_from_checkpoint(state)
+            else:
+                self.handle_new_source_version(new_version)
+                self.concept_version_ids = set(self.source_version.concepts)
+                lines_handled, position = 0, 0
+
+            if workers and workers > 1:
+                lines_handled = self.handle_lines_in_parallel(workers, total)
+            else:
+                self.create_concept_versions_map()
+                lines_handled = self.handle_lines_in_input_file(total, lines_handled, position)
+            self.lines_handled = lines_handled
+            self.output_unhandled_concept_version_ids()
+            self.handle_deactivation__of_old_records(deactivate_old_records)
+        finally:
+            if self.index_updater:
+                self.index_updater.stop()
+        self.update_index()
+
+        # Display final summary
+        self.output_summary(lines_handled, total or lines_handled)
+        if self.checkpoint:
+            self.checkpoint.clear()
+
+    def validate_concepts(self, total=0, **kwargs):
+        """
+        Validates every line of the input file without writing anything. Names are checked against the source merged
+        with the preceding lines of the file, so the report lists the lines that the import would reject.
+        """
+        self.action_count = {}
+        self.info('Validate concepts for source...\n')
         self.user = User.objects.filter(is_superuser=True)[0]
+
+        concept_ids = dict(Concept.objects.filter(parent_id=self.source.id).values_list('mnemonic', 'id'))
+        validators, name_index = Concept.build_validators(self.source)
+
+        lines_handled = 0
+        num_failed = 0
+        for line in self.concepts_file:
+            lines_handled += 1
+            data = self.json_to_concept(line)
+            if data:
+                errors = self.validate_concept(data, concept_ids, validators, name_index)
+                if errors:
+                    num_failed += 1
+                    if self.save_validation_errors:
+                        self.validation_logger.append_concept(data, errors)
+                    self.error(unicode('%s\nValidation failed: %s\n' % (''.join(errors), data)))
+            if (lines_handled % 1000) == 0:
+                self.info('Validated %d concepts...' % lines_handled, ending='\r', flush=True)
+
+        self.concepts_file.close()
+        if self.validation_logger:
+            self.validation_logger.close()
+        self.lines_handled = lines_handled
+        self.info('Validated %d concepts, %d failed validation.\n' % (lines_handled, num_failed), flush=True)
+        return num_failed
+
+    def import_items(self, items, chunk_size=None):
+        """
+        Adds or updates the concepts of a list of decoded concept payloads, as the import of a file with the same lines
+        would, and returns the result of each item. The items share one set of validators, new concepts are inserted
+        in bulk per chunk and the membership changes are applied to the HEAD source version in a single save.
+        """
+        self.action_count = {}
+        self.test_mode = False
+        self.chunk_size = chunk_size or self.BULK_CHUNK_SIZE
+        self.source_version = SourceVersion.get_head_of(self.source)
+        self.deferred_source_version = DeferredSourceVersion(self.source_version)
+        self.concept_version_ids = set()
+        self.concept_validators, self.name_index = Concept.build_validators(self.source)
+
+        results = []
+        for start in range(0, len(items), self.chunk_size):
+            chunk = items[start:start + self.chunk_size]
+            self.map_chunk(chunk)
+            self.prefetch_chunk(chunk)
+            self.deferred_failures = {}
+            chunk_results = [self.import_item(data) for data in chunk]
+            self.try_insert_new_concepts()
+            self.try_apply_retired_changes()
+
+            # New concepts and retired status changes are only saved now, so a failure turns their results into errors
+            for result in chunk_results:
+                if result['id'] in self.deferred_failures and result['action'] != ImportActionHelper.IMPORT_ACTION_SKIP:
+                    result['action'] = ImportActionHelper.IMPORT_ACTION_SKIP
+                    result['errors'] = [self.deferred_failures[result['id']]]
+                result['action'] = ImportActionHelper.get_action_string(result['action'])
+            results.extend(chunk_results)
+
+        self.apply_membership_changes(self.deferred_source_version.concepts, self.deferred_source_version.replaced)
+        return results
+
+    def import_item(self, data):
+        """ Imports a single item of import_items, returning its result instead of logging a failure """
+        if not isinstance(data, dict):
+            self.count_action(ImportActionHelper.IMPORT_ACTION_SKIP)
+            return {'id': None, 'action': ImportActionHelper.IMPORT_ACTION_SKIP, 'errors': ['Must be a JSON object.']}
+
+        result = {'id': unicode(data.get('id') or '')}
+        try:
+            result['action'] = self.handle_concept(self.source, data)
+            self.count_action(result['action'])
+            return result
+        except (IllegalInputException, InvalidStateException) as exc:
+            errors = [exc.args[0]]
+        except ValidationError as exc:
+            errors = exc.messages
+        except KeyError as exc:
+            errors = ['Must specify %s.' % exc.args[0]]
+        except Exception as exc:
+            errors = ['Something unexpected occured: %s' % exc]
+        self.count_action(ImportActionHelper.IMPORT_ACTION_SKIP)
+        result.update({'action': ImportActionHelper.IMPORT_ACTION_SKIP, 'errors': errors})
+        return result
+
+    def map_chunk(self, chunk):
+        """
+        Maps the concepts of a chunk to their versions in the HEAD source version, which import_items does per chunk
+        instead of mapping every concept of the source up front
+        """
+        mnemonics = [data['id'] for data in chunk if isinstance(data, dict) and data.get('id')]
+        concept_ids = dict(Concept.objects.filter(
+            parent_id=self.source.id, mnemonic__in=mnemonics).values_list('mnemonic', 'id'))
+        self.concept_ids.update(concept_ids)
+        versions = list(ConceptVersion.objects.filter(
+            versioned_object_id__in=concept_ids.values(), is_latest_version=True).values(
+            'id', 'versioned_object_id', 'content_hash'))
+        member_ids = set(VersionMembership.objects.filter(
+            container_version_id=self.source_version.id, attribute='concepts',
+            resource_version_id__in=[version['id'] for version in versions]).values_list('resource_version_id', flat=True))
+        for version in versions:
+            if version['id'] in member_ids:
+                self.concepts_versions_map[version['versioned_object_id']] = version['id']
+                self.concept_hashes[version['versioned_object_id']] = version['content_hash']
+        self.concept_version_ids.update(member_ids)
+
+    def validate_concept(self, data, concept_ids, validators, name_index):
+        """ Returns the validation errors of a line, and records the names of a valid line in the name index """
+        mnemonic = data.get('id')
+        if not mnemonic:
+            return ['Must specify concept id.']
+        try:
+            concept = ConceptDataDecoder.new_concept(data)
+        except ValidationError as exc:
+            return ['Could not parse concept %s: %s' % (mnemonic, exc.message_dict)]
+
+        # Concepts that are new to the source are told apart by their mnemonic, which cannot clash with an ID
+        concept.id = concept_ids.get(mnemonic) or u'new:%s' % mnemonic
+        try:
+            for validator in validators:
+                validator.validate(concept)
+        except ValidationError as exc:
+            return exc.messages
+
+        concept_ids[mnemonic] = concept.id
+        if name_index:
+            name_index.replace(concept)
+        return []
+
+    def update_index(self):
+        if not self.index_updater:
+            return
+        self.info('Updating the search index...\n')
+        num_versions = self.index_updater.update_index()
+        self.info('Updated %d versions in the search index.\n' % num_versions)
+
+    def resume_from_checkpoint(self, state):
+        """ Restores the progress of a previous run, and skips the lines that were already handled """
+        self.source_version = SourceVersion.objects.get(id=state['source_version_id'])
+        self.action_count = state['action_count']
+        self.concept_version_ids = set(state['remaining_ids'])
+        if self.index_updater:
+            self.index_updater.restore(state.get('touched_ids', {}))
+        ImportCheckpoint.skip_to(self.concepts_file, state['position'])
+        self.info('Resuming import after line %d...\n' % state['lines_handled'])
+        return state['lines_handled'], state['position']
+
+    def save_checkpoint(self, position, lines_handled):
+        self.checkpoint.save(self.source_version.id, position, lines_handled, self.action_count,
+                             self.concept_version_ids, self.index_updater)
+
+    def import_partition(self, source_version_id, total=0, test_mode=False, chunk_size=None):
+        """ Imports a partition of the input file in a worker process, deferring membership changes """
+        self.action_count = {}
+        self.test_mode = test_mode
+        self.chunk_size = chunk_size
+        self.source_version = SourceVersion.objects.get(id=source_version_id)
+        self.deferred_source_version = DeferredSourceVersion(SourceVersion.get_head_of(self.source))
         self.concept_version_ids = set(self.source_version.concepts)
+        unhandled_ids = set(self.concept_version_ids)
 
         self.create_concept_versions_map()
         lines_handled = self.handle_lines_in_input_file(total)
-        self.output_unhandled_concept_version_ids()
-        self.handle_deactivation__of_old_records(deactivate_old_records)  # Display final summary
-        self.output_summary(lines_handled, total)
+
+        return {
+            'lines_handled': lines_handled,
+            'action_count': self.action_count,
+            'handled_ids': list(unhandled_ids - self.concept_version_ids),
+            'added_ids': self.deferred_source_version.concepts,
+            'replaced_ids': self.deferred_source_version.replaced,
+            'validation_errors': self.validation_logger.errors,
+        }
+
+    def handle_lines_in_parallel(self, workers, total):
+        """
+        Splits the input file by a hash of the concept mnemonic, so that all lines of a concept end up in the same
+        partition, imports the partitions in a pool of worker processes and applies their membership changes at once.
+        """
+        partition_dir = tempfile.mkdtemp()
+        try:
+            lines_skipped, partition_totals = self.write_partitions(partition_dir, workers)
+
+            # Forked workers must not inherit open database connections
+            for connection in connections.all():
+                connection.close()
+
+            self.info('Importing in %d worker processes...\n' % workers)
+            pool = Pool(workers)
+            try:
+                results = pool.map(import_concepts_partition, [
+                    (self.source.id, self.user.id, os.path.join(partition_dir, '%d.json' % index),
+                     {'source_version_id': self.source_version.id, 'total': partition_total,
+                      'test_mode': self.test_mode, 'chunk_size': self.chunk_size})
+                    for index, partition_total in enumerate(partition_totals)])
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(partition_dir, ignore_errors=True)
+
+        lines_handled = lines_skipped
+        added_ids, replaced_ids = [], {}
+        for result in results:
+            lines_handled += result['lines_handled']
+            for action, count in result['action_count'].items():
+                self.action_count[action] = self.action_count.get(action, 0) + count
+            self.concept_version_ids.difference_update(result['handled_ids'])
+            added_ids.extend(result['added_ids'])
+            replaced_ids.update(result['replaced_ids'])
+            if self.validation_logger:
+                for data, errors in result['validation_errors']:
+                    self.validation_logger.append_concept(data, errors)
+
+        self.concepts_file.close()
+        if self.validation_logger:
+            self.validation_logger.close()
+        if not self.test_mode:
+            self.apply_membership_changes(added_ids, replaced_ids)
+
+        log = ImportActionHelper.get_progress_descriptor(
+            'concepts', lines_handled, total or lines_handled, self.action_count)
+        self.info(log, ending='\r', flush=True)
+        return lines_handled
+
+    def write_partitions(self, partition_dir, workers):
+        """ Writes each line of the input file into the partition file chosen by its concept mnemonic """
+        lines_skipped = 0
+        partition_totals = [0] * workers
+        partition_files = [open(os.path.join(partition_dir, '%d.json' % index), 'wb') for index in range(workers)]
+        try:
+            for line in self.concepts_file:
+                data = self.json_to_concept(line)
+                if not data:
+                    lines_skipped += 1
+                    continue
+                mnemonic = data.get('id') if isinstance(data, dict) else None
+                index = zlib.crc32(mnemonic.encode('utf-8')) % workers if mnemonic else 0
+                partition_files[index].write(line)
+                partition_totals[index] += 1
+        finally:
+            for partition_file in partition_files:
+                partition_file.close()
+        return lines_skipped, partition_totals
+
+    def apply_membership_changes(self, added_ids, replaced_ids):
+        """ Applies the concept versions created by the workers to the HEAD source version in a single save """
+        if not (added_ids or replaced_ids):
+            return
+
+        def latest_id(version_id):
+            # A concept may have been updated and retired in the same import, so follow the chain to its end
+            while version_id in replaced_ids:
+                version_id = replaced_ids[version_id]
+            return version_id
+
+        head = SourceVersion.get_head_of(self.source)
+        # Versions created by this import reach the HEAD through the version their chain starts from
+        created_ids = set(added_ids) | set(replaced_ids.values())
+
+        def write():
+            for version_id in replaced_ids:
+                if version_id in created_ids:
+                    continue
+                # Like SourceVersion.update_concept_version, add the new version if the old one was not a member
+                if not head.concepts.replace(version_id, latest_id(version_id)):
+                    head.concepts.append(latest_id(version_id))
+            head.concepts.extend(map(latest_id, added_ids))
+            head.save()
+        head.retry_on_conflict(write)
+
+        # Versions were indexed by the workers before they became members of the source version
+        if type(haystack.signal_processor) is not BaseSignalProcessor:
+            changed_ids = map(latest_id, added_ids + replaced_ids.keys())
+            update_all_in_index(ConceptVersion, ConceptVersion.objects.filter(id__in=changed_ids))
+        elif self.index_updater:
+            self.index_updater.add(ConceptVersion, added_ids + replaced_ids.keys() + replaced_ids.values())
+
+    def source_version_kwargs(self):
+        """ Directs membership changes to the deferred source version when running as a worker """
+        if self.deferred_source_version is None:
+            return {}
+        return {'parent_resource_version': self.deferred_source_version}
 
     def output_unhandled_concept_version_ids(self):
         # Log remaining unhandled IDs
@@ -128,33 +659,42 @@ class ConceptsImporter(object):
 
         self.info('Deactivating old concepts...\n')
 
-        for version_id in self.concept_version_ids:
-            try:
-                self.remove_concept_version(version_id)
-                self.count_action(ImportActionHelper.IMPORT_ACTION_DEACTIVATE)
-
-                # Log the mapping deactivation
-                self.info('Deactivated concept version: %s\n' % version_id)
-
-            except InvalidStateException as exc:
-                self.error('Failed to inactivate concept version on ID %s! %s\n' % (version_id, exc.args[0]))
-
-    def handle_lines_in_input_file(self, total):
-        lines_handled = 0
-        for line in self.concepts_file:
-            # Load the next JSON line
-            lines_handled += 1
-            data = self.json_to_concept(line)  # Process the import for the current JSON line
-            self.try_import_concept(data)
-
-            # Simple progress bar
-            if (lines_handled % 10) == 0:
-                log = ImportActionHelper.get_progress_descriptor(
-                    'concepts', lines_handled, total, self.action_count)
-                self.stdout.write(log, ending='\r')
-                self.stdout.flush()
-                if (lines_handled % 1000) == 0:
-                    logger.info(log)
+        # All versions are deactivated with one update, and reindexed at once
+        if self.test_mode:
+            version_ids = ConceptVersion.objects.filter(
+                id__in=list(self.concept_version_ids), is_active=True).values_list('id', flat=True)
+        else:
+            version_ids = ConceptVersion.deactivate_in_bulk(self.concept_version_ids)
+            if self.index_updater:
+                self.index_updater.add(ConceptVersion, version_ids)
+        for version_id in version_ids:
+            self.count_action(ImportActionHelper.IMPORT_ACTION_DEACTIVATE)
+            self.info('Deactivated concept version: %s\n' % version_id)
+
+    def handle_lines_in_input_file(self, total, lines_handled=0, position=0):
+        for chunk, position in self.read_chunks(position):
+            # Resolve all concepts of the chunk at once, so that each line doesn't hit the database on its own
+            self.prefetch_chunk(chunk)
+            lines_before_chunk = lines_handled
+
+            for data in chunk:
+                lines_handled += 1
+                self.try_import_concept(data)
+
+                # Simple progress bar
+                if (lines_handled % 10) == 0:
+                    log = ImportActionHelper.get_progress_descriptor(
+                        'concepts', lines_handled, self.get_progress_total(lines_handled, total), self.action_count)
+                    self.stdout.write(log, ending='\r')
+                    self.stdout.flush()
+                    if (lines_handled % 1000) == 0:
+                        logger.info(log)
+
+            # New concepts and retired status changes of the chunk are saved together, before the progress is persisted
+            self.try_insert_new_concepts()
+            self.try_apply_retired_changes()
+            if self.checkpoint and self.checkpoint.is_due(lines_before_chunk, lines_handled):
+                self.save_checkpoint(position, lines_handled)
 
         # Done with the input file, so close it
         self.concepts_file.close()
@@ -162,10 +702,60 @@ class ConceptsImporter(object):
             self.validation_logger.close()
         # Import complete - display final progress bar
         log = ImportActionHelper.get_progress_descriptor(
-            'concepts', lines_handled, total, self.action_count)
+            'concepts', lines_handled, total or lines_handled, self.action_count)
         self.info(log, ending='\r', flush=True)
         return lines_handled
 
+    def get_progress_total(self, lines_handled, total):
+        """ Returns the total number of lines if known, otherwise an estimate based on the position in the file """
+        return total or ImportActionHelper.get_total_estimate(self.concepts_file, lines_handled)
+
+    def read_chunks(self, position=0):
+        """
+        Yields the parsed JSON lines of the input file in lists of chunk_size (one line if not chunked),
+        along with the position in the file after the chunk
+        """
+        chunk_size = self.chunk_size or 1
+        chunk = []
+        for line in self.concepts_file:
+            position += len(line)
+            chunk.append(self.json_to_concept(line))
+            if len(chunk) >= chunk_size:
+                yield chunk, position
+                chunk = []
+        if chunk:
+            yield chunk, position
+
+    def prefetch_chunk(self, chunk):
+        """ Loads the concepts and their latest versions for all mnemonics in the chunk with one query apiece """
+        if not self.chunk_size:
+            return
+
+        mnemonics = [data['id'] for data in chunk if isinstance(data, dict) and data.get('id')]
+        concepts = Concept.objects.filter(parent_id=self.source.id, mnemonic__in=mnemonics)
+        self.concepts_cache = dict((concept.mnemonic, concept) for concept in concepts)
+
+        version_ids = [self.concepts_versions_map[concept.id] for concept in self.concepts_cache.values()
+                       if concept.id in self.concepts_versions_map]
+        versions = ConceptVersion.objects.filter(id__in=version_ids) if version_ids else []
+        self.concept_versions_cache = dict((version.id, version) for version in versions)
+
+    def get_concept(self, source, mnemonic):
+        """ Returns the concept from the prefetched chunk, or from the database if not importing in chunks """
+        if self.concepts_cache is None:
+            return Concept.objects.get(parent_id=source.id, mnemonic=mnemonic)
+        if mnemonic not in self.concepts_cache:
+            raise Concept.DoesNotExist('Concept %s does not exist in source %s.' % (mnemonic, source.mnemonic))
+        return self.concepts_cache[mnemonic]
+
+    def get_concept_version(self, version_id):
+        """ Returns the concept version from the prefetched chunk, or from the database if not importing in chunks """
+        if self.concept_versions_cache is None:
+            return ConceptVersion.objects.get(id=version_id)
+        if version_id not in self.concept_versions_cache:
+            raise ConceptVersion.DoesNotExist('Concept version %s does not exist.' % version_id)
+        return self.concept_versions_cache[version_id]
+
     def try_import_concept(self, data):
         if not data:
             return
@@ -211,6 +801,10 @@ class ConceptsImporter(object):
         new_source_version.full_clean()
         new_source_version.save()
         self.source_version = new_source_version
+        if self.index_updater:
+            # The members of the new source version have to be found by it
+            self.index_updater.add(ConceptVersion, new_source_version.concepts)
+            self.index_updater.add(MappingVersion, new_source_version.mappings)
 
     def handle_concept(self, source, data):
         """ Adds, updates, retires/unretires a single concept, or skips if no diff """
@@ -221,10 +815,23 @@ class ConceptsImporter(object):
         if not mnemonic:
             raise IllegalInputException('Must specify concept id.')
         concept_name = data['concept_class']
+
+        # A concept added or (un-)retired earlier in the same chunk has to be saved before it can be updated
+        if unicode(mnemonic) in self.new_concepts:
+            self.try_insert_new_concepts()
+        if self.concept_ids.get(unicode(mnemonic)) in self.retired_changes:
+            self.try_apply_retired_changes()
+
+        # Skip lines whose content matches the stored content hash of the latest version
+        concept_version_id = self.get_unchanged_concept_version_id(mnemonic, data)
+        if concept_version_id:
+            self.concept_version_ids.discard(concept_version_id)
+            return ImportActionHelper.IMPORT_ACTION_NONE
+
         # If concept exists, update the concept with the new data (ignoring retired status for now)
         try:
-            concept = Concept.objects.get(parent_id=source.id, mnemonic=mnemonic)
-            concept_version = ConceptVersion.objects.get(id=self.concepts_versions_map[concept.id])
+            concept = self.get_concept(source, mnemonic)
+            concept_version = self.get_concept_version(self.concepts_versions_map[concept.id])
             update_action = self.update_concept_version(concept_version, data)
 
             # Remove ID from the concept version list so that we know concept has been handled
@@ -245,8 +852,8 @@ class ConceptsImporter(object):
             if update_action:
                 self.info('Created new concept: %s = %s\n' % (mnemonic, concept_name))
 
-            # Reload the concept so that the retire/unretire step will work
-            concept = Concept.objects.get(parent_id=source.id, mnemonic=mnemonic)
+            # The retired status of a new concept is part of its initial version already
+            return update_action
 
         # Concept exists, but not in this source version
         except (ConceptVersion.DoesNotExist, KeyError):
@@ -256,7 +863,11 @@ class ConceptsImporter(object):
 
         # Handle retired status - if different, will create an additional concept version
         if 'retired' in data:
-            retire_action = self.update_concept_retired_status(concept, data['retired'])
+            # An unchanged, prefetched version is still the latest one, so there is no need to look it up again
+            latest_version = None
+            if self.concept_versions_cache is not None and update_action == ImportActionHelper.IMPORT_ACTION_NONE:
+                latest_version = concept_version
+            retire_action = self.update_concept_retired_status(concept, data['retired'], latest_version)
             if retire_action == ImportActionHelper.IMPORT_ACTION_RETIRE:
                 str_log = 'Retired concept: %s = %s\n' % (mnemonic, concept_name)
                 self.stdout.write(str_log)
@@ -266,32 +877,94 @@ class ConceptsImporter(object):
                 self.stdout.write(str_log)
                 logger.info(str_log)
 
+        # A changed concept must not be compared against the hash of its replaced version again
+        if update_action or retire_action:
+            self.concept_hashes.pop(concept.id, None)
+
         # Return the list of actions performed
         return update_action + retire_action
 
+    def get_unchanged_concept_version_id(self, mnemonic, data):
+        """ Returns the ID of the latest concept version if it has the same content hash as data, otherwise None """
+        concept_id = self.concept_ids.get(unicode(mnemonic))
+        if concept_id is None or concept_id not in self.concept_hashes:
+            return None
+        stored_hash = self.concept_hashes[concept_id]
+        if stored_hash is None or stored_hash != ConceptVersion.content_hash_of_import_data(data):
+            return None
+        return self.concepts_versions_map.get(concept_id)
+
     def add_concept(self, source, data):
-        """ Adds a new concept -- NOTE: data['id'] is the concept mnemonic """
-        serializer = ConceptDetailSerializer(data=data, context={'request': MockRequest(self.user)})
-        if not serializer.is_valid():
+        """ Validates a new concept and queues it for the next bulk insert -- NOTE: data['id'] is the concept mnemonic """
+        try:
+            concept = ConceptDataDecoder.new_concept(data)
+        except ValidationError:
             raise IllegalInputException('Could not parse new concept %s' % data['id'])
         if not self.test_mode:
-            serializer.save(force_insert=True, parent_resource=source, child_list_attribute='concepts')
-
-            if not serializer.is_valid():
-                raise ValidationError(serializer.errors)
+            if self.concept_validators is not None:
+                # The name index tells concepts apart by their ID, so a new concept needs it before it is inserted
+                concept.id = unicode(ObjectId())
+                concept.concept_validators = self.concept_validators
+            errors = Concept.prepare_new(concept, self.user, source)
+            if errors:
+                raise ValidationError(errors)
+            self.new_concepts[concept.mnemonic] = concept
+
+            # Custom validation checks names against the concepts in the database, so it must see every new concept,
+            # unless it checks them against the name index, which holds the queued concepts too
+            if self.name_index is not None:
+                self.name_index.replace(concept)
+            elif source.custom_validation_schema:
+                self.insert_new_concepts()
         return ImportActionHelper.IMPORT_ACTION_ADD
 
+    def insert_new_concepts(self):
+        """ Inserts the queued new concepts and their initial versions in bulk """
+        if not self.new_concepts:
+            return
+        concepts = self.new_concepts.values()
+        self.new_concepts = OrderedDict()
+        parent_resource_version = self.deferred_source_version or SourceVersion.get_head_of(self.source)
+        initial_versions, _ = Concept.persist_new_in_bulk(concepts, parent_resource_version)
+        if self.index_updater:
+            self.index_updater.add(ConceptVersion, [version.id for version in initial_versions])
+
+        # Make the new concepts known to the lines that follow
+        for concept, initial_version in zip(concepts, initial_versions):
+            self.concept_ids[concept.mnemonic] = concept.id
+            self.concepts_versions_map[concept.id] = initial_version.id
+            self.concept_hashes[concept.id] = initial_version.content_hash
+            if self.concepts_cache is not None:
+                self.concepts_cache[concept.mnemonic] = concept
+            if self.concept_versions_cache is not None:
+                self.concept_versions_cache[initial_version.id] = initial_version
+
+    def try_insert_new_concepts(self):
+        """ Inserts the queued new concepts, counting them as skipped instead of added if the insert fails """
+        concepts = self.new_concepts.values()
+        try:
+            self.insert_new_concepts()
+        except Exception as exc:
+            self.error(unicode('%s\nFailed to insert new concepts: %s. Skipping them...\n' %
+                               (exc, ', '.join(c.mnemonic for c in concepts))))
+            for concept in concepts:
+                self.deferred_failures[concept.mnemonic] = unicode('Failed to insert new concept: %s' % exc)
+                if self.name_index is not None:
+                    self.name_index.remove(concept.id)
+            self.action_count[ImportActionHelper.IMPORT_ACTION_ADD] -= len(concepts)
+            self.action_count[ImportActionHelper.IMPORT_ACTION_SKIP] = \
+                self.action_count.get(ImportActionHelper.IMPORT_ACTION_SKIP, 0) + len(concepts)
+
     def update_concept_version(self, concept_version, data):
         """ Updates the concept, or skips if no diff. Ignores retired status. """
 
         # Generate the diff
         clone = concept_version.clone()
-        serializer = ConceptVersionUpdateSerializer(
-            clone, data=data, context={'request': MockRequest(self.user)})
-        if not serializer.is_valid():
+        try:
+            new_version = ConceptDataDecoder.update_concept_version(clone, data)
+        except ValidationError:
             raise IllegalInputException(
                 'Could not parse concept to update: %s.' % concept_version.mnemonic)
-        new_version = serializer.object
         diffs = ConceptVersion.diff(concept_version, new_version)
 
         # Update concept if different
@@ -302,54 +975,110 @@ class ConceptsImporter(object):
                 diffs['descriptions'] = {'is': data.get('descriptions')}
             clone.update_comment = json.dumps(diffs)
             if not self.test_mode:
-                serializer.save()
-                if not serializer.is_valid():
-                    raise ValidationError(serializer.errors)
+                if self.concept_validators is not None:
+                    new_version.concept_validators = self.concept_validators
+                errors = ConceptVersion.persist_clone(new_version, self.user, **self.source_version_kwargs())
+                if errors:
+                    raise ValidationError(errors)
+                if self.name_index is not None:
+                    self.name_index.replace(new_version.versioned_object)
             return ImportActionHelper.IMPORT_ACTION_UPDATE
 
-        # No diff, so do nothing
+        # No diff, so do nothing except storing the content hash of versions saved before it existed
+        if not self.test_mode and not concept_version.content_hash:
+            ConceptVersion.objects.filter(id=concept_version.id).update(
+                content_hash=concept_version.get_content_hash())
         return ImportActionHelper.IMPORT_ACTION_NONE
 
-    def update_concept_retired_status(self, concept, new_retired_state):
+    def apply_retired_changes(self):
+        """ Retires and un-retires the queued concepts, creating the new versions of each status in bulk """
+        if not self.retired_changes:
+            return
+        changes = self.retired_changes.values()
+        for retired in [True, False]:
+            concepts = [concept for concept, new_retired_state in changes if new_retired_state == retired]
+            new_versions, errors = Concept.change_retired_in_bulk(
+                concepts, retired, self.user, parent_resource_version=self.deferred_source_version)
+            if 'non_field_errors' in errors:
+                raise IllegalInputException('Failed to %s concepts due to %s' %
+                                            ('retire' if retired else 'un-retire', errors))
+            # Changes that were handled are no longer pending, should the other status fail
+            for concept in concepts:
+                del self.retired_changes[concept.id]
+            # Only the concepts that failed validation are skipped, the others were persisted
+            for concept in concepts:
+                if concept.mnemonic in errors:
+                    self.skip_retired_change(concept, retired, 'Failed to change retired status: %s' %
+                                             errors[concept.mnemonic])
+            concepts = [concept for concept in concepts if concept.mnemonic not in errors]
+            if self.index_updater:
+                self.index_updater.add(ConceptVersion, [version.id for version in new_versions] +
+                                       [version.previous_version_id for version in new_versions])
+
+            # Later lines have to find the new versions
+            for version in new_versions:
+                self.concepts_versions_map[version.versioned_object_id] = version.id
+                if self.concept_versions_cache is not None:
+                    self.concept_versions_cache[version.id] = version
+            if self.name_index is not None:
+                for concept in concepts:
+                    self.name_index.replace(concept)
+
+    def try_apply_retired_changes(self):
+        """ Applies the queued retired status changes, counting the ones that could not be persisted as skipped """
+        try:
+            self.apply_retired_changes()
+        except Exception as exc:
+            changes = self.retired_changes.values()
+            self.retired_changes = OrderedDict()
+            self.error(unicode('%s\nFailed to change the retired status of concepts: %s. Skipping them...\n' %
+                               (exc, ', '.join(concept.mnemonic for concept, _ in changes))))
+            for concept, new_retired_state in changes:
+                self.skip_retired_change(concept, new_retired_state, 'Failed to change retired status: %s' % exc)
+
+    def skip_retired_change(self, concept, new_retired_state, message):
+        """ Counts a queued retired status change as skipped, and reports it as the failure of its line """
+        action = ImportActionHelper.IMPORT_ACTION_RETIRE if new_retired_state else \
+            ImportActionHelper.IMPORT_ACTION_UNRETIRE
+        self.action_count[action] -= 1
+        self.count_action(ImportActionHelper.IMPORT_ACTION_SKIP)
+        self.deferred_failures[concept.mnemonic] = unicode(message)
+
+    def update_concept_retired_status(self, concept, new_retired_state, concept_version=None):
         """ Updates and persists a new retired status for a concept """
 
         # Do nothing if retired status is unchanged
-        concept_version = ConceptVersion.get_latest_version_of(concept)
+        queue_change = concept_version is not None and self.chunk_size and not self.test_mode
+        if concept_version is None:
+            concept_version = ConceptVersion.get_latest_version_of(concept)
         if concept_version.retired == new_retired_state:
             return ImportActionHelper.IMPORT_ACTION_NONE
 
+        # A change of the prefetched latest version is queued, to be saved in bulk with the others of the chunk
+        if queue_change:
+            self.retired_changes[concept.id] = (concept, bool(new_retired_state))
+            if new_retired_state:
+                return ImportActionHelper.IMPORT_ACTION_RETIRE
+            return ImportActionHelper.IMPORT_ACTION_UNRETIRE
+
         # Retire/un-retire the concept
         if new_retired_state:
             if not self.test_mode:
-                errors = Concept.retire(concept, self.user)
+                errors = Concept.retire(concept, self.user, **self.source_version_kwargs())
                 if errors:
                     raise IllegalInputException('Failed to retire concept due to %s' % errors)
+                if self.name_index is not None:
+                    self.name_index.replace(concept)
             return ImportActionHelper.IMPORT_ACTION_RETIRE
         else:
             if not self.test_mode:
-                errors = Concept.unretire(concept, self.user)
+                errors = Concept.unretire(concept, self.user, **self.source_version_kwargs())
                 if errors:
                     raise IllegalInputException('Failed to un-retire concept due to %s' % errors)
+                if self.name_index is not None:
+                    self.name_index.replace(concept)
             return ImportActionHelper.IMPORT_ACTION_UNRETIRE
 
-    def remove_concept_version(self, version_id):
-        """ Deactivates a concept """
-        version_query = ConceptVersion.objects.filter(id=version_id)
-
-        if version_query.count() is 0:
-            raise InvalidStateException(
-                "Cannot deactivate concept version %s because it doesn't exist!" % version_id)
-
-        version = version_query.get()
-        if not version.is_active:
-            return ImportActionHelper.IMPORT_ACTION_NONE
-
-        if not self.test_mode:
-            version.is_active = False
-            version.save()
-
-        return ImportActionHelper.IMPORT_ACTION_DEACTIVATE
-
     def count_action(self, update_action):
         """ Increments the counter for the specified action """
         if update_action not in self.action_count:
@@ -360,8 +1089,14 @@ class ConceptsImporter(object):
     def create_concept_versions_map(self):
         # Create map for all concept ids to concept versions
         try:
-            versions_list = ConceptVersion.objects.values('id', 'versioned_object_id').filter(
-                id__in=self.concept_version_ids)
-            self.concepts_versions_map = dict((x['versioned_object_id'], x['id']) for x in versions_list)
+            versions_list = ConceptVersion.objects.values('id', 'versioned_object_id', 'content_hash').filter(
+                id__in=self.source_version.concepts)
+            self.concepts_versions_map = {}
+            self.concept_hashes = {}
+            for x in versions_list:
+                self.concepts_versions_map[x['versioned_object_id']] = x['id']
+                self.concept_hashes[x['versioned_object_id']] = x['content_hash']
+            concepts_list = Concept.objects.values('id', 'mnemonic').filter(parent_id=self.source.id)
+            self.concept_ids = dict((x['mnemonic'], x['id']) for x in concepts_list)
         except KeyError:
             raise InvalidStateException("Map couldn't be created, possible corruption of data")
@@ -1,8 +1,13 @@
+from bson import ObjectId
 from django.core.exceptions import ValidationError
+from django.db.models.signals import pre_save
+import haystack
+from haystack.signals import BaseSignalProcessor
 
 from concepts.custom_validators import OpenMRSConceptValidator
 from concepts.validators import BasicConceptValidator, ValidatorSpecifier
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
+from oclapi.utils import update_all_in_index
 import os
 
 __author__ = 'misternando'
@@ -14,12 +19,16 @@ class DictionaryItemMixin(object):
         return None
 
     @classmethod
-    def persist_new(cls, obj, created_by, **kwargs):
+    def build_initial_version(cls, obj):
+        return None
+
+    @classmethod
+    def prepare_new(cls, obj, created_by, parent_resource):
+        """ Sets the attributes of a new dictionary item that come from its creator and parent, and validates it """
         errors = dict()
         user = created_by
         if not user:
             errors['created_by'] = 'Concept creator cannot be null.'
-        parent_resource = kwargs.pop('parent_resource', None)
         if not parent_resource:
             errors['parent'] = 'Concept parent cannot be null.'
         if errors:
@@ -32,22 +41,31 @@ class DictionaryItemMixin(object):
             obj.full_clean()
         except ValidationError as e:
             errors.update(e.message_dict)
+        return errors
+
+    @classmethod
+    def get_parent_resource_version(cls, parent_resource):
+        version_model = parent_resource.get_version_model()
+
+        if version_model.__name__ in ['SourceVersion', 'CollectionVersion']:
+            return version_model.get_head_of(parent_resource)
+        return version_model.get_latest_version_of(parent_resource)
+
+    @classmethod
+    def persist_new(cls, obj, created_by, **kwargs):
+        parent_resource = kwargs.pop('parent_resource', None)
+        errors = cls.prepare_new(obj, created_by, parent_resource)
         if errors:
             return errors
 
         parent_resource_version = kwargs.pop('parent_resource_version', None)
         if parent_resource_version is None:
-            version_model = parent_resource.get_version_model()
-
-            if version_model.__name__ in ['SourceVersion', 'CollectionVersion']:
-                parent_resource_version = version_model.get_head_of(parent_resource)
-            else:
-                parent_resource_version = version_model.get_latest_version_of(parent_resource)
+            parent_resource_version = cls.get_parent_resource_version(parent_resource)
 
         child_list_attribute = kwargs.pop('child_list_attribute', 'concepts')
 
-        initial_parent_children = getattr(parent_resource_version, child_list_attribute) or []
         initial_version = None
+        member_added = False
         errored_action = 'saving concept'
         persisted = False
         try:
@@ -59,11 +77,9 @@ class DictionaryItemMixin(object):
 
             # Associate the version with a version of the parent
             errored_action = 'associating dictionary item with parent resource'
-            parent_children = getattr(parent_resource_version, child_list_attribute) or []
             child_id = initial_version.id if initial_version else obj.id
-            parent_children.append(child_id)
-            setattr(parent_resource_version, child_list_attribute, parent_children)
-            parent_resource_version.save()
+            parent_resource_version.add_members(child_list_attribute, [child_id])
+            member_added = True
 
             # Save the initial version again to trigger the Solr update
             if initial_version is not None:
@@ -73,33 +89,81 @@ class DictionaryItemMixin(object):
         finally:
             if not persisted:
                 errors['non_field_errors'] = ['An error occurred while %s.' % errored_action]
-                setattr(parent_resource_version, child_list_attribute, initial_parent_children)
-                parent_resource_version.save()
+                if member_added:
+                    parent_resource_version.remove_members(child_list_attribute, [child_id])
                 if initial_version:
                     initial_version.delete()
                 if obj.id:
                     obj.delete()
         return errors
 
+    @classmethod
+    def persist_new_in_bulk(cls, objs, parent_resource_version, child_list_attribute='concepts'):
+        """
+        Inserts new dictionary items that passed prepare_new, and their initial versions, with one bulk insert
+        per collection, then adds them to the parent resource version with a single save.
+        Returns the initial versions and the errors.
+        """
+        errors = dict()
+        if not objs:
+            return [], errors
+
+        # Bulk inserts skip the model signals, so IDs, URIs and other stamped attributes are assigned up front
+        initial_versions = []
+        for obj in objs:
+            obj.id = obj.id or unicode(ObjectId())
+            pre_save.send(sender=cls, instance=obj, raw=False, using=None, update_fields=None)
+            initial_version = cls.build_initial_version(obj)
+            if initial_version is not None:
+                pre_save.send(sender=type(initial_version), instance=initial_version, raw=False, using=None,
+                              update_fields=None)
+                initial_versions.append(initial_version)
+        version_model = cls.get_version_model()
+        child_ids = [v.id for v in initial_versions] if initial_versions else [obj.id for obj in objs]
+
+        errored_action = 'inserting dictionary items'
+        persisted = False
+        try:
+            cls.objects.bulk_create(objs)
+
+            errored_action = 'inserting initial versions of dictionary items'
+            if initial_versions:
+                version_model.objects.bulk_create(initial_versions)
+
+            errored_action = 'associating dictionary items with parent resource'
+            parent_resource_version.add_members(child_list_attribute, child_ids)
+
+            persisted = True
+        finally:
+            if not persisted:
+                errors['non_field_errors'] = ['An error occurred while %s.' % errored_action]
+                if initial_versions:
+                    version_model.objects.filter(id__in=child_ids).delete()
+                cls.objects.filter(id__in=[obj.id for obj in objs]).delete()
+
+        if initial_versions and type(haystack.signal_processor) is not BaseSignalProcessor:
+            update_all_in_index(version_model, version_model.objects.filter(id__in=child_ids))
+        return initial_versions, errors
+
 
 class ConceptValidationMixin:
     def clean(self):
-        from concepts.models import Concept
-
         if os.environ.get('DISABLE_VALIDATION'):
             return
 
-        validators = [BasicConceptValidator()]
-        other_concepts = list(Concept.objects.filter(parent_id=self.parent_source.id, is_active=True, retired=False).values_list('id', flat=True))
-
-        schema = self.parent_source.custom_validation_schema
-        if schema:
-            custom_validator = ValidatorSpecifier()\
-                .with_validation_schema(schema)\
-                .with_repo(self.parent_source)\
-                .with_reference_values()\
-                .get()
-            validators.append(custom_validator)
+        # Bulk writers build the validators once and attach them to every concept they save
+        validators = getattr(self, 'concept_validators', None)
+        if validators is None:
+            validators = [BasicConceptValidator()]
+
+            schema = self.parent_source.custom_validation_schema
+            if schema:
+                custom_validator = ValidatorSpecifier()\
+                    .with_validation_schema(schema)\
+                    .with_repo(self.parent_source)\
+                    .with_reference_values()\
+                    .get()
+                validators.append(custom_validator)
 
         for validator in validators:
             validator.validate(self)
@@ -1,3 +1,6 @@
+from datetime import datetime
+
+from bson import ObjectId
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
@@ -6,15 +9,17 @@ from django.core.urlresolvers import reverse
 from django.db import models
 from django.db.models import Q
 from django.db.models import get_model
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django_mongodb_engine.contrib import MongoDBManager
 from djangotoolbox.fields import ListField, EmbeddedModelField
 from uuidfield import UUIDField
 
 from concepts.mixins import DictionaryItemMixin, ConceptValidationMixin
-from oclapi.models import (SubResourceBaseModel, ResourceVersionModel,
+from concepts.validators import LookupValues, BasicConceptValidator, ValidatorSpecifier
+from oclapi.models import (SubResourceBaseModel, ResourceVersionModel, VersionMembership,
                            VERSION_TYPE, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW)
+from oclapi.utils import content_digest
 from sources.models import SourceVersion, Source
 
 class LocalizedText(models.Model):
@@ -35,6 +40,9 @@ class LocalizedText(models.Model):
             locale_preferred=self.locale_preferred
         )
 
+    def get_content(self):
+        return [self.external_id or None, self.name, self.type, self.locale, bool(self.locale_preferred)]
+
     @property
     def is_fully_specified(self):
         return self.type == "FULLY_SPECIFIED" or self.type == "Fully Specified"
@@ -47,6 +55,78 @@ class LocalizedText(models.Model):
     def is_search_index_term(self):
         return self.type == "INDEX_TERM" or self.type == "Index Term"
 
+class ConceptNameEntry(models.Model):
+    """
+    Non-short name of an active, non-retired concept, indexed by source, locale and name. Kept up to date whenever
+    a concept is saved, so that checking a name for uniqueness within a source is a single indexed lookup.
+    """
+    source_id = models.TextField()
+    locale = models.TextField(null=True, blank=True)
+    name = models.TextField()
+    name_type = models.TextField(null=True, blank=True)
+    concept_id = models.TextField(db_index=True)
+
+    class MongoMeta:
+        indexes = [
+            [('source_id', 1), ('locale', 1), ('name', 1), ('name_type', 1)],
+        ]
+
+    @classmethod
+    def entries_for(cls, concept):
+        if not concept.is_active or concept.retired:
+            return []
+        return [cls(source_id=concept.parent_id, locale=name.locale, name=name.name, name_type=name.type,
+                    concept_id=concept.id) for name in (concept.names or []) if not name.is_short]
+
+    @classmethod
+    def register(cls, concepts):
+        """ Replaces the registered names of the concepts with their current names """
+        if not concepts:
+            return
+        cls.objects.filter(concept_id__in=[concept.id for concept in concepts]).delete()
+        entries = [entry for concept in concepts for entry in cls.entries_for(concept)]
+        if entries:
+            cls.objects.bulk_create(entries)
+
+    @classmethod
+    def concept_ids_with_name(cls, source_id, locale, name):
+        return list(cls.objects.filter(source_id=source_id, locale=locale, name=name)
+                    .values_list('concept_id', flat=True))
+
+
+class ConceptNameIndex(object):
+    """
+    In-memory copy of the name entries of a source, keyed by locale and name. Bulk writers replace the names of
+    their concepts in it once the concepts pass validation, so that the concepts they have not saved yet are seen too.
+    """
+    def __init__(self, source):
+        self.concept_ids = {}
+        self.names_by_concept = {}
+        entries = ConceptNameEntry.objects.filter(source_id=source.id).values_list('concept_id', 'locale', 'name')
+        for concept_id, locale, name in entries:
+            self.add(concept_id, [(locale, name)])
+
+    def add(self, concept_id, keys):
+        for key in keys:
+            self.concept_ids.setdefault(key, set()).add(concept_id)
+        self.names_by_concept.setdefault(concept_id, []).extend(keys)
+
+    def remove(self, concept_id):
+        for key in self.names_by_concept.pop(concept_id, []):
+            concept_ids = self.concept_ids[key]
+            concept_ids.discard(concept_id)
+            if not concept_ids:
+                del self.concept_ids[key]
+
+    def replace(self, concept):
+        self.remove(concept.id)
+        if not concept.retired:
+            self.add(concept.id, [(name.locale, name.name) for name in concept.names if not name.is_short])
+
+    def concept_ids_with_name(self, locale, name):
+        return list(self.concept_ids.get((locale, name), []))
+
+
 CONCEPT_TYPE = 'Concept'
 
 
@@ -149,7 +229,100 @@ class Concept(ConceptValidationMixin, SubResourceBaseModel, DictionaryItemMixin)
         return initial_version
 
     @classmethod
-    def retire(cls, concept, user, update_comment=None):
+    def build_initial_version(cls, obj):
+        initial_version = ConceptVersion.for_concept(obj, '--TEMP--')
+        initial_version.versioned_object = obj
+        initial_version.id = unicode(ObjectId())
+        initial_version.mnemonic = initial_version.id
+        initial_version.root_version_id = initial_version.id
+        initial_version.released = True
+        return initial_version
+
+    @classmethod
+    def persist_new_in_bulk(cls, objs, parent_resource_version, child_list_attribute='concepts'):
+        initial_versions, errors = super(Concept, cls).persist_new_in_bulk(
+            objs, parent_resource_version, child_list_attribute=child_list_attribute)
+        if not errors:
+            ConceptNameEntry.register(objs)
+            LookupValues.concepts_changed(objs)
+        return initial_versions, errors
+
+    @classmethod
+    def build_validators(cls, source):
+        """
+        Returns the validators of a source for saving many of its concepts, which check names against an in-memory
+        name index if the source has a schema, and the name index
+        """
+        validators = [BasicConceptValidator()]
+        name_index = None
+        schema = source.custom_validation_schema
+        if schema:
+            name_index = ConceptNameIndex(source)
+            validators.append(ValidatorSpecifier()
+                              .with_validation_schema(schema)
+                              .with_repo(source)
+                              .with_name_index(name_index)
+                              .with_reference_values()
+                              .get())
+        return validators, name_index
+
+    @classmethod
+    def change_retired_in_bulk(cls, concepts, retired, user, update_comment=None, parent_resource_version=None):
+        """
+        Retires or un-retires concepts of one source, creating their new versions in bulk instead of calling
+        persist_clone for each concept. Concepts that already have the retired status are left alone, and the ones
+        whose un-retired version fails validation are left out while the others are persisted.
+        Returns the new versions and the errors, by concept mnemonic or, if nothing could be persisted, as
+        non_field_errors.
+        """
+        concepts = [concept for concept in concepts if concept.retired != retired]
+        if not concepts:
+            return [], dict()
+        source = concepts[0].parent
+        if parent_resource_version is None:
+            parent_resource_version = SourceVersion.get_head_of(source)
+        concepts_by_id = dict((concept.id, concept) for concept in concepts)
+
+        clones = []
+        errors = dict()
+        validators, name_index = cls.build_validators(source) if not retired else (None, None)
+        for latest_version in ConceptVersion.objects.filter(
+                versioned_object_id__in=concepts_by_id.keys(), is_latest_version=True):
+            clone = latest_version.clone()
+            clone.retired = retired
+            clone.update_comment = update_comment or ('Concept was retired' if retired else 'Concept was un-retired')
+            clones.append(clone)
+
+            # Un-retired names must not clash with the names of the other concepts, including the ones un-retired here
+            if validators:
+                concept = concepts_by_id[clone.versioned_object_id]
+                clone.concept_validators = validators
+                try:
+                    clone.clean()
+                except ValidationError as err:
+                    errors[concept.mnemonic] = err.messages
+                    continue
+                if name_index:
+                    name_index.add(concept.id, [(name.locale, name.name) for name in clone.names if not name.is_short])
+        if errors:
+            clones = [clone for clone in clones if concepts_by_id[clone.versioned_object_id].mnemonic not in errors]
+            concepts = [concepts_by_id[clone.versioned_object_id] for clone in clones]
+        if not clones:
+            return [], errors
+        persist_errors = ConceptVersion.persist_clones_in_bulk(clones, user, parent_resource_version, 'concepts')
+        if persist_errors:
+            return [], persist_errors
+
+        cls.objects.filter(id__in=[concept.id for concept in concepts]).update(
+            retired=retired, updated_by=user.username, updated_at=datetime.now())
+        for concept in concepts:
+            concept.retired = retired
+        ConceptNameEntry.register(concepts)
+        LookupValues.concepts_changed(concepts)
+        return clones, errors
+
+    @classmethod
+    def retire(cls, concept, user, update_comment=None, **kwargs):
         if concept.retired:
             return {'__all__': 'Concept is already retired'}
         latest_version = ConceptVersion.get_latest_version_of(concept)
@@ -159,21 +332,21 @@ class Concept(ConceptValidationMixin, SubResourceBaseModel, DictionaryItemMixin)
             retired_version.update_comment = update_comment
         else :
             retired_version.update_comment = 'Concept was retired'
-        errors = ConceptVersion.persist_clone(retired_version, user)
+        errors = ConceptVersion.persist_clone(retired_version, user, **kwargs)
         if not errors:
             concept.retired = True
             concept.save()
         return errors
 
     @classmethod
-    def unretire(cls, concept, user):
+    def unretire(cls, concept, user, **kwargs):
         if not concept.retired:
             return {'__all__': 'Concept is already not retired'}
         latest_version = ConceptVersion.get_latest_version_of(concept)
         unretired_version = latest_version.clone()
         unretired_version.retired = False
         unretired_version.update_comment = 'Concept was un-retired'
-        errors = ConceptVersion.persist_clone(unretired_version, user)
+        errors = ConceptVersion.persist_clone(unretired_version, user, **kwargs)
         if not errors:
             concept.retired = False
             concept.save()
@@ -225,6 +398,7 @@ class ConceptVersion(ConceptValidationMixin, ResourceVersionModel):
     is_latest_version = models.BooleanField(default=True)
     version_created_by = models.TextField()
     update_comment = models.TextField(null=True, blank=True)
+    content_hash = models.TextField(null=True, blank=True)
 
     objects = MongoDBManager()
 
@@ -290,7 +464,8 @@ class ConceptVersion(ConceptValidationMixin, ResourceVersionModel):
 
     @property
     def collection_versions(self):
-        return get_model('collection', 'CollectionVersion').objects.filter(concepts=self.id)
+        return get_model('collection', 'CollectionVersion').objects.filter(
+            id__in=VersionMembership.container_version_ids('concepts', [self.id]))
 
     @property
     def mappings_url(self):
@@ -378,11 +553,55 @@ class ConceptVersion(ConceptValidationMixin, ResourceVersionModel):
             updated_by=concept.updated_by,
         )
 
+    def get_content_hash(self):
+        return self.content_digest_of(
+            self.external_id, self.concept_class, self.datatype, self.retired, self.extras,
+            [n.get_content() for n in self.names or []],
+            [d.get_content() for d in self.descriptions or []])
+
+    @classmethod
+    def content_digest_of(cls, external_id, concept_class, datatype, retired, extras, names, descriptions):
+        return content_digest({
+            'external_id': external_id,
+            'concept_class': concept_class,
+            'datatype': datatype,
+            'retired': retired,
+            'extras': extras or {},
+            'names': sorted(names),
+            'descriptions': sorted(descriptions),
+        })
+
+    @classmethod
+    def content_hash_of_import_data(cls, data):
+        """
+        Computes the content hash of an import line without going through the serializer.
+        Returns None when the line is not in a shape that can be compared, in which case
+        the caller should fall back to a full update.
+        """
+        try:
+            names = [cls.localized_text_content_of_import_data(n, 'name', 'name_type')
+                     for n in data.get('names') or []]
+            descriptions = [cls.localized_text_content_of_import_data(d, 'description', 'description_type')
+                            for d in data.get('descriptions') or []]
+        except AttributeError:
+            return None
+        return cls.content_digest_of(
+            data.get('external_id'), data.get('concept_class'), data.get('datatype'), data.get('retired', False),
+            data.get('extras'), names, descriptions)
+
+    @classmethod
+    def localized_text_content_of_import_data(cls, data, name_key, type_key):
+        locale_preferred = data.get('locale_preferred', False) in [True, 'True', 'true', 'TRUE']
+        return [data.get('external_id') or None, data.get(name_key), data.get(type_key), data.get('locale'),
+                locale_preferred]
+
     @classmethod
     def diff(cls, v1, v2):
         diffs = {}
         if v1.public_access != v2.public_access:
             diffs['public_access'] = {'was': v1.public_access, 'is': v2.public_access}
+        if v1.id and v1.content_hash and v1.content_hash == v2.get_content_hash():
+            return diffs
         if v1.external_id != v2.external_id:
             diffs['external_id'] = {'was': v1.external_id, 'is': v2.external_id}
         if v1.concept_class != v2.concept_class:
@@ -449,7 +668,7 @@ class ConceptVersion(ConceptValidationMixin, ResourceVersionModel):
         obj.version_created_by = user.username
         previous_version = obj.previous_version
         previous_was_latest = previous_version.is_latest_version and obj.is_latest_version
-        source_version = SourceVersion.get_head_of(obj.versioned_object.parent)
+        source_version = kwargs.pop('parent_resource_version', None) or SourceVersion.get_head_of(obj.versioned_object.parent)
         persisted = False
         errored_action = 'saving new concept version'
         try:
@@ -501,6 +720,33 @@ class ConceptVersion(ConceptValidationMixin, ResourceVersionModel):
     def get_url_kwarg():
         return 'concept_version'
 
+@receiver(pre_save, sender=ConceptVersion)
+def set_content_hash(sender, instance=None, **kwargs):
+    instance.content_hash = instance.get_content_hash()
+
+
+@receiver(post_save, sender=Concept)
+def register_names(sender, instance=None, **kwargs):
+    ConceptNameEntry.register([instance])
+
+
+@receiver(post_delete, sender=Concept)
+def unregister_names(sender, instance=None, **kwargs):
+    ConceptNameEntry.objects.filter(concept_id=instance.id).delete()
+
+
+@receiver(post_save, sender=Concept)
+@receiver(post_delete, sender=Concept)
+def invalidate_lookup_values(sender, instance=None, **kwargs):
+    LookupValues.concepts_changed([instance])
+
+
+@receiver(post_save, sender=Source)
+@receiver(post_delete, sender=Source)
+def invalidate_lookup_sources(sender, instance=None, **kwargs):
+    LookupValues.source_changed(instance)
+
+
 @receiver(post_save, sender=Source)
 def propagate_parent_attributes(sender, instance=None, created=False, **kwargs):
     if created:
@@ -1,14 +1,14 @@
-from django.contrib.contenttypes.models import ContentType
 from haystack import indexes
 from concepts.models import ConceptVersion
-from oclapi.search_backends import SortOrFilterField, FilterField
+from concepts.serializers import ConceptVersionListSerializer
+from oclapi.search_backends import SortOrFilterField, FilterField, StoredPayloadField
 from oclapi.search_indexes import OCLSearchIndex
-from sources.models import SourceVersion, Source
 
 __author__ = 'misternando'
 
 
 class ConceptVersionIndex(OCLSearchIndex, indexes.Indexable):
+    membership_attribute = 'concepts'
     text = indexes.CharField(
         document=True, use_template=True)
     name = SortOrFilterField(
@@ -38,10 +38,14 @@ class ConceptVersionIndex(OCLSearchIndex, indexes.Indexable):
     collection = FilterField()
     collection_version = FilterField()
     is_active = indexes.BooleanField(model_attr='is_active', indexed=True, stored=True)
+    list_payload = StoredPayloadField()
 
     def get_model(self):
         return ConceptVersion
 
+    def prepare_list_payload(self, obj):
+        return self.serialize_payload(obj, ConceptVersionListSerializer)
+
     def prepare_locale(self, obj):
         locales = set()
         if obj.names:
@@ -51,19 +55,10 @@ class ConceptVersionIndex(OCLSearchIndex, indexes.Indexable):
         return list(locales)
 
     def prepare_source_version(self, obj):
-        source_version_ids = []
-        source = obj.source
-        source_versions = SourceVersion.objects.filter(
-            versioned_object_id=source.id,
-            versioned_object_type=ContentType.objects.get_for_model(Source)
-        )
-        for sv in source_versions:
-            if obj.id in sv.concepts:
-                source_version_ids.append(sv.id)
-        return source_version_ids
+        return self.get_membership_map(obj).source_versions_of(obj)
 
     def prepare_collection_version(self, obj):
-        return obj.collection_version_ids
+        return self.get_membership_map(obj).collection_versions_of(obj)
 
     def prepare_collection(self, obj):
-        return obj.collection_ids
+        return self.get_membership_map(obj).collections_of(obj)
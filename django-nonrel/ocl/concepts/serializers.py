@@ -5,7 +5,7 @@ from concepts.models import Concept, ConceptVersion, LocalizedText
 from concepts.validation_messages import BASIC_NAMES_CANNOT_BE_EMPTY
 from oclapi.fields import HyperlinkedResourceIdentityField
 from oclapi.models import NAMESPACE_REGEX
-from oclapi.serializers import ResourceVersionSerializer
+from oclapi.serializers import ResourceVersionSerializer, StoredPayloadSerializer
 
 
 class ConceptListSerializer(serializers.Serializer):
@@ -122,6 +122,9 @@ class ConceptVersionListSerializer(ResourceVersionSerializer):
             mappings_field.source = 'get_empty_mappings'
 
 
+class ConceptVersionStoredListSerializer(StoredPayloadSerializer):
+    fallback_serializer_class = ConceptVersionListSerializer
+
 
 class ConceptVersionDetailSerializer(ResourceVersionSerializer):
     type = serializers.CharField(source='versioned_resource_type')
@@ -14,9 +14,11 @@ from concepts.validation_messages import OPENMRS_ONE_FULLY_SPECIFIED_NAME_PER_LO
     OPENMRS_SHORT_NAME_CANNOT_BE_PREFERRED, OPENMRS_DESCRIPTION_LOCALE, OPENMRS_NAME_LOCALE, OPENMRS_DESCRIPTION_TYPE, \
     OPENMRS_NAME_TYPE, OPENMRS_DATATYPE, OPENMRS_CONCEPT_CLASS, BASIC_DESCRIPTION_CANNOT_BE_EMPTY, \
     OPENMRS_PREFERRED_NAME_UNIQUE_PER_SOURCE_LOCALE, OPENMRS_AT_LEAST_ONE_FULLY_SPECIFIED_NAME
-from concepts.validators import ValidatorSpecifier
+from concepts.models import ConceptNameEntry
+from concepts.validators import ValidatorSpecifier, LookupValues
 from concepts.views import ConceptVersionListView
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
+from oclapi.search_indexes import MembershipMap
 from test_helper.base import *
 
 
@@ -494,6 +496,47 @@ class ConceptClassMethodsTest(ConceptBaseTest):
         self.assertTrue(concept_version.id in source_version.concepts)
         self.assertEquals(concept_version.mnemonic, concept_version.id)
 
+    def test_persist_new_in_bulk_positive(self):
+        source_version = SourceVersion.get_head_of(self.source1)
+        self.assertEquals(0, len(source_version.concepts))
+        concepts = [Concept(mnemonic=mnemonic, concept_class='First', datatype='None', names=[self.name])
+                    for mnemonic in ['concept1', 'concept2']]
+        for concept in concepts:
+            self.assertEquals({}, Concept.prepare_new(concept, self.user1, self.source1))
+
+        (initial_versions, errors) = Concept.persist_new_in_bulk(concepts, source_version)
+
+        self.assertEquals(0, len(errors))
+        source_version = SourceVersion.objects.get(id=source_version.id)
+        self.assertEquals([v.id for v in initial_versions], source_version.concepts)
+        for concept in concepts:
+            concept = Concept.objects.get(id=concept.id)
+            self.assertEquals(self.source1.public_access, concept.public_access)
+            self.assertEquals(1, concept.num_versions)
+            concept_version = ConceptVersion.get_latest_version_of(concept)
+            self.assertEquals(concept_version, concept_version.root_version)
+            self.assertEquals(concept_version.mnemonic, concept_version.id)
+            self.assertEquals(concept.uri + concept_version.id + '/', concept_version.uri)
+            self.assertEquals(concept_version.get_content_hash(), concept_version.content_hash)
+
+    def test_change_retired_in_bulk_should_persist_concepts_that_pass_validation(self):
+        source = self.source_for_openmrs
+        clashing_name = create_localized_text('Clashing Name', locale_preferred=True)
+        (clashing, _) = create_concept(self.user1, source, mnemonic='clashing', names=[clashing_name])
+        (other, _) = create_concept(self.user1, source, mnemonic='other',
+                                    names=[create_localized_text('Other Name', locale_preferred=True)])
+        Concept.change_retired_in_bulk([clashing, other], True, self.user1)
+        create_concept(self.user1, source, mnemonic='active', names=[create_localized_text('Clashing Name',
+                                                                                          locale_preferred=True)])
+
+        concepts = list(Concept.objects.filter(id__in=[clashing.id, other.id]))
+        (versions, errors) = Concept.change_retired_in_bulk(concepts, False, self.user1)
+
+        self.assertEquals(['clashing'], errors.keys())
+        self.assertEquals([other.id], [version.versioned_object_id for version in versions])
+        self.assertTrue(Concept.objects.get(id=clashing.id).retired)
+        self.assertFalse(Concept.objects.get(id=other.id).retired)
+
     def test_persist_new_negative__no_owner(self):
         source_version = SourceVersion.get_latest_version_of(self.source1)
         self.assertEquals(0, len(source_version.concepts))
@@ -994,6 +1037,57 @@ class ConceptVersionTest(ConceptBaseTest):
                           CollectionVersion.objects.get(mnemonic='version1').id)
 
 
+    def test_membership_map_should_match_version_properties(self):
+        kwargs = {
+            'parent_resource': self.userprofile1
+        }
+
+        collection = Collection(
+            name='collection2',
+            mnemonic='collection2',
+            full_name='Collection Two',
+            collection_type='Dictionary',
+            public_access=ACCESS_TYPE_EDIT,
+            default_locale='en',
+            supported_locales=['en'],
+            website='www.collection2.com',
+            description='This is the second test collection'
+        )
+        Collection.persist_new(collection, self.user1, **kwargs)
+
+        source = Source(
+            name='source',
+            mnemonic='source',
+            full_name='Source One',
+            source_type='Dictionary',
+            public_access=ACCESS_TYPE_EDIT,
+            default_locale='en',
+            supported_locales=['en'],
+            website='www.source1.com',
+            description='This is the first test source'
+        )
+        kwargs = {
+            'parent_resource': self.org1
+        }
+        Source.persist_new(source, self.user1, **kwargs)
+
+        (concept1, errors) = create_concept(mnemonic='concept12', user=self.user1, source=source)
+        (another_concept, errors) = create_concept(mnemonic='anotherConcept', user=self.user1, source=source)
+
+        collection.expressions = ['/orgs/org1/sources/source/concepts/concept12/']
+        collection.full_clean()
+        collection.save()
+
+        versions = list(ConceptVersion.objects.filter(versioned_object_id__in=[concept1.id, another_concept.id]))
+        membership_map = MembershipMap('concepts', versions)
+
+        for version in versions:
+            self.assertItemsEqual(membership_map.source_versions_of(version),
+                                  [sv.id for sv in SourceVersion.objects.filter(versioned_object_id=source.id)
+                                   if version.id in sv.concepts])
+            self.assertItemsEqual(membership_map.collection_versions_of(version), version.collection_version_ids)
+            self.assertItemsEqual(membership_map.collections_of(version), version.collection_ids)
+
 class ConceptVersionStaticMethodsTest(ConceptBaseTest):
     def setUp(self):
         super(ConceptVersionStaticMethodsTest, self).setUp()
@@ -1050,6 +1144,22 @@ class ConceptVersionStaticMethodsTest(ConceptBaseTest):
         self.assertEquals(self.concept1.external_id, version.external_id)
         self.assertFalse(version.released)
 
+    def test_content_hash_of_import_data(self):
+        data = {
+            'id': 'concept1',
+            'concept_class': 'Diagnosis',
+            'datatype': 'None',
+            'names': [{'name': 'concept1', 'locale': 'en', 'name_type': 'FULLY_SPECIFIED'}],
+            'descriptions': [{'description': 'aDescription', 'locale': 'en', 'description_type': 'FULLY_SPECIFIED'}],
+        }
+        version = ConceptVersion.objects.get(id=self.concept_version.id)
+        self.assertEquals(version.get_content_hash(), version.content_hash)
+        self.assertEquals(version.content_hash, ConceptVersion.content_hash_of_import_data(data))
+
+        data['names'][0]['locale_preferred'] = 'true'
+        self.assertNotEquals(version.content_hash, ConceptVersion.content_hash_of_import_data(data))
+        self.assertIsNone(ConceptVersion.content_hash_of_import_data({'names': ['concept1']}))
+
     def test_persist_clone_positive(self):
         self.assertEquals(2, self.concept1.num_versions)
         self.assertEquals(
@@ -1325,7 +1435,30 @@ class OpenMRSConceptValidationTest(ConceptBaseTest):
 
 
 class ValidatorSpecifierTest(ConceptBaseTest):
-    def test_specifier_should_initialize_openmrs_validator_with_name_registry(self):
+    def test_specifier_should_initialize_openmrs_validator_with_repo(self):
+        user = create_user()
+        source = create_source(user, validation_schema=CUSTOM_VALIDATION_SCHEMA_OPENMRS)
+
+        validator = ValidatorSpecifier() \
+            .with_validation_schema(CUSTOM_VALIDATION_SCHEMA_OPENMRS) \
+            .with_repo(source) \
+            .get()
+
+        self.assertEquals(source.id, validator.repo_id)
+
+    def test_lookup_values_should_be_reloaded_when_reference_source_changes(self):
+        user = create_user()
+        classes_source = Source.objects.get(parent_id=Organization.objects.get(mnemonic='OCL').id, mnemonic='Classes')
+
+        self.assertTrue('Diagnosis' in LookupValues.get('Classes'))
+        self.assertFalse('Finding' in LookupValues.get('Classes'))
+
+        create_concept(user, classes_source, concept_class='Concept Class', names=[create_localized_text('Finding')])
+
+        self.assertTrue('Finding' in LookupValues.get('Classes'))
+        self.assertTrue(isinstance(LookupValues.get('Classes'), frozenset))
+
+    def test_name_registry_should_track_names_of_active_concepts(self):
         user = create_user()
         source = create_source(user, validation_schema=CUSTOM_VALIDATION_SCHEMA_OPENMRS)
 
@@ -1335,31 +1468,24 @@ class ValidatorSpecifierTest(ConceptBaseTest):
         flu_es = create_localized_text('Flu', locale='es', type='Fully Specified')
         flu_fr = create_localized_text('Flu', locale='fr', locale_preferred=True)
         flu_en = create_localized_text('Flu', locale='en', locale_preferred=True)
+        flu_short = create_localized_text('FL', locale='en', type='Short')
 
-        concept_1, errors1 = create_concept(user=user, source=source, names=[diabetes_en_1, diabetes_es])
-        concept_2, errors2 = create_concept(user=user, source=source, names=[diabetes_en_2, flu_es])
-        concept_3, _ = create_concept(user=user, source=source, names=[flu_en, flu_fr])
-
-        expected_name_registry = {
-            u'enDiabetes': [concept_1.id, concept_2.id],
-            u'frFlu': [concept_3.id],
-            u'enFlu': [concept_3.id],
-            u'esDiabetes': [concept_1.id],
-            u'esFlu': [concept_2.id]
-        }
+        concept_1, _ = create_concept(user=user, source=source, names=[diabetes_en_1, diabetes_es])
+        concept_2, _ = create_concept(user=user, source=source, names=[diabetes_en_2, flu_es])
+        concept_3, _ = create_concept(user=user, source=source, names=[flu_en, flu_fr, flu_short])
 
-        validator = ValidatorSpecifier() \
-            .with_validation_schema(CUSTOM_VALIDATION_SCHEMA_OPENMRS) \
-            .with_repo(source) \
-            .get()
+        self.assertItemsEqual([concept_1.id, concept_2.id],
+                              ConceptNameEntry.concept_ids_with_name(source.id, 'en', 'Diabetes'))
+        self.assertItemsEqual([concept_3.id], ConceptNameEntry.concept_ids_with_name(source.id, 'fr', 'Flu'))
+        self.assertItemsEqual([concept_3.id], ConceptNameEntry.concept_ids_with_name(source.id, 'en', 'Flu'))
+        self.assertItemsEqual([concept_1.id], ConceptNameEntry.concept_ids_with_name(source.id, 'es', 'Diabetes'))
+        self.assertItemsEqual([concept_2.id], ConceptNameEntry.concept_ids_with_name(source.id, 'es', 'Flu'))
+        self.assertItemsEqual([], ConceptNameEntry.concept_ids_with_name(source.id, 'en', 'FL'))
 
-        actual_name_registry = validator.name_registry
+        Concept.retire(concept_1, user)
 
-        self.assertItemsEqual(expected_name_registry[u'enDiabetes'], actual_name_registry[u'enDiabetes'])
-        self.assertItemsEqual(expected_name_registry[u'frFlu'], actual_name_registry[u'frFlu'])
-        self.assertItemsEqual(expected_name_registry[u'enFlu'], actual_name_registry[u'enFlu'])
-        self.assertItemsEqual(expected_name_registry[u'esDiabetes'], actual_name_registry[u'esDiabetes'])
-        self.assertItemsEqual(expected_name_registry[u'esFlu'], actual_name_registry[u'esFlu'])
+        self.assertItemsEqual([concept_2.id], ConceptNameEntry.concept_ids_with_name(source.id, 'en', 'Diabetes'))
+        self.assertItemsEqual([], ConceptNameEntry.concept_ids_with_name(source.id, 'es', 'Diabetes'))
 
     def test_specifier_should_initialize_openmrs_validator_with_reference_values(self):
         user = create_user()
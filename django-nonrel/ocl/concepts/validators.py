@@ -1,3 +1,5 @@
+import time
+
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
 
@@ -14,6 +16,106 @@ def message_with_name_details(message, name):
     preferred = 'yes' if name.locale_preferred else 'no'
     return unicode(u'{}: {} (locale: {}, preferred: {})'.format(message, unicode(name_str), locale, preferred))
 
+class LookupValues(object):
+    """
+    Names of the concepts in the reference sources of the OCL organization, loaded once per process as frozen sets.
+    Saving a concept or source of those sources invalidates them at once in the saving process; other processes
+    notice the change through a generation counter in the cache, which they check every CHECK_INTERVAL seconds.
+    """
+    SOURCE_CONCEPT_CLASSES = {
+        'Classes': None,
+        'Datatypes': None,
+        'NameTypes': None,
+        'DescriptionTypes': None,
+        'Locales': None,
+        'MapTypes': 'MapType',
+    }
+    GENERATION_CACHE_KEY = 'lookup_values_generation'
+    GENERATION_TIMEOUT = 30 * 24 * 60 * 60
+    CHECK_INTERVAL = 5
+
+    values = None
+    source_ids = None
+    generation = None
+    checked_at = 0
+
+    @classmethod
+    def get(cls, source_mnemonic):
+        """ Returns the values of a reference source, or None if the source has not been imported """
+        return cls.get_all().get(source_mnemonic)
+
+    @classmethod
+    def get_all(cls):
+        cls.check_generation()
+        if cls.values is None:
+            cls.values = cls.load()
+        return cls.values
+
+    @classmethod
+    def load(cls):
+        from concepts.models import Concept
+        values = dict()
+        for source in cls.get_sources():
+            concepts = Concept.objects.filter(parent_id=source.id, retired=False, is_active=True)
+            concept_class = cls.SOURCE_CONCEPT_CLASSES[source.mnemonic]
+            if concept_class:
+                concepts = concepts.filter(concept_class=concept_class)
+            values[source.mnemonic] = frozenset(name.name for concept in concepts for name in concept.names)
+        return values
+
+    @classmethod
+    def get_sources(cls):
+        from orgs.models import Organization
+        from sources.models import Source
+        try:
+            ocl_org = Organization.objects.get(mnemonic='OCL')
+        except Organization.DoesNotExist:
+            return []
+        return list(Source.objects.filter(parent_id=ocl_org.id, mnemonic__in=cls.SOURCE_CONCEPT_CLASSES.keys()))
+
+    @classmethod
+    def is_reference_source(cls, source):
+        return source.mnemonic in cls.SOURCE_CONCEPT_CLASSES
+
+    @classmethod
+    def is_reference_source_id(cls, source_id):
+        if cls.source_ids is None:
+            cls.source_ids = frozenset(source.id for source in cls.get_sources())
+        return source_id in cls.source_ids
+
+    @classmethod
+    def concepts_changed(cls, concepts):
+        if any(cls.is_reference_source_id(concept.parent_id) for concept in concepts):
+            cls.invalidate()
+
+    @classmethod
+    def source_changed(cls, source):
+        if cls.is_reference_source(source):
+            cls.source_ids = None
+            cls.invalidate()
+
+    @classmethod
+    def invalidate(cls):
+        cls.values = None
+        try:
+            cls.generation = cache.incr(cls.GENERATION_CACHE_KEY)
+        except ValueError:
+            cls.generation = 1
+            cache.set(cls.GENERATION_CACHE_KEY, cls.generation, cls.GENERATION_TIMEOUT)
+
+    @classmethod
+    def check_generation(cls):
+        now = time.time()
+        if now - cls.checked_at < cls.CHECK_INTERVAL:
+            return
+        cls.checked_at = now
+        generation = cache.get(cls.GENERATION_CACHE_KEY)
+        if generation != cls.generation:
+            cls.generation = generation
+            cls.values = None
+            cls.source_ids = None
+
+
 class ValidatorSpecifier:
     def __init__(self):
         from concepts.custom_validators import OpenMRSConceptValidator
@@ -21,65 +123,31 @@ class ValidatorSpecifier:
             CUSTOM_VALIDATION_SCHEMA_OPENMRS: OpenMRSConceptValidator
         }
         self.reference_values = dict()
-        self.name_registry = dict()
+        self.repo_id = None
+        self.name_index = None
 
     def with_validation_schema(self, schema):
         self.validation_schema = schema
         return self
 
     def with_repo(self, repo):
-        from concepts.models import Concept
-        concepts_in_source = Concept.objects.filter(parent_id=repo.id, is_active=True, retired=False).all()
-
-        name_registry = dict()
-
-        for concept in concepts_in_source:
-            for name in concept.names:
-                if name.is_short:
-                    continue
-                name_key = u"{}{}".format(name.locale, name.name)
-                ids = name_registry.get(name_key, [])
-                ids.append(concept.id)
-                name_registry[name_key] = ids
-
-        self.name_registry = name_registry
+        self.repo_id = repo.id
+        return self
 
+    def with_name_index(self, name_index):
+        self.name_index = name_index
         return self
 
     def with_reference_values(self):
-        from orgs.models import Organization
-        from sources.models import Source
-
-        FIVE_MINS = 5*60
-        reference_value_source_mnemonics = ['Classes', 'Datatypes', 'NameTypes', 'DescriptionTypes', 'Locales']
-
-        ocl_org_filter = Organization.objects.get(mnemonic='OCL')
-
-        if not cache.has_key('reference_sources'):
-            cache.set('reference_sources', Source.objects.filter(parent_id=ocl_org_filter.id, mnemonic__in=reference_value_source_mnemonics), FIVE_MINS)
-
-        sources = cache.get('reference_sources')
-
-        self.reference_values = dict()
-        for source in sources:
-            if not cache.has_key(source.mnemonic):
-                cache.set(source.mnemonic,self._get_reference_values(source), FIVE_MINS)
-            reference_values = cache.get(source.mnemonic)
-            self.reference_values[source.mnemonic] = reference_values
-
+        self.reference_values = LookupValues.get_all()
         return self
 
-    def _get_reference_values(self, reference_value_source):
-        from concepts.models import Concept
-        reference_concepts = list(Concept.objects.filter(retired=False, is_active=True, parent_id=reference_value_source.id).all())
-        names_in_concepts = map(lambda value: value.names, reference_concepts)
-        return [name_object.name for names in names_in_concepts for name_object in names]
-
     def get(self):
         validator_class = self.validator_map.get(self.validation_schema, BasicConceptValidator)
 
         kwargs = {
-            'name_registry': self.name_registry,
+            'repo_id': self.repo_id,
+            'name_index': self.name_index,
             'reference_values': self.reference_values
         }
 
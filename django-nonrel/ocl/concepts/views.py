@@ -14,12 +14,13 @@ from concepts.permissions import CanViewParentDictionary, CanEditParentDictionar
 from concepts.serializers import (ConceptDetailSerializer, ConceptVersionListSerializer,
                                   ConceptVersionDetailSerializer, ConceptVersionUpdateSerializer,
                                   ConceptVersionsSerializer, ConceptNameSerializer,
-                                  ConceptDescriptionSerializer)
+                                  ConceptDescriptionSerializer, ConceptVersionStoredListSerializer)
 from mappings.models import Mapping
 from mappings.serializers import MappingListSerializer
 from oclapi.filters import HaystackSearchFilter
 from oclapi.mixins import ListWithHeadersMixin, ConceptVersionCSVFormatterMixin
 from oclapi.models import ACCESS_TYPE_NONE, ResourceVersionModel
+from oclapi.search_indexes import LIST_PAYLOAD_FIELD
 from oclapi.views import (ConceptDictionaryMixin, VersionedResourceChildMixin, BaseAPIView,
                           ChildResourceMixin, parse_updated_since_param, ResourceVersionMixin)
 from sources.models import SourceVersion
@@ -31,6 +32,8 @@ INCLUDE_RETIRED_PARAM = 'includeRetired'
 INCLUDE_MAPPINGS_PARAM = 'includeMappings'
 INCLUDE_INVERSE_MAPPINGS_PARAM = 'includeInverseMappings'
 LIMIT_PARAM = 'limit'
+MAPPING_PARAMS = [INCLUDE_MAPPINGS_PARAM, INCLUDE_INVERSE_MAPPINGS_PARAM,
+                  'include_direct_mappings', 'include_indirect_mappings']
 
 
 class ConceptBaseView(ChildResourceMixin):
@@ -105,7 +108,25 @@ class ConceptRetrieveUpdateDestroyView(ConceptBaseView, RetrieveAPIView,
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class ConceptVersionListAllView(BaseAPIView, ConceptVersionCSVFormatterMixin, ListWithHeadersMixin):
+class ConceptVersionListSerializerMixin(object):
+
+    def set_list_serializer(self, request):
+        """
+        Serializes verbose lists from the concept versions, and other lists from the representations stored in the
+        search index, unless they include mappings or are exported to CSV
+        """
+        self.search_payload_field = None
+        if self.is_verbose(request):
+            self.serializer_class = ConceptVersionDetailSerializer
+        elif any(request.QUERY_PARAMS.get(param) for param in MAPPING_PARAMS + ['csv']):
+            self.serializer_class = ConceptVersionListSerializer
+        else:
+            self.search_payload_field = LIST_PAYLOAD_FIELD
+            self.serializer_class = ConceptVersionStoredListSerializer
+
+
+class ConceptVersionListAllView(BaseAPIView, ConceptVersionListSerializerMixin, ConceptVersionCSVFormatterMixin,
+                                ListWithHeadersMixin):
     model = ConceptVersion
     permission_classes = (CanViewParentDictionary,)
     filter_backends = [PublicConceptsSearchFilter]
@@ -140,7 +161,7 @@ class ConceptVersionListAllView(BaseAPIView, ConceptVersionCSVFormatterMixin, Li
     def get(self, request, *args, **kwargs):
         self.updated_since = parse_updated_since_param(request)
         self.include_retired = request.QUERY_PARAMS.get(INCLUDE_RETIRED_PARAM, False)
-        self.serializer_class = ConceptVersionDetailSerializer if self.is_verbose(request) else ConceptVersionListSerializer
+        self.set_list_serializer(request)
         self.limit = 100 if request.QUERY_PARAMS.get('csv') else request.QUERY_PARAMS.get(LIMIT_PARAM, 25)
         return self.list(request, *args, **kwargs)
 
@@ -214,7 +235,7 @@ class ConceptVersionMixin():
     child_list_attribute = 'concepts'
 
 
-class ConceptVersionListView(ConceptVersionMixin, VersionedResourceChildMixin,
+class ConceptVersionListView(ConceptVersionMixin, VersionedResourceChildMixin, ConceptVersionListSerializerMixin,
                              ConceptVersionCSVFormatterMixin, ListWithHeadersMixin):
     serializer_class = ConceptVersionListSerializer
     permission_classes = (CanViewParentDictionary,)
@@ -249,7 +270,7 @@ class ConceptVersionListView(ConceptVersionMixin, VersionedResourceChildMixin,
         self.filter_backends = [LimitCollectionVersionFilter] if 'collection' in kwargs else [LimitSourceVersionFilter]
         self.updated_since = parse_updated_since_param(request)
         self.include_retired = request.QUERY_PARAMS.get(INCLUDE_RETIRED_PARAM, False)
-        self.serializer_class = ConceptVersionDetailSerializer if self.is_verbose(request) else ConceptVersionListSerializer
+        self.set_list_serializer(request)
 
         return self.list(request, *args, **kwargs)
 
@@ -424,6 +445,106 @@ class ConceptExtraRetrieveUpdateDestroyView(ConceptBaseView, VersionedResourceCh
         return Response({"detail": "Not found."}, status.HTTP_404_NOT_FOUND)
 
 
+class ConceptEditsView(ConceptBaseView):
+    """
+    Applies several changes to the names, descriptions and extras of a concept as a single new version, e.g.
+    {"names": {"add": [...], "update": [{"uuid": ..., ...}], "delete": [uuid, ...]},
+     "descriptions": {...}, "extras": {"set": {key: value}, "delete": [key, ...]}, "update_comment": ...}
+    """
+    permission_classes = (CanEditParentDictionary,)
+    label_serializers = [('names', ConceptNameSerializer), ('descriptions', ConceptDescriptionSerializer)]
+
+    def initialize(self, request, path_info_segment, **kwargs):
+        self.parent_path_info = self.get_parent_in_path(path_info_segment, levels=1)
+        self.parent_resource = None
+        if self.parent_path_info and '/' != self.parent_path_info:
+            self.parent_resource = self.get_object_for_path(self.parent_path_info, self.request)
+        if hasattr(self.parent_resource, 'versioned_object'):
+            self.parent_resource = self.parent_resource.versioned_object
+        self.parent_resource_version = ConceptVersion.get_latest_version_of(self.parent_resource)
+
+    def patch(self, request, *args, **kwargs):
+        self.check_object_permissions(request, self.parent_resource)
+        if not isinstance(request.DATA, dict):
+            return Response({'detail': 'Expected an object of changes.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        new_version = self.parent_resource_version.clone()
+        changes = []
+        errors = {}
+        for attribute, serializer_class in self.label_serializers:
+            label_errors = self.apply_label_edits(new_version, attribute, serializer_class,
+                                                  request.DATA.get(attribute) or {}, changes)
+            if label_errors:
+                errors[attribute] = label_errors
+        extras_errors = self.apply_extras_edits(new_version, request.DATA.get('extras') or {}, changes)
+        if extras_errors:
+            errors['extras'] = extras_errors
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        if not changes:
+            return Response({'detail': 'No changes to apply.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        new_version.update_comment = request.DATA.get('update_comment') or ' '.join(changes)
+        errors = ConceptVersion.persist_clone(new_version, request.user)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        serializer = ConceptVersionDetailSerializer(new_version, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+    def apply_label_edits(self, new_version, attribute, serializer_class, edits, changes):
+        if not isinstance(edits, dict):
+            return ['Expected an object with add, update and delete lists.']
+        labels = getattr(new_version, attribute) or []
+        setattr(new_version, attribute, labels)
+        labels_by_uuid = dict((unicode(label.uuid), label) for label in labels)
+        errors = []
+
+        for data in edits.get('update') or []:
+            label = labels_by_uuid.get(unicode(data.get('uuid'))) if isinstance(data, dict) else None
+            if label is None:
+                errors.append('Could not find %s to update: %s.' % (attribute, data))
+                continue
+            serializer = serializer_class(label, data=data, partial=True)
+            if serializer.is_valid():
+                changes.append('Updated %s in %s.' % (label.name, attribute))
+            else:
+                errors.append(serializer.errors)
+
+        for uuid in edits.get('delete') or []:
+            label = labels_by_uuid.pop(unicode(uuid), None)
+            if label is None:
+                errors.append('Could not find %s to delete: %s.' % (attribute, uuid))
+                continue
+            labels.remove(label)
+            changes.append('Deleted %s from %s.' % (label.name, attribute))
+
+        for data in edits.get('add') or []:
+            serializer = serializer_class(data=data)
+            if serializer.is_valid():
+                labels.append(serializer.object)
+                changes.append('Added to %s: %s.' % (attribute, serializer.object.name))
+            else:
+                errors.append(serializer.errors)
+        return errors
+
+    def apply_extras_edits(self, new_version, edits, changes):
+        if not isinstance(edits, dict):
+            return ['Expected an object with set and delete entries.']
+        extras = dict(new_version.extras or {})
+        errors = []
+        for key, value in (edits.get('set') or {}).items():
+            extras[key] = value
+            changes.append('Updated extras: %s=%s.' % (key, value))
+        for key in edits.get('delete') or []:
+            if key not in extras:
+                errors.append('Could not find extra to delete: %s.' % key)
+                continue
+            del extras[key]
+            changes.append('Deleted extra %s.' % key)
+        new_version.extras = extras
+        return errors
+
+
 class ConceptLabelListCreateView(ConceptBaseView, VersionedResourceChildMixin,
                                  ListWithHeadersMixin, ListCreateAPIView):
     model = LocalizedText
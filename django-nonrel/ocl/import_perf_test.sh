@@ -8,7 +8,6 @@ yes | python manage.py rebuild_index -a 1 -k 5
 #first time import
 start=`date +%s`
 python manage.py import_concepts_to_source --source $SOURCE --token PERF_TEST_TOKEN perf_data/ciel_20160711_concepts_2k.json
-yes | python manage.py rebuild_index -a 1 -k 5
 end=`date +%s`
 runtime=$((end-start))
 echo "Took ${runtime} sec to complete import concepts"
@@ -20,7 +19,6 @@ fi
 
 start=`date +%s`
 python manage.py import_mappings_to_source --source $SOURCE --token PERF_TEST_TOKEN perf_data/ciel_20160711_mappings_2k.json
-yes | python manage.py rebuild_index -a 1 -k 5
 end=`date +%s`
 runtime=$((end-start))
 echo "Took ${runtime} sec to complete import mappings"
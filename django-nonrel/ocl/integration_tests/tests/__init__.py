@@ -3,4 +3,5 @@ from integration_tests.tests.bulk_import_validation import *
 from integration_tests.tests.openmrs_concept_validation import *
 from integration_tests.tests.openmrs_mapping_validation import *
 from integration_tests.tests.validation_on_source_schema_change import *
+from integration_tests.tests.import_api import *
 from integration_tests.tests.all import *
@@ -7,6 +7,7 @@ from django.test.client import MULTIPART_CONTENT, FakePayload
 from django.utils.encoding import force_str
 from django.utils.unittest.case import skip
 from haystack.management.commands import update_index
+from haystack.query import SearchQuerySet
 from moto import mock_s3
 from rest_framework import status
 
@@ -57,6 +58,26 @@ class ConceptCreateViewTest(ConceptBaseTest):
         self.assertEquals(1, len(source_head_concepts))
         self.assertEquals(content[0]['version'], source_head_concepts[0])
 
+    def test_list_should_be_served_from_stored_payload(self):
+        update_haystack_index()
+        self.client.login(username='user1', password='user1')
+        kwargs = {
+            'org': self.org1.mnemonic,
+            'source': self.source1.mnemonic
+        }
+
+        result = SearchQuerySet().models(ConceptVersion).filter(source_version=self.source1.get_head().id)[0]
+        self.assertEquals('concept1', result.list_payload['id'])
+
+        response = self.client.get(reverse('concept-create', kwargs=kwargs))
+        self.assertEquals(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEquals([result.list_payload], content)
+
+        response = self.client.get(reverse('concept-create', kwargs=kwargs) + '?verbose=true')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('names' in json.loads(response.content)[0])
+
     def test_create_concept_without_fully_specified_name(self):
         self.client.login(username='user1', password='user1')
 
@@ -695,6 +716,57 @@ class ConceptCreateViewTest(ConceptBaseTest):
         self.assertEquals(response.data['names'], [BASIC_NAMES_CANNOT_BE_EMPTY])
 
 
+    def test_edits_should_create_one_version(self):
+        name = LocalizedText(name='Grip', locale='en', type='FULLY_SPECIFIED')
+        (concept, _) = create_concept(mnemonic='concept', user=self.user1, source=self.source1, names=[name])
+        name_uuid = unicode(ConceptVersion.get_latest_version_of(concept).names[0].uuid)
+        self.client.login(username='user1', password='user1')
+        kwargs = {
+            'org': self.org1.mnemonic,
+            'source': self.source1.mnemonic,
+            'concept': concept.mnemonic
+        }
+
+        data = json.dumps({
+            "names": {
+                "add": [{"name": "Flu", "locale": "en", "name_type": "SHORT"}],
+                "update": [{"uuid": name_uuid, "name": "Influenza"}]
+            },
+            "extras": {"set": {"reviewed": "yes"}},
+            "update_comment": "Reviewed names"
+        })
+
+        response = self.client.patch(reverse('concept-edits', kwargs=kwargs), data,
+                                     content_type='application/json')
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(concept.num_versions, 2)
+        latest_version = ConceptVersion.get_latest_version_of(concept)
+        self.assertEquals(sorted([n.name for n in latest_version.names]), ['Flu', 'Influenza'])
+        self.assertEquals(latest_version.extras, {'reviewed': 'yes'})
+        self.assertEquals(latest_version.update_comment, 'Reviewed names')
+
+    def test_edits_with_unknown_name_should_fail_without_new_version(self):
+        (concept, _) = create_concept(mnemonic='concept', user=self.user1, source=self.source1)
+        self.client.login(username='user1', password='user1')
+        kwargs = {
+            'org': self.org1.mnemonic,
+            'source': self.source1.mnemonic,
+            'concept': concept.mnemonic
+        }
+
+        data = json.dumps({
+            "names": {"delete": ["unknown"]},
+            "extras": {"set": {"reviewed": "yes"}}
+        })
+
+        response = self.client.patch(reverse('concept-edits', kwargs=kwargs), data,
+                                     content_type='application/json')
+
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue('names' in response.data)
+        self.assertEquals(concept.num_versions, 1)
+
 class ConceptVersionAllView(ConceptBaseTest):
     def test_collection_concept_version_list(self):
         kwargs = {
@@ -1,6 +1,9 @@
+from StringIO import StringIO
+
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 
-from concepts.importer import ConceptsImporter, ValidationLogger
+from concepts.importer import ConceptsImporter, ValidationLogger, ConceptDataDecoder
 from concepts.validation_messages import OPENMRS_NAMES_EXCEPT_SHORT_MUST_BE_UNIQUE, OPENMRS_MUST_HAVE_EXACTLY_ONE_PREFERRED_NAME, \
     OPENMRS_SHORT_NAME_CANNOT_BE_PREFERRED, OPENMRS_PREFERRED_NAME_UNIQUE_PER_SOURCE_LOCALE, \
     OPENMRS_AT_LEAST_ONE_FULLY_SPECIFIED_NAME, OPENMRS_FULLY_SPECIFIED_NAME_UNIQUE_PER_SOURCE_LOCALE
@@ -11,6 +14,7 @@ from mappings.importer import MappingsImporter
 from mappings.models import Mapping
 from mappings.models import MappingVersion
 from mappings.tests import MappingBaseTest
+from oclapi.management.commands import ImportActionHelper, ImportCheckpoint
 from sources.models import SourceVersion
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS, LOOKUP_CONCEPT_CLASSES
 from test_helper.base import create_source, create_user, create_concept
@@ -90,6 +94,22 @@ class BulkConceptImporterTest(ConceptBaseTest):
         self.assertTrue('4;%s' % OPENMRS_AT_LEAST_ONE_FULLY_SPECIFIED_NAME  in logger.output.getvalue())
         self.assertTrue('7;%s' % OPENMRS_FULLY_SPECIFIED_NAME_UNIQUE_PER_SOURCE_LOCALE  in logger.output.getvalue())
 
+    def test_validate_only_reports_errors_without_importing(self):
+        self.testfile = open('./integration_tests/fixtures/valid_invalid_concepts.json', 'rb')
+        stderr_stub = TestStream()
+
+        logger = ValidationLogger(output=TestStream())
+        source = create_source(self.user1, validation_schema=CUSTOM_VALIDATION_SCHEMA_OPENMRS)
+        num_concepts = Concept.objects.count()
+
+        importer = ConceptsImporter(source, self.testfile, 'test', TestStream(), stderr_stub, validation_logger=logger)
+        importer.validate_concepts(total=7)
+
+        self.assertTrue('MNEMONIC;ERROR;JSON' in logger.output.getvalue())
+        self.assertTrue('4;%s' % OPENMRS_AT_LEAST_ONE_FULLY_SPECIFIED_NAME in logger.output.getvalue())
+        self.assertTrue('7;%s' % OPENMRS_FULLY_SPECIFIED_NAME_UNIQUE_PER_SOURCE_LOCALE in logger.output.getvalue())
+        self.assertEquals(num_concepts, Concept.objects.count())
+
     def test_validation_error_file_exists(self):
         self.testfile = open('./integration_tests/fixtures/valid_invalid_concepts.json', 'rb')
         stderr_stub = TestStream()
@@ -104,6 +124,46 @@ class BulkConceptImporterTest(ConceptBaseTest):
         self.assertTrue(path.exists(output_file_name))
         remove(output_file_name)
 
+    def test_resumed_validation_logger_should_append_to_the_report(self):
+        output_file_name = 'test_resumed_file.csv'
+        logger = ValidationLogger(output_file_name=output_file_name)
+        logger.append_concept({'id': '1'}, ['first error'])
+        logger.close()
+
+        logger = ValidationLogger(output_file_name=output_file_name, append=True)
+        logger.append_concept({'id': '2'}, ['second error'])
+        logger.close()
+
+        from os import remove
+        with open(output_file_name) as report:
+            lines = report.read().splitlines()
+        remove(output_file_name)
+        self.assertEquals(lines[0], 'MNEMONIC;ERROR;JSON')
+        self.assertEquals([line.split(';')[:2] for line in lines[1:]], [['1', 'first error'], ['2', 'second error']])
+
+
+class ConceptDataDecoderTest(ConceptBaseTest):
+    def test_new_concept_from_import_data(self):
+        concept = ConceptDataDecoder.new_concept({
+            'id': 'C1', 'concept_class': 'Diagnosis', 'datatype': 'None', 'retired': 'false',
+            'names': [{'name': u'Malaria', 'locale': u'en', 'locale_preferred': 'true', 'name_type': 'FULLY_SPECIFIED'}],
+            'descriptions': [{'description': u'A disease', 'locale': u'en'}],
+        })
+
+        self.assertEquals('C1', concept.mnemonic)
+        self.assertEquals('Diagnosis', concept.concept_class)
+        self.assertFalse(concept.retired)
+        self.assertEquals(u'Malaria', concept.names[0].name)
+        self.assertTrue(concept.names[0].locale_preferred)
+        self.assertEquals('FULLY_SPECIFIED', concept.names[0].type)
+        self.assertEquals(u'A disease', concept.descriptions[0].name)
+
+    def test_new_concept_from_invalid_import_data(self):
+        with self.assertRaises(ValidationError):
+            ConceptDataDecoder.new_concept({'id': 'C 1', 'concept_class': 'Diagnosis'})
+        with self.assertRaises(ValidationError):
+            ConceptDataDecoder.new_concept({'id': 'C1', 'names': [{'name': u'Malaria'}]})
+
 
 class ConceptImporterTest(ConceptBaseTest):
     def setUp(self):
@@ -147,6 +207,77 @@ class ConceptImporterTest(ConceptBaseTest):
         self.assertTrue(('Updated concept, replacing version ID ' + latest_concept_version.previous_version.id) in stdout_stub.getvalue())
         self.assertTrue('**** Processed 1 out of 1 concepts - 1 updated, ****' in stdout_stub.getvalue())
 
+    def test_import_job_in_chunks_for_change_in_data(self):
+        stdout_stub = TestStream()
+        create_concept(mnemonic='1', user=self.user1, source=self.source1)
+
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1, chunk_size=100)
+        all_concept_versions = ConceptVersion.objects.exclude(concept_class__in=LOOKUP_CONCEPT_CLASSES)
+        self.assertEquals(len(all_concept_versions), 2)
+
+        latest_concept_version = [version for version in all_concept_versions if version.previous_version][0]
+        self.assertEquals(len(latest_concept_version.names), 4)
+        self.assertTrue('**** Processed 1 out of 1 concepts - 1 updated, ****' in stdout_stub.getvalue())
+
+    def test_import_job_in_chunks_for_one_record(self):
+        stdout_stub = TestStream()
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1, chunk_size=100)
+        self.assertTrue('Created new concept: 1 = Diagnosis' in stdout_stub.getvalue())
+        inserted_concept = Concept.objects.get(mnemonic='1')
+        inserted_concept_version = ConceptVersion.objects.get(versioned_object_id=inserted_concept.id)
+        source_version_latest = SourceVersion.get_latest_version_of(self.source1)
+        self.assertEquals(source_version_latest.concepts, [inserted_concept_version.id])
+
+    def test_import_job_skips_unchanged_record_by_content_hash(self):
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', TestStream(), TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1)
+        num_versions = ConceptVersion.objects.count()
+
+        stdout_stub = TestStream()
+        testfile = open('./integration_tests/fixtures/one_concept.json', 'rb')
+        importer = ConceptsImporter(self.source1, testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1)
+
+        self.assertEquals(num_versions, ConceptVersion.objects.count())
+        self.assertTrue('**** Processed 1 out of 1 concepts - 1 no action/no diff, ****' in stdout_stub.getvalue())
+        self.assertFalse(importer.concept_version_ids)
+
+    def test_import_job_resumes_from_checkpoint(self):
+        stdout_stub = TestStream()
+        checkpoint = ImportCheckpoint('./one_concept.json.checkpoint')
+        source_version = SourceVersion.get_latest_version_of(self.source1)
+        file_size = len(open('./integration_tests/fixtures/one_concept.json', 'rb').read())
+        checkpoint.save(source_version.id, file_size, 1, {ImportActionHelper.IMPORT_ACTION_ADD: 1}, [])
+
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1, checkpoint=checkpoint, resume=True)
+
+        self.assertTrue('Resuming import after line 1' in stdout_stub.getvalue())
+        self.assertTrue('**** Processed 1 out of 1 concepts - 1 added, ****' in stdout_stub.getvalue())
+        self.assertFalse(Concept.objects.filter(mnemonic='1').exists())
+        self.assertFalse(checkpoint.exists())
+
+    def test_apply_membership_changes_of_import_workers(self):
+        create_concept(mnemonic='1', user=self.user1, source=self.source1)
+        head = SourceVersion.get_head_of(self.source1)
+        existing_version_id = head.concepts[0]
+
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', TestStream(), TestStream(), save_validation_errors=False)
+        importer.apply_membership_changes(['added'], {existing_version_id: 'updated', 'updated': 'retired'})
+
+        self.assertEquals(SourceVersion.get_head_of(self.source1).concepts, ['retired', 'added'])
+
+    def test_apply_membership_changes_should_add_versions_whose_previous_version_is_not_a_member(self):
+        create_concept(mnemonic='1', user=self.user1, source=self.source1)
+        existing_version_id = SourceVersion.get_head_of(self.source1).concepts[0]
+
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', TestStream(), TestStream(), save_validation_errors=False)
+        importer.apply_membership_changes([], {'not_a_member': 'updated', 'updated': 'retired'})
+
+        self.assertEquals(SourceVersion.get_head_of(self.source1).concepts, [existing_version_id, 'retired'])
+
 
 class MappingImporterTest(MappingBaseTest):
     def setUp(self):
@@ -242,4 +373,23 @@ class MappingImporterTest(MappingBaseTest):
         self.assertTrue('Cannot map concept to itself.' in stderr_stub.getvalue())
         self.assertTrue("Must specify either 'to_concept' or 'to_source' & " in stderr_stub.getvalue())
         self.assertEquals(3, Mapping.objects.count())
-        self.assertEquals(3, MappingVersion.objects.count())
\ No newline at end of file
+        self.assertEquals(3, MappingVersion.objects.count())
+
+    def test_import_same_mapping_twice_in_one_chunk(self):
+        stdout_stub = TestStream()
+        line = open('./integration_tests/fixtures/one_mapping.json', 'rb').read().strip()
+        importer = MappingsImporter(self.source1, StringIO(line + '\n' + line + '\n'), stdout_stub, TestStream(), 'test')
+        importer.import_mappings(total=2)
+        self.assertEquals(1, Mapping.objects.filter(to_concept_code='413532003').count())
+        self.assertTrue('1 added,' in stdout_stub.getvalue())
+        self.assertTrue('1 no action/no diff,' in stdout_stub.getvalue())
+
+    def test_import_mapping_from_unknown_concept(self):
+        stderr_stub = TestStream()
+        mappings_file = StringIO('{"from_concept_url": "/orgs/org2/sources/source2/concepts/unknown/", '
+                                 '"to_source_url": "/users/user1/sources/source1/", "map_type": "SAME-AS", '
+                                 '"to_concept_code": "413532003"}\n')
+        importer = MappingsImporter(self.source1, mappings_file, TestStream(), stderr_stub, 'test')
+        importer.import_mappings(total=1)
+        self.assertTrue('Concept /orgs/org2/sources/source2/concepts/unknown/ does not exist' in stderr_stub.getvalue())
+        self.assertFalse(Mapping.objects.filter(to_concept_code='413532003').exists())
\ No newline at end of file
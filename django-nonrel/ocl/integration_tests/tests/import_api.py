@@ -0,0 +1,180 @@
+import json
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from mock import mock
+from rest_framework.status import HTTP_202_ACCEPTED, HTTP_400_BAD_REQUEST, HTTP_200_OK
+
+from concepts.models import Concept, ConceptVersion
+from concepts.tests import ConceptBaseTest
+from sources.models import ImportJob, SourceVersion, IMPORT_JOB_SUCCESS
+from tasks import import_source_file
+from test_helper.base import create_user
+
+
+class ImportJobApiTest(ConceptBaseTest):
+    def setUp(self):
+        super(ImportJobApiTest, self).setUp()
+        User.objects.create(
+            username='superuser',
+            password='superuser',
+            email='superuser@test.com',
+            last_name='Super',
+            first_name='User',
+            is_superuser=True
+        )
+        self.spool_dir = tempfile.mkdtemp()
+        self.user = create_user()
+        self.client.login(username=self.user.username, password=self.user.password)
+        self.kwargs = {'org': self.org1.mnemonic, 'source': self.source1.mnemonic}
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+        super(ImportJobApiTest, self).tearDown()
+
+    @mock.patch('sources.views.import_source_file')
+    def test_post_spools_upload_and_queues_job(self, import_task):
+        data = open('./integration_tests/fixtures/one_concept.json', 'rb').read()
+        with self.settings(IMPORT_SPOOL_DIR=self.spool_dir):
+            response = self.client.post(reverse('source-import-list', kwargs=self.kwargs) + '?type=concepts', data,
+                                        content_type='application/x-ndjson')
+            self.assertEquals(response.status_code, HTTP_202_ACCEPTED)
+            content = json.loads(response.content)
+            self.assertEquals(content['status'], 'PENDING')
+            self.assertEquals(content['file_size'], len(data))
+
+            job = ImportJob.objects.get(id=content['id'])
+            self.assertEquals(open(job.input_file_name, 'rb').read(), data)
+            import_task.delay.assert_called_once_with(job.id)
+
+            import_source_file(job.id)
+            response = self.client.get(reverse('source-import-detail', kwargs=dict(self.kwargs, job=job.id)))
+            self.assertEquals(response.status_code, HTTP_200_OK)
+            content = json.loads(response.content)
+            self.assertEquals(content['status'], IMPORT_JOB_SUCCESS)
+            self.assertEquals(content['progress'], 1.0)
+            self.assertEquals(content['action_count'], {'added': 1})
+            self.assertTrue(Concept.objects.filter(parent_id=self.source1.id, mnemonic='1').exists())
+
+    @mock.patch('sources.views.import_source_file')
+    def test_post_without_type_or_upload_is_rejected(self, import_task):
+        with self.settings(IMPORT_SPOOL_DIR=self.spool_dir):
+            response = self.client.post(reverse('source-import-list', kwargs=self.kwargs), '{}',
+                                        content_type='application/x-ndjson')
+            self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+
+            response = self.client.post(reverse('source-import-list', kwargs=self.kwargs) + '?type=mappings', '',
+                                        content_type='application/x-ndjson')
+            self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertFalse(ImportJob.objects.exists())
+        self.assertFalse(import_task.delay.called)
+
+
+class BulkConceptsApiTest(ConceptBaseTest):
+    def setUp(self):
+        super(BulkConceptsApiTest, self).setUp()
+        self.user = create_user()
+        self.client.login(username=self.user.username, password=self.user.password)
+        self.url = reverse('source-bulk-concepts', kwargs={'org': self.org1.mnemonic, 'source': self.source1.mnemonic})
+        self.concept = json.loads(open('./integration_tests/fixtures/one_concept.json', 'rb').read())
+
+    def test_post_array_returns_result_per_item(self):
+        invalid_concept = dict(self.concept, id='2', names=[])
+        response = self.client.post(self.url, json.dumps([self.concept, invalid_concept]),
+                                    content_type='application/json')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        content = json.loads(response.content)
+        self.assertEquals(content[0], {'id': '1', 'action': 'added'})
+        self.assertEquals(content[1]['id'], '2')
+        self.assertEquals(content[1]['action'], 'skipped due to error')
+        self.assertTrue(content[1]['errors'])
+
+        concept = Concept.objects.get(parent_id=self.source1.id, mnemonic='1')
+        self.assertFalse(Concept.objects.filter(parent_id=self.source1.id, mnemonic='2').exists())
+        head = SourceVersion.get_head_of(self.source1)
+        self.assertTrue(ConceptVersion.get_latest_version_of(concept).id in head.concepts)
+
+    def test_post_json_lines_updates_existing_concepts(self):
+        self.client.post(self.url, json.dumps([self.concept]), content_type='application/json')
+        concept = Concept.objects.get(parent_id=self.source1.id, mnemonic='1')
+        initial_version = ConceptVersion.get_latest_version_of(concept)
+
+        changed_concept = dict(self.concept, external_id='2AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+        response = self.client.post(self.url, json.dumps(self.concept) + '\n' + json.dumps(changed_concept) + '\n',
+                                    content_type='application/x-ndjson')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        content = json.loads(response.content)
+        self.assertEquals([result['action'] for result in content], ['no action/no diff', 'updated'])
+
+        latest_version = ConceptVersion.get_latest_version_of(concept)
+        self.assertEquals(latest_version.external_id, '2AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+        head = SourceVersion.get_head_of(self.source1)
+        self.assertTrue(latest_version.id in head.concepts)
+        self.assertFalse(initial_version.id in head.concepts)
+
+    def test_post_without_concepts_is_rejected(self):
+        response = self.client.post(self.url, '{}', content_type='application/json')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        response = self.client.post(self.url, 'not json', content_type='application/x-ndjson')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+
+
+class BulkActionApiTest(ConceptBaseTest):
+    def setUp(self):
+        super(BulkActionApiTest, self).setUp()
+        self.user = create_user()
+        self.client.login(username=self.user.username, password=self.user.password)
+        kwargs = {'org': self.org1.mnemonic, 'source': self.source1.mnemonic}
+        self.url = reverse('source-bulk-actions', kwargs=kwargs)
+        concept = json.loads(open('./integration_tests/fixtures/one_concept.json', 'rb').read())
+        concepts = [dict(concept, id=mnemonic, retired=False) for mnemonic in ['1', '2']]
+        self.client.post(reverse('source-bulk-concepts', kwargs=kwargs), json.dumps(concepts),
+                         content_type='application/json')
+
+    def test_retire_and_unretire_concepts(self):
+        previous_versions = [ConceptVersion.get_latest_version_of(concept)
+                             for concept in Concept.objects.filter(parent_id=self.source1.id)]
+        response = self.client.post(self.url, json.dumps({'action': 'retire', 'concepts': ['1', '2', '3']}),
+                                    content_type='application/json')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        content = json.loads(response.content)
+        self.assertEquals(content['concepts'], 2)
+        self.assertEquals(content['not_found'], {'concepts': ['3'], 'mappings': []})
+
+        head = SourceVersion.get_head_of(self.source1)
+        for previous_version in previous_versions:
+            concept = Concept.objects.get(id=previous_version.versioned_object_id)
+            latest_version = ConceptVersion.get_latest_version_of(concept)
+            self.assertTrue(concept.retired)
+            self.assertTrue(latest_version.retired)
+            self.assertTrue(latest_version.is_latest_version)
+            self.assertEquals(latest_version.previous_version_id, previous_version.id)
+            self.assertFalse(ConceptVersion.objects.get(id=previous_version.id).is_latest_version)
+            self.assertTrue(latest_version.id in head.concepts)
+            self.assertFalse(previous_version.id in head.concepts)
+
+        response = self.client.post(self.url, json.dumps({'action': 'unretire', 'concepts': ['1']}),
+                                    content_type='application/json')
+        self.assertEquals(json.loads(response.content)['concepts'], 1)
+        self.assertFalse(Concept.objects.get(parent_id=self.source1.id, mnemonic='1').retired)
+        self.assertTrue(Concept.objects.get(parent_id=self.source1.id, mnemonic='2').retired)
+
+    def test_deactivate_concepts(self):
+        concept = Concept.objects.get(parent_id=self.source1.id, mnemonic='1')
+        response = self.client.post(self.url, json.dumps({'action': 'deactivate', 'concepts': ['1']}),
+                                    content_type='application/json')
+        self.assertEquals(json.loads(response.content)['concepts'], 1)
+        self.assertFalse(ConceptVersion.objects.get(versioned_object_id=concept.id, is_latest_version=True).is_active)
+
+    def test_mapping_ids_that_are_not_object_ids_are_not_found(self):
+        response = self.client.post(self.url, json.dumps({'action': 'retire', 'concepts': ['1'], 'mappings': ['bad']}),
+                                    content_type='application/json')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(json.loads(response.content)['not_found'], {'concepts': [], 'mappings': ['bad']})
+
+    def test_unknown_action_is_rejected(self):
+        response = self.client.post(self.url, json.dumps({'action': 'delete', 'concepts': ['1']}),
+                                    content_type='application/json')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
@@ -1,12 +1,15 @@
 import json
 
 from django.core.urlresolvers import reverse
-from rest_framework.status import HTTP_400_BAD_REQUEST, HTTP_201_CREATED, HTTP_200_OK
+from mock import mock
+from rest_framework.status import HTTP_202_ACCEPTED, HTTP_200_OK
 
 from concepts.tests import ConceptBaseTest
 from concepts.validation_messages import OPENMRS_FULLY_SPECIFIED_NAME_UNIQUE_PER_SOURCE_LOCALE
 from concepts.validators import message_with_name_details
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
+from sources.models import Source, SchemaValidationJob, IMPORT_JOB_FAILURE, IMPORT_JOB_SUCCESS
+from sources.tests import run_schema_validation
 from test_helper.base import create_source, create_user, create_localized_text, create_concept
 
 
@@ -27,12 +30,19 @@ class ValidationOnSourceSchemaTest(ConceptBaseTest):
             'custom_validation_schema': CUSTOM_VALIDATION_SCHEMA_OPENMRS
         })
 
-        response = self.client.put(reverse('source-detail', kwargs=kwargs), data, content_type='application/json')
+        with mock.patch('sources.serializers.validate_source_schema') as validate_source_schema:
+            response = self.client.put(reverse('source-detail', kwargs=kwargs), data, content_type='application/json')
 
-        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
-        response_content = json.loads(response.content)
-        self.assertIn('failed_concept_validations', response_content)
-        self.assertItemsEqual(response_content['failed_concept_validations'], [
+        self.assertEqual(response.status_code, HTTP_202_ACCEPTED)
+        job_id = json.loads(response.content)['schema_validation_job']['id']
+        validate_source_schema.delay.assert_called_once_with(job_id)
+        job = run_schema_validation(SchemaValidationJob.objects.get(id=job_id))
+        self.assertEqual(IMPORT_JOB_FAILURE, job.status)
+        self.assertIsNone(Source.objects.get(id=source_no_validation.id).custom_validation_schema)
+
+        response = self.client.get(job.failures_url)
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        self.assertItemsEqual(json.loads(response.content), [
                 {u"mnemonic": concept_1.mnemonic,
                  u"url": concept_1.url,
                  u"errors": {u"names": [
@@ -56,6 +66,11 @@ class ValidationOnSourceSchemaTest(ConceptBaseTest):
             'custom_validation_schema': CUSTOM_VALIDATION_SCHEMA_OPENMRS
         })
 
-        response = self.client.put(reverse('source-detail', kwargs=kwargs), data, content_type='application/json')
+        with mock.patch('sources.serializers.validate_source_schema'):
+            response = self.client.put(reverse('source-detail', kwargs=kwargs), data, content_type='application/json')
 
-        self.assertEqual(response.status_code, HTTP_200_OK)
+        self.assertEqual(response.status_code, HTTP_202_ACCEPTED)
+        job = run_schema_validation(SchemaValidationJob.objects.get(id=json.loads(response.content)['schema_validation_job']['id']))
+        self.assertEqual(IMPORT_JOB_SUCCESS, job.status)
+        self.assertEqual(CUSTOM_VALIDATION_SCHEMA_OPENMRS,
+                         Source.objects.get(id=source_no_validation.id).custom_validation_schema)
@@ -1,8 +1,51 @@
 from django.core.exceptions import ValidationError
 
+from concepts.validators import LookupValues
 from mappings.validation_messages import OPENMRS_SINGLE_MAPPING_BETWEEN_TWO_CONCEPTS, OPENMRS_INVALID_MAPTYPE
 from oclapi.models import LOOKUP_CONCEPT_CLASSES
 
+
+class MappingPairIndex(object):
+    """
+    The IDs of the active, non-retired mappings of a source by their (from_concept_id, to_concept_id) pair.
+    Importers attach it to the mappings they save as 'pair_index', so that the OpenMRS pair uniqueness check
+    is a lookup instead of a query per mapping.
+    """
+
+    def __init__(self, source):
+        from mappings.models import Mapping
+        self.source_id = source.id
+        self.pairs = {}
+        self.mapping_pairs = {}
+        values = Mapping.objects.filter(parent_id=source.id, is_active=True, retired=False).values(
+            'id', 'from_concept_id', 'to_concept_id')
+        for value in values:
+            self.add(value['id'], value['from_concept_id'], value['to_concept_id'])
+
+    def add(self, mapping_id, from_concept_id, to_concept_id):
+        key = (from_concept_id, to_concept_id)
+        self.pairs.setdefault(key, set()).add(mapping_id)
+        self.mapping_pairs[mapping_id] = key
+
+    def remove(self, mapping_id):
+        key = self.mapping_pairs.pop(mapping_id, None)
+        if key is not None:
+            ids = self.pairs[key]
+            ids.discard(mapping_id)
+            if not ids:
+                del self.pairs[key]
+
+    def update(self, mapping):
+        """ Moves the mapping to its current pair, or drops it if it is no longer active """
+        self.remove(mapping.id)
+        if mapping.id and mapping.is_active and not mapping.retired:
+            self.add(mapping.id, mapping.from_concept_id, mapping.to_concept_id)
+
+    def has_other_mapping(self, mapping):
+        ids = self.pairs.get((mapping.from_concept_id, mapping.to_concept_id), ())
+        return any(mapping_id != mapping.id for mapping_id in ids)
+
+
 class OpenMRSMappingValidator:
     def __init__(self, mapping):
         self.mapping = mapping
@@ -14,6 +57,12 @@ class OpenMRSMappingValidator:
     def pair_must_be_unique(self):
         from mappings.models import Mapping
 
+        pair_index = getattr(self.mapping, 'pair_index', None)
+        if pair_index is not None and pair_index.source_id == self.mapping.parent_id:
+            if pair_index.has_other_mapping(self.mapping):
+                raise ValidationError(OPENMRS_SINGLE_MAPPING_BETWEEN_TWO_CONCEPTS)
+            return
+
         intersection = Mapping.objects\
             .filter(parent=self.mapping.parent_source, from_concept=self.mapping.from_concept, to_concept=self.mapping.to_concept, is_active=True, retired=False)\
             .exclude(id=self.mapping.id)\
@@ -22,35 +71,13 @@ class OpenMRSMappingValidator:
         if intersection:
             raise ValidationError(OPENMRS_SINGLE_MAPPING_BETWEEN_TWO_CONCEPTS)
 
-    def map_type_should_be_valid_attribute(self, org):
-        is_data_type_valid = self.is_attribute_valid(self.mapping.map_type, org, 'MapTypes', 'MapType')
-
-        if not is_data_type_valid:
-            raise ValidationError({'map_type': [OPENMRS_INVALID_MAPTYPE]})
-
-    def is_attribute_valid(self, attribute_property, org, source_mnemonic, concept_class):
-        from sources.models import Source
-        from concepts.models import Concept
-
-        attributetypes_source_filter = Source.objects.filter(parent_id=org.id, mnemonic=source_mnemonic)
-
-        if attributetypes_source_filter.count() < 1:
+    def map_type_should_be_valid_attribute(self):
+        map_types = LookupValues.get('MapTypes')
+        if map_types is None:
             raise ValidationError({'non_field_errors': ['Lookup attributes must be imported']})
 
-        source_attributetypes = attributetypes_source_filter.values_list('id').get()
-
-        matching_attribute_types = {'retired': False, 'is_active': True, 'concept_class': concept_class,
-                                    'parent_id': source_attributetypes[0], 'names.name': attribute_property or 'None'}
-
-        return Concept.objects.raw_query(matching_attribute_types).count() > 0
+        if (self.mapping.map_type or 'None') not in map_types:
+            raise ValidationError({'map_type': [OPENMRS_INVALID_MAPTYPE]})
 
     def lookup_attributes_should_be_valid(self):
-        from orgs.models import Organization
-        ocl_org_filter = Organization.objects.filter(mnemonic='OCL')
-
-        if ocl_org_filter.count() < 1:
-            raise ValidationError({'non_field_errors': ['Lookup attributes must be imported']})
-
-        org = ocl_org_filter.get()
-
-        self.map_type_should_be_valid_attribute(org)
+        self.map_type_should_be_valid_attribute()
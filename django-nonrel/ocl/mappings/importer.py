@@ -2,11 +2,13 @@
 import json
 import logging
 from django.core.management import CommandError
-from django.db.models import Q
-from mappings.models import Mapping
-from concepts.models import Concept
+from mappings.custom_validators import MappingPairIndex
+from mappings.models import Mapping, MappingVersion
+from concepts.models import Concept, ConceptVersion
 from mappings.serializers import MappingCreateSerializer, MappingUpdateSerializer
-from oclapi.management.commands import MockRequest, ImportActionHelper
+from oclapi.management.commands import MockRequest, ImportActionHelper, ImportCheckpoint, ImportIndexUpdater
+from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
+from oclapi.utils import LRUCache
 from sources.models import Source, SourceVersion
 
 __author__ = 'misternando,paynejd'
@@ -26,11 +28,24 @@ class InvalidStateException(Exception):
 class MappingsImporter(object):
     """ Class to import mappings """
 
+    CONCEPT_IDS_CACHE_SIZE = 10000
+    CONCEPTS_CACHE_SIZE = 1000
+    SOURCES_CACHE_SIZE = 100
+    DEFAULT_CHUNK_SIZE = 100
+
     def __init__(self, source, mappings_file, output_stream, error_stream, user):
         """ Initialize mapping importer """
         self.source = source
-        self.sources_cache = {}
-        self.concepts_cache = {}
+        self.chunk_size = self.DEFAULT_CHUNK_SIZE
+        self.index_updater = None
+        self.concept_ids = {}
+        self.external_concept_ids = LRUCache(self.CONCEPT_IDS_CACHE_SIZE)
+        self.concepts_cache = LRUCache(self.CONCEPTS_CACHE_SIZE)
+        self.sources_cache = LRUCache(self.SOURCES_CACHE_SIZE)
+        self.mapping_hashes = {}
+        self.chunk_mapping_ids = {}
+        self.version_mapping_ids = set()
+        self.pair_index = None
         self.mappings_file = mappings_file
         self.stdout = output_stream
         self.stderr = error_stream
@@ -39,14 +54,46 @@ class MappingsImporter(object):
         self.test_mode = False
         self.action_count = {}
 
-    def import_mappings(self, new_version=False, total=0, test_mode=False, deactivate_old_records=False, **kwargs):
+    def import_mappings(self, new_version=False, total=0, test_mode=False, deactivate_old_records=False,
+                        chunk_size=None, checkpoint=None, resume=False, **kwargs):
+        """ Imports the mappings file, and reindexes the versions it saved if inline indexing is disabled """
+        checkpoint = None if test_mode else checkpoint
+
+        # Without inline indexing, only the versions saved by this import are reindexed at the end
+        if not test_mode and ImportIndexUpdater.is_needed():
+            self.index_updater = ImportIndexUpdater(MappingVersion, ConceptVersion)
+            self.index_updater.start()
+        try:
+            self.import_mappings_file(new_version, total, test_mode, deactivate_old_records, chunk_size, checkpoint,
+                                      resume)
+        finally:
+            if self.index_updater:
+                self.index_updater.stop()
+        if self.index_updater:
+            str_log = 'Updating the search index...\n'
+            self.stdout.write(str_log)
+            logger.info(str_log)
+            str_log = 'Updated %d versions in the search index.\n' % self.index_updater.update_index()
+            self.stdout.write(str_log)
+            logger.info(str_log)
+        if checkpoint:
+            checkpoint.clear()
+
+    def import_mappings_file(self, new_version, total, test_mode, deactivate_old_records, chunk_size, checkpoint,
+                             resume):
         """ Main mapping importer loop """
         logger.info('Import mappings to source...')
         self.test_mode = test_mode
+        self.chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
+        state = checkpoint.load() if checkpoint and resume else None
 
         # Retrieve latest source version and, if specified, create a new one
         self.source_version = SourceVersion.get_latest_version_of(self.source)
-        if new_version:
+        if state:
+            self.source_version = SourceVersion.objects.get(id=state['source_version_id'])
+            if self.index_updater:
+                self.index_updater.restore(state.get('touched_ids', {}))
+        elif new_version:
             try:
                 new_version = SourceVersion.for_base_object(
                     self.source, new_version, previous_version=self.source_version)
@@ -55,54 +102,82 @@ class MappingsImporter(object):
                 new_version.full_clean()
                 new_version.save()
                 self.source_version = new_version
+                if self.index_updater:
+                    # The members of the new source version have to be found by it
+                    self.index_updater.add(ConceptVersion, new_version.concepts)
+                    self.index_updater.add(MappingVersion, new_version.mappings)
             except Exception as exc:
                 raise CommandError('Failed to create new source version due to %s' % exc.args[0])
 
-        # Load the JSON file line by line and import each line
-        self.mapping_ids = set(self.source_version.mappings)
+        # Load the JSON file in chunks and import each line
+        self.version_mapping_ids = set(self.source_version.mappings)
+        self.mapping_ids = set(self.version_mapping_ids)
         self.count = 0
-        concepts_for_uris = Concept.objects.filter(parent_id=self.source.id)
-        self.concepts_cache = dict((x.uri, x) for x in concepts_for_uris)
-        for line in self.mappings_file:
-
-            # Load the next JSON line
-            self.count += 1
-            data = None
-            try:
-                data = json.loads(line)
-            except ValueError as exc:
-                str_log = 'Skipping invalid JSON line: %s. JSON: %s\n' % (exc.args[0], line)
-                self.stderr.write(str_log)
-                logger.warning(str_log)
-                self.count_action(ImportActionHelper.IMPORT_ACTION_SKIP)
-
-            # Process the import for the current JSON line
-            if data:
-                try:
-                    update_action = self.handle_mapping(data)
-                    self.count_action(update_action)
-                except IllegalInputException as exc:
-                    str_log = '%s, failed to parse line %s. Skipping it...\n' % (exc.args[0], data)
-                    self.stderr.write(str_log)
-                    logger.warning(str_log)
-                    self.count_action(ImportActionHelper.IMPORT_ACTION_SKIP)
-                except InvalidStateException as exc:
-                    str_log = 'Source is in an invalid state!\n%s\n%s\n' % (exc.args[0], data)
+        position = 0
+        if state:
+            # Continue after the lines that were handled before the last checkpoint
+            self.mapping_ids = set(state['remaining_ids'])
+            self.count = state['lines_handled']
+            self.action_count = state['action_count']
+            position = state['position']
+            ImportCheckpoint.skip_to(self.mappings_file, position)
+            str_log = 'Resuming import after line %d...\n' % self.count
+            self.stdout.write(str_log)
+            logger.info(str_log)
+        self.concept_ids = dict(Concept.objects.filter(parent_id=self.source.id).values_list('uri', 'id'))
+        latest_versions = MappingVersion.objects.values('versioned_object_id', 'content_hash').filter(
+            parent_id=self.source.id, is_latest_version=True)
+        self.mapping_hashes = dict((x['versioned_object_id'], x['content_hash']) for x in latest_versions)
+        if self.source.custom_validation_schema == CUSTOM_VALIDATION_SCHEMA_OPENMRS:
+            # Pair uniqueness is checked against the active mappings held in memory, kept current as lines are saved
+            self.pair_index = MappingPairIndex(self.source)
+        for chunk, position in self.read_chunks(position):
+            # Look up the existing mappings of all lines in the chunk at once
+            self.prefetch_chunk(chunk)
+            lines_before_chunk = self.count
+
+            for line, data, error in chunk:
+                self.count += 1
+                if error:
+                    str_log = 'Skipping invalid JSON line: %s. JSON: %s\n' % (error, line)
                     self.stderr.write(str_log)
                     logger.warning(str_log)
                     self.count_action(ImportActionHelper.IMPORT_ACTION_SKIP)
 
-            # Simple progress bars
-            if (self.count % 10) == 0:
-                str_log = ImportActionHelper.get_progress_descriptor(
-                    'mappings', self.count, total, self.action_count)
-                self.stdout.write(str_log, ending='\r')
-                self.stdout.flush()
-                if (self.count % 1000) == 0:
-                    logger.info(str_log)
+                # Process the import for the current JSON line
+                if data:
+                    try:
+                        update_action = self.handle_mapping(data)
+                        self.count_action(update_action)
+                    except IllegalInputException as exc:
+                        str_log = '%s, failed to parse line %s. Skipping it...\n' % (exc.args[0], data)
+                        self.stderr.write(str_log)
+                        logger.warning(str_log)
+                        self.count_action(ImportActionHelper.IMPORT_ACTION_SKIP)
+                    except InvalidStateException as exc:
+                        str_log = 'Source is in an invalid state!\n%s\n%s\n' % (exc.args[0], data)
+                        self.stderr.write(str_log)
+                        logger.warning(str_log)
+                        self.count_action(ImportActionHelper.IMPORT_ACTION_SKIP)
+
+                # Simple progress bars
+                if (self.count % 10) == 0:
+                    str_log = ImportActionHelper.get_progress_descriptor(
+                        'mappings', self.count,
+                        total or ImportActionHelper.get_total_estimate(self.mappings_file, self.count), self.action_count)
+                    self.stdout.write(str_log, ending='\r')
+                    self.stdout.flush()
+                    if (self.count % 1000) == 0:
+                        logger.info(str_log)
+
+            # Persist the progress, so that the import can be resumed from here
+            if checkpoint and checkpoint.is_due(lines_before_chunk, self.count):
+                checkpoint.save(self.source_version.id, position, self.count, self.action_count, self.mapping_ids,
+                                self.index_updater)
 
         # Done with the input file, so close it
         self.mappings_file.close()
+        total = total or self.count
 
         # Import complete - display final progress bar
         str_log = ImportActionHelper.get_progress_descriptor(
@@ -125,20 +200,13 @@ class MappingsImporter(object):
             str_log = 'Deactivating old mappings...\n'
             self.stdout.write(str_log)
             logger.info(str_log)
-            for mapping_id in self.mapping_ids:
-                try:
-                    if self.remove_mapping(mapping_id):
-                        self.count_action(ImportActionHelper.IMPORT_ACTION_DEACTIVATE)
-
-                        # Log the mapping deactivation
-                        str_log = 'Deactivated mapping: %s\n' % mapping_id
-                        self.stdout.write(str_log)
-                        logger.info(str_log)
+            for mapping_id in self.remove_mappings(self.mapping_ids):
+                self.count_action(ImportActionHelper.IMPORT_ACTION_DEACTIVATE)
 
-                except InvalidStateException as exc:
-                    str_log = 'Failed to inactivate mapping on ID %s! %s\n' % (mapping_id, exc.args[0])
-                    self.stderr.write(str_log)
-                    logger.warning(str_log)
+                # Log the mapping deactivation
+                str_log = 'Deactivated mapping: %s\n' % mapping_id
+                self.stdout.write(str_log)
+                logger.info(str_log)
         else:
             str_log = 'Skipping deactivation loop...\n'
             self.stdout.write(str_log)
@@ -153,55 +221,71 @@ class MappingsImporter(object):
         self.stdout.write(str_log, ending='\r')
         logger.info(str_log)
 
+    def read_chunks(self, position=0):
+        """
+        Yields the lines of the input file in lists of (line, parsed JSON, parse error) of chunk_size,
+        along with the position in the file after the chunk
+        """
+        chunk = []
+        for line in self.mappings_file:
+            position += len(line)
+            data, error = None, None
+            try:
+                data = json.loads(line)
+            except ValueError as exc:
+                error = exc.args[0]
+            chunk.append((line, data, error))
+            if len(chunk) >= self.chunk_size:
+                yield chunk, position
+                chunk = []
+        if chunk:
+            yield chunk, position
+
+    def prefetch_chunk(self, chunk):
+        """ Loads the unique keys of the existing mappings from all concepts in the chunk with a single query """
+        from_concept_ids = set()
+        for _, data, _ in chunk:
+            try:
+                from_concept_ids.add(self.get_concept_id(data['from_concept_url']))
+            except (IllegalInputException, KeyError, TypeError):
+                # Reported when the line itself is handled
+                pass
+        self.chunk_mapping_ids = {}
+        if not from_concept_ids:
+            return
+        mappings = Mapping.objects.filter(
+            parent_id=self.source.id, from_concept_id__in=list(from_concept_ids)).values(
+            'id', 'map_type', 'from_concept_id', 'to_concept_id', 'to_source_id', 'to_concept_code', 'to_concept_name')
+        for mapping in mappings:
+            self.chunk_mapping_ids[self.mapping_key(**mapping)] = mapping['id']
+
+    @staticmethod
+    def mapping_key(map_type=None, from_concept_id=None, to_concept_id=None, to_source_id=None,
+                    to_concept_code=None, to_concept_name=None, **kwargs):
+        """ Key by which a mapping is unique within a source: internal mappings by their target concept only """
+        if to_concept_id:
+            return map_type, from_concept_id, to_concept_id
+        return map_type, from_concept_id, None, to_source_id, to_concept_code, to_concept_name
+
     def handle_mapping(self, data):
         """ Handle importing of a single mapping """
         update_action = ImportActionHelper.IMPORT_ACTION_NONE
 
-        # If mapping exists, update the mapping with the new data
-        try:
-            from_concept = self.get_concept(data['from_concept_url'])
-            data['from_concept'] = from_concept
-            query = Q(parent_id=self.source.id, map_type=data['map_type'],
-                      from_concept_id=from_concept.id)
-            if data.get('to_concept_url'):  # Internal mapping
-                to_concept = self.get_concept(data['to_concept_url'])
-                data['to_concept'] = to_concept
-                query = query & Q(to_concept_id=to_concept.id)
-            else:   # External mapping
-                to_source = self.get_source(data['to_source_url'])
-                data['to_source'] = to_source
-                query = query & Q(to_source_id=to_source.id,
-                                  to_concept_code=data['to_concept_code'],
-                                  to_concept_name=data.get('to_concept_name'))
-
-            # Perform the query - throws exception if does not exist
-            mapping = Mapping.objects.get(query)
-
-            # Mapping exists, but not in this source version
-            if mapping.id not in self.source_version.mappings:
-                raise InvalidStateException(
-                    "Source %s has mapping %s, but source version %s does not. Mapping not updated." %
-                    (self.source.mnemonic, mapping.id, self.source_version.mnemonic))
-
-            # Finish updating the mapping
-            update_action = self.update_mapping(mapping, data)
-
-            # Remove ID from the mapping list so that we know that mapping has been handled
-            try:
-                self.mapping_ids.remove(mapping.id)
-            except KeyError:
-                str_log = 'Key not found. Could not remove key %s from list of mapping IDs: %s\n' % (mapping.id, data)
-                self.stderr.write(str_log)
-                logger.warning(str_log)
-
-            # Log the update
-            if update_action:
-                str_log = 'Updated mapping with ID %s: %s\n' % (mapping.id, data)
-                self.stdout.write(str_log)
-                logger.info(str_log)
+        # Resolve the IDs of the concepts and source the mapping refers to
+        from_concept_id = self.get_concept_id(data['from_concept_url'])
+        to_concept_id = to_source_id = None
+        if data.get('to_concept_url'):  # Internal mapping
+            to_concept_id = self.get_concept_id(data['to_concept_url'])
+        else:   # External mapping
+            data['to_source'] = self.get_source(data['to_source_url'])
+            to_source_id = data['to_source'].id
+        mapping_id = self.chunk_mapping_ids.get(self.mapping_key(
+            data['map_type'], from_concept_id, to_concept_id, to_source_id,
+            data.get('to_concept_code'), data.get('to_concept_name')))
 
         # Mapping does not exist, so create new one
-        except Mapping.DoesNotExist:
+        if mapping_id is None:
+            self.resolve_concepts(data, from_concept_id, to_concept_id)
             update_action = self.add_mapping(data)
 
             # Log the insert
@@ -209,15 +293,50 @@ class MappingsImporter(object):
                 str_log = 'Created new mapping: to - %s\n' % (data.get('to_concept_url') or (data.get('to_source_url') + ':' + data.get('to_concept_code')))
                 self.stdout.write(str_log)
                 logger.info(str_log)
+            return update_action
+
+        # Mapping exists, but not in this source version
+        if mapping_id not in self.version_mapping_ids:
+            raise InvalidStateException(
+                "Source %s has mapping %s, but source version %s does not. Mapping not updated." %
+                (self.source.mnemonic, mapping_id, self.source_version.mnemonic))
+
+        # If mapping exists, update the mapping with the new data, unless its latest version already has the same content
+        if not self.is_unchanged(mapping_id, data, from_concept_id, to_concept_id, to_source_id):
+            self.resolve_concepts(data, from_concept_id, to_concept_id)
+            update_action = self.update_mapping(Mapping.objects.get(id=mapping_id), data)
+            if update_action:
+                self.mapping_hashes.pop(mapping_id, None)
+
+        # Remove ID from the mapping list so that we know that mapping has been handled
+        try:
+            self.mapping_ids.remove(mapping_id)
+        except KeyError:
+            str_log = 'Key not found. Could not remove key %s from list of mapping IDs: %s\n' % (mapping_id, data)
+            self.stderr.write(str_log)
+            logger.warning(str_log)
+
+        # Log the update
+        if update_action:
+            str_log = 'Updated mapping with ID %s: %s\n' % (mapping_id, data)
+            self.stdout.write(str_log)
+            logger.info(str_log)
 
         # Return the action performed
         return update_action
 
+    def resolve_concepts(self, data, from_concept_id, to_concept_id):
+        """ Loads the concepts of the mapping, which are only needed when it is added or updated """
+        data['from_concept'] = self.get_concept(from_concept_id)
+        if to_concept_id:
+            data['to_concept'] = self.get_concept(to_concept_id)
+
     def add_mapping(self, data):
         """ Create a new mapping """
 
         # Create the new mapping
         mapping = Mapping(**data)
+        mapping.pair_index = self.pair_index
         kwargs = {'parent_resource': self.source}
         if self.test_mode:
             mapping.save=lambda x: None
@@ -227,6 +346,15 @@ class MappingsImporter(object):
             raise IllegalInputException(
                 'Could not persist new mapping due to %s' % errors)
 
+        # Later lines of the same chunk have to find the new mapping
+        if mapping.id:
+            self.chunk_mapping_ids[self.mapping_key(
+                mapping.map_type, mapping.from_concept_id, mapping.to_concept_id, mapping.to_source_id,
+                mapping.to_concept_code, mapping.to_concept_name)] = mapping.id
+            self.version_mapping_ids.add(mapping.id)
+            if self.pair_index:
+                self.pair_index.update(mapping)
+
         return ImportActionHelper.IMPORT_ACTION_ADD
 
     def update_mapping(self, mapping, data):
@@ -237,6 +365,7 @@ class MappingsImporter(object):
         if 'retired' in data and mapping.retired != data['retired']:
             diffs['retired'] = {'was': mapping.retired, 'is': data['retired']}
         original = mapping.clone(self.user)
+        mapping.pair_index = self.pair_index
         serializer = MappingUpdateSerializer(
             mapping, data=data, context={'request': MockRequest(self.user)})
         if not serializer.is_valid():
@@ -256,26 +385,33 @@ class MappingsImporter(object):
                     raise IllegalInputException(
                         'Could not persist update to mapping %s due to %s' %
                         (mapping.id, serializer.errors))
+                if self.pair_index:
+                    self.pair_index.update(mapping)
 
             return ImportActionHelper.IMPORT_ACTION_UPDATE
 
         # No diff, so do nothing
         return ImportActionHelper.IMPORT_ACTION_NONE
 
-    def remove_mapping(self, mapping_id):
-        """ Deactivates a mapping """
-        try:
-            mapping = Mapping.objects.get(id=mapping_id)
-            if mapping.is_active:
-                if not self.test_mode:
-                    mapping.is_active = False
-                    mapping.save()
-                return ImportActionHelper.IMPORT_ACTION_DEACTIVATE
-            else:
-                return ImportActionHelper.IMPORT_ACTION_NONE
-        except:
-            raise InvalidStateException(
-                "Cannot deactivate mapping %s because it doesn't exist!" % mapping_id)
+    def is_unchanged(self, mapping_id, data, from_concept_id, to_concept_id, to_source_id):
+        """ Compares the content hash of the latest mapping version with the (already resolved) input data """
+        stored_hash = self.mapping_hashes.get(mapping_id)
+        if not stored_hash:
+            return False
+        return stored_hash == MappingVersion.content_digest_of(
+            data.get('map_type'), from_concept_id, to_concept_id, to_source_id,
+            data.get('to_concept_code'), data.get('to_concept_name'), data.get('retired', False),
+            data.get('external_id'), data.get('extras'))
+
+    def remove_mappings(self, mapping_ids):
+        """ Deactivates the active mappings among the IDs with one update, and returns their IDs """
+        if self.test_mode:
+            return list(Mapping.objects.filter(id__in=list(mapping_ids), is_active=True).values_list('id', flat=True))
+        mapping_ids = Mapping.deactivate_in_bulk(mapping_ids)
+        if self.pair_index:
+            for mapping_id in mapping_ids:
+                self.pair_index.remove(mapping_id)
+        return mapping_ids
 
     def count_action(self, update_action):
         """ Increments the counter for the specified action """
@@ -283,15 +419,31 @@ class MappingsImporter(object):
             self.action_count[update_action] += 1
         else:
             self.action_count[update_action] = 1
-    def get_concept(self, concept_url):
-        result = self.concepts_cache.get(concept_url)
+
+    def get_concept_id(self, concept_url):
+        """ Resolves a concept URL to its ID; concepts of other sources are looked up through a bounded cache """
+        result = self.concept_ids.get(concept_url) or self.external_concept_ids.get(concept_url)
+        if not result:
+            ids = list(Concept.objects.filter(uri=concept_url).values_list('id', flat=True)[:1])
+            if not ids:
+                raise IllegalInputException('Concept %s does not exist' % concept_url)
+            result = ids[0]
+            self.external_concept_ids.set(concept_url, result)
+        return result
+
+    def get_concept(self, concept_id):
+        result = self.concepts_cache.get(concept_id)
         if not result:
-            result = Concept.objects.get(uri=concept_url)
-            self.concepts_cache[concept_url] = result
+            result = Concept.objects.get(id=concept_id)
+            self.concepts_cache.set(concept_id, result)
         return result
+
     def get_source(self, source_url):
         result = self.sources_cache.get(source_url)
         if not result:
-            result = Source.objects.get(uri=source_url)
-            self.sources_cache[source_url] = result
-        return result
\ No newline at end of file
+            try:
+                result = Source.objects.get(uri=source_url)
+            except Source.DoesNotExist:
+                raise IllegalInputException('Source %s does not exist' % source_url)
+            self.sources_cache.set(source_url, result)
+        return result
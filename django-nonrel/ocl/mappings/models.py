@@ -1,13 +1,18 @@
+from datetime import datetime
+
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models import get_model
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 
 from concepts.models import Concept
+from mappings.custom_validators import MappingPairIndex
 from mappings.mixins import MappingValidationMixin
-from oclapi.models import BaseModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, ResourceVersionModel
+from oclapi.models import BaseModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, ResourceVersionModel, VersionMembership, \
+    CUSTOM_VALIDATION_SCHEMA_OPENMRS
+from oclapi.utils import content_digest
 from sources.models import Source, SourceVersion
 
 MAPPING_RESOURCE_TYPE = 'Mapping'
@@ -185,6 +190,68 @@ class Mapping(MappingValidationMixin, BaseModel):
             mapping.save()
         return errors
 
+    @classmethod
+    def change_retired_in_bulk(cls, mappings, retired, user, update_comment=None, parent_resource_version=None):
+        """
+        Retires or un-retires mappings of one source, creating their new versions in bulk instead of calling
+        persist_clone for each mapping. Mappings that already have the retired status are left alone, and the ones
+        whose un-retired version fails validation are left out while the others are persisted.
+        Returns the new versions and the errors, by mapping ID or, if nothing could be persisted, as non_field_errors.
+        """
+        mappings = [mapping for mapping in mappings if mapping.retired != retired]
+        if not mappings:
+            return [], dict()
+        source = mappings[0].parent
+        if parent_resource_version is None:
+            parent_resource_version = SourceVersion.get_head_of(source)
+        mapping_ids = [mapping.id for mapping in mappings]
+
+        clones = []
+        errors = dict()
+        # Un-retired mappings must not pair the same concepts as the other mappings, including the ones un-retired here
+        pair_index = None
+        if not retired and source.custom_validation_schema == CUSTOM_VALIDATION_SCHEMA_OPENMRS:
+            pair_index = MappingPairIndex(source)
+        for latest_version in MappingVersion.objects.filter(versioned_object_id__in=mapping_ids, is_latest_version=True):
+            clone = latest_version.clone()
+            clone.retired = retired
+            clone.update_comment = update_comment or ('Mapping was retired' if retired else 'Mapping was un-retired')
+            clones.append(clone)
+
+            if not retired:
+                clone.pair_index = pair_index
+                try:
+                    # The users and the mnemonic are stamped when the clones are persisted
+                    clone.full_clean(exclude=['created_by', 'updated_by', 'mnemonic'])
+                except ValidationError as err:
+                    errors[clone.versioned_object_id] = err.messages
+                    continue
+                if pair_index:
+                    pair_index.add(clone.versioned_object_id, clone.from_concept_id, clone.to_concept_id)
+        if errors:
+            clones = [clone for clone in clones if clone.versioned_object_id not in errors]
+            mapping_ids = [clone.versioned_object_id for clone in clones]
+            mappings = [mapping for mapping in mappings if mapping.id not in errors]
+        if not clones:
+            return [], errors
+        persist_errors = MappingVersion.persist_clones_in_bulk(clones, user, parent_resource_version, 'mappings')
+        if persist_errors:
+            return [], persist_errors
+
+        cls.objects.filter(id__in=mapping_ids).update(retired=retired, updated_by=user.username,
+                                                      updated_at=datetime.now())
+        for mapping in mappings:
+            mapping.retired = retired
+        return clones, errors
+
+    @classmethod
+    def deactivate_in_bulk(cls, mapping_ids):
+        """ Deactivates the active mappings among the IDs with one update, and returns their IDs """
+        mapping_ids = list(cls.objects.filter(id__in=list(mapping_ids), is_active=True).values_list('id', flat=True))
+        if mapping_ids:
+            cls.objects.filter(id__in=mapping_ids).update(is_active=False)
+        return mapping_ids
+
 
     @staticmethod
     def get_version_model():
@@ -271,11 +338,11 @@ class Mapping(MappingValidationMixin, BaseModel):
         if parent_resource_version is None:
             parent_resource_version = parent_resource.get_version_model().get_head_of(parent_resource)
         child_list_attribute = kwargs.pop('mapping_list_attribute', 'mappings')
-        initial_parent_children = getattr(parent_resource_version, child_list_attribute) or []
 
         errored_action = 'saving mapping'
         persisted = False
         initial_version=None
+        member_added = False
         try:
             obj.save(**kwargs)
             #mapping version save start
@@ -287,10 +354,8 @@ class Mapping(MappingValidationMixin, BaseModel):
             # mapping version save end
             # Add the mapping to its parent source version
             errored_action = 'associating mapping with parent resource'
-            parent_children = getattr(parent_resource_version, child_list_attribute) or []
-            parent_children.append(initial_version.id)
-            setattr(parent_resource_version, child_list_attribute, parent_children)
-            parent_resource_version.save()
+            parent_resource_version.add_members(child_list_attribute, [initial_version.id])
+            member_added = True
 
             # Save the mapping again to trigger the Solr update
             errored_action = 'saving mapping to trigger Solr update'
@@ -299,8 +364,8 @@ class Mapping(MappingValidationMixin, BaseModel):
         finally:
             if not persisted:
                 errors['non_field_errors'] = ['An error occurred while %s.' % errored_action]
-                setattr(parent_resource_version, child_list_attribute, initial_parent_children)
-                parent_resource_version.save()
+                if member_added:
+                    parent_resource_version.remove_members(child_list_attribute, [initial_version.id])
                 if obj.id:
                     obj.delete()
                 if initial_version and initial_version.id:
@@ -355,6 +420,7 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
     external_id = models.TextField(null=True, blank=True)
     is_latest_version = models.BooleanField(default=True)
     update_comment = models.TextField(null=True, blank=True)
+    content_hash = models.TextField(null=True, blank=True)
 
     def clone(self):
         return MappingVersion(
@@ -379,6 +445,30 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
     class Meta:
         pass
 
+    @classmethod
+    def mnemonic_of_clone(cls, clone):
+        return int(clone.previous_version.mnemonic) + 1
+
+    def get_content_hash(self):
+        return self.content_digest_of(
+            self.map_type, self.from_concept_id, self.to_concept_id, self.to_source_id, self.to_concept_code,
+            self.to_concept_name, self.retired, self.external_id, self.extras)
+
+    @classmethod
+    def content_digest_of(cls, map_type, from_concept_id, to_concept_id, to_source_id, to_concept_code,
+                          to_concept_name, retired, external_id, extras):
+        return content_digest({
+            'map_type': map_type,
+            'from_concept_id': from_concept_id,
+            'to_concept_id': to_concept_id,
+            'to_source_id': to_source_id,
+            'to_concept_code': to_concept_code,
+            'to_concept_name': to_concept_name,
+            'retired': retired,
+            'external_id': external_id,
+            'extras': extras or {},
+        })
+
     @property
     def source(self):
         return self.parent.mnemonic
@@ -495,7 +585,8 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
 
     @property
     def collection_versions(self):
-        return get_model('collection', 'CollectionVersion').objects.filter(mappings=self.id)
+        return get_model('collection', 'CollectionVersion').objects.filter(
+            id__in=VersionMembership.container_version_ids('mappings', [self.id]))
 
     @staticmethod
     def get_url_kwarg():
@@ -572,6 +663,11 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
         return errors
 
 
+@receiver(pre_save, sender=MappingVersion)
+def set_content_hash(sender, instance=None, **kwargs):
+    instance.content_hash = instance.get_content_hash()
+
+
 @receiver(post_save, sender=Source)
 def propagate_parent_attributes(sender, instance=None, created=False, **kwargs):
     if created:
@@ -1,13 +1,14 @@
 from haystack import indexes
 from mappings.models import Mapping, MappingVersion
-from oclapi.search_backends import SortOrFilterField, FilterField
+from mappings.serializers import MappingVersionListSerializer, PAYLOAD_REFERENCES_KEY
+from oclapi.search_backends import SortOrFilterField, FilterField, StoredPayloadField
 from oclapi.search_indexes import OCLSearchIndex
-from sources.models import SourceVersion
 from django.db.models import get_model
 
 __author__ = 'misternando'
 
 class MappingVersionIndex(OCLSearchIndex, indexes.Indexable):
+    membership_attribute = 'mappings'
     text = indexes.CharField(document=True, use_template=True)
     external_id = SortOrFilterField(model_attr='external_id', indexed=True, stored=True, null=True)
     lastUpdate = indexes.DateTimeField(model_attr='updated_at', indexed=True, stored=True)
@@ -34,6 +35,7 @@ class MappingVersionIndex(OCLSearchIndex, indexes.Indexable):
     public_can_view = indexes.BooleanField(model_attr='public_can_view', indexed=True, stored=True)
     is_active = indexes.BooleanField(model_attr='is_active', indexed=True, stored=True)
     is_latest_version = indexes.BooleanField(model_attr='is_latest_version', indexed=True, stored=True)
+    list_payload = StoredPayloadField()
 
     def get_model(self):
         return MappingVersion
@@ -53,22 +55,34 @@ class MappingVersionIndex(OCLSearchIndex, indexes.Indexable):
         self.prepared_data['toConceptOwnerType'] = obj.to_source_owner_type
         self.prepared_data['conceptOwnerType'] = [obj.from_source_owner_type, obj.to_source_owner_type]
 
-        source_version_ids = []
-        source = obj.parent
-        source_versions = SourceVersion.objects.filter(
-            versioned_object_id=source.id,
-        )
-        for sv in source_versions:
-            if obj.id in sv.mappings:
-                source_version_ids.append(sv.id)
-        self.prepared_data['source_version'] = source_version_ids
+        self.prepared_data['source_version'] = self.get_membership_map(obj).source_versions_of(obj)
 
         return self.prepared_data
 
 
     def prepare_collection_version(self, obj):
-        return obj.collection_version_ids
+        return self.get_membership_map(obj).collection_versions_of(obj)
+
+
+    def prepare_list_payload(self, obj):
+        # MappingVersionStoredListSerializer fills in the names of the referenced concepts, sources and owners
+        excluded_fields = ['source', 'owner', 'from_concept_name', 'from_source_name', 'from_source_owner',
+                           'to_source_name', 'to_source_owner']
+        to_concept_id = None
+        if obj.to_concept_id and not obj.to_concept_name:
+            excluded_fields.append('to_concept_name')
+            to_concept_id = obj.to_concept_id
+        to_source_id = obj.to_source_id or (obj.to_concept.parent_id if obj.to_concept_id else None)
+        references = {
+            'source': obj.parent_id,
+            'from_concept': obj.from_concept_id,
+            'from_source': obj.from_concept.parent_id,
+            'to_concept': to_concept_id,
+            'to_source': to_source_id,
+        }
+        return self.serialize_payload(obj, MappingVersionListSerializer, excluded_fields,
+                                      {PAYLOAD_REFERENCES_KEY: references})
 
 
     def prepare_collection(self, obj):
-        return obj.collection_ids
\ No newline at end of file
+        return self.get_membership_map(obj).collections_of(obj)
\ No newline at end of file
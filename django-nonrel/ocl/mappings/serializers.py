@@ -2,10 +2,14 @@ from rest_framework import serializers
 from concepts.fields import ConceptURLField, SourceURLField
 from concepts.models import Concept
 from mappings.models import Mapping, MappingVersion
-from oclapi.serializers import ResourceVersionSerializer
+from oclapi.serializers import ResourceVersionSerializer, StoredPayloadSerializer
+from sources.models import Source
 
 __author__ = 'misternando'
 
+# Key of the stored list payload holding the ids of the concepts and sources whose names are looked up when serving it
+PAYLOAD_REFERENCES_KEY = 'references'
+
 
 class MappingBaseSerializer(serializers.Serializer):
 
@@ -185,6 +189,37 @@ class MappingVersionListSerializer(ResourceVersionSerializer):
         return obj.url
 
 
+class MappingVersionStoredListSerializer(StoredPayloadSerializer):
+    """
+    Concepts, sources and owners can be renamed without their mappings being reindexed, so their names are not
+    stored in the payload, but read for all the mappings of a response at once.
+    """
+    fallback_serializer_class = MappingVersionListSerializer
+
+    def complete_payloads(self, payloads):
+        # Payloads indexed before the references were stored still carry the names
+        payloads = [payload for payload in payloads if PAYLOAD_REFERENCES_KEY in payload]
+        if not payloads:
+            return
+        references = [payload.pop(PAYLOAD_REFERENCES_KEY) for payload in payloads]
+        concept_ids = set(reference[key] for reference in references for key in ['from_concept', 'to_concept'])
+        source_ids = set(reference[key] for reference in references for key in ['source', 'from_source', 'to_source'])
+        concept_names = dict((concept.id, concept.display_name)
+                             for concept in Concept.objects.filter(id__in=[id for id in concept_ids if id]))
+        source_names = dict((source.id, (source.mnemonic, source.owner_name))
+                            for source in Source.objects.filter(id__in=[id for id in source_ids if id]))
+
+        for payload, reference in zip(payloads, references):
+            payload['from_concept_name'] = concept_names.get(reference['from_concept'])
+            # Mappings to concepts outside of OCL keep the name they were created with
+            if reference['to_concept']:
+                payload['to_concept_name'] = concept_names.get(reference['to_concept'])
+            payload['source'], payload['owner'] = source_names.get(reference['source'], (None, None))
+            payload['from_source_name'], payload['from_source_owner'] = source_names.get(reference['from_source'],
+                                                                                         (None, None))
+            payload['to_source_name'], payload['to_source_owner'] = source_names.get(reference['to_source'],
+                                                                                     (None, None))
+
 
 class MappingCreateSerializer(MappingBaseSerializer):
     map_type = serializers.CharField(required=True)
@@ -4,6 +4,7 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import json
 from unittest import skip
 from urlparse import urlparse
 
@@ -14,6 +15,9 @@ from django.test import Client
 from django.test.client import MULTIPART_CONTENT, FakePayload
 from django.utils.encoding import force_str
 
+from mappings.custom_validators import MappingPairIndex
+from mappings.search_indexes import MappingVersionIndex
+from mappings.serializers import MappingVersionStoredListSerializer, PAYLOAD_REFERENCES_KEY
 from mappings.validation_messages import OPENMRS_SINGLE_MAPPING_BETWEEN_TWO_CONCEPTS, OPENMRS_INVALID_MAPTYPE
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
 from oclapi.utils import add_user_to_org
@@ -661,6 +665,34 @@ class MappingVersionTest(MappingVersionBaseTest):
         self.assertEquals(mapping_version.collection_version_ids[1],
                           CollectionVersion.objects.get(mnemonic='version1').id)
 
+    def test_stored_list_payload_should_serve_current_concept_names(self):
+        mapping_version = MappingVersion(
+            created_by=self.user1,
+            updated_by=self.user1,
+            parent=self.source1,
+            map_type='Same As',
+            from_concept=self.concept1,
+            to_concept=self.concept2,
+            external_id='mappingversion1',
+            versioned_object_id=self.mapping1.id,
+            mnemonic='tempid',
+            versioned_object_type=ContentType.objects.get_for_model(Mapping),
+        )
+        mapping_version.full_clean()
+        mapping_version.save()
+        payload = json.loads(MappingVersionIndex().prepare_list_payload(mapping_version))
+        self.assertFalse('from_concept_name' in payload)
+
+        self.concept1.names = [LocalizedText(name='Renamed', locale='en', type='FULLY_SPECIFIED')]
+        self.concept1.save()
+        data = MappingVersionStoredListSerializer([payload], many=True).data
+
+        self.assertEquals('Renamed', data[0]['from_concept_name'])
+        self.assertEquals('Fred', data[0]['to_concept_name'])
+        self.assertEquals(self.source1.mnemonic, data[0]['source'])
+        self.assertEquals(self.source1.owner_name, data[0]['to_source_owner'])
+        self.assertFalse(PAYLOAD_REFERENCES_KEY in data[0])
+
 
 class MappingClassMethodsTest(MappingBaseTest):
 
@@ -1104,3 +1136,60 @@ class OpenMRSMappingValidationTest(MappingBaseTest):
         errors = Mapping.persist_changes(mapping, user)
 
         self.assertEqual(len(errors), 0)
+
+    def test_pair_index_should_check_uniqueness_without_querying_mappings(self):
+        user = create_user()
+
+        source = create_source(user, validation_schema=CUSTOM_VALIDATION_SCHEMA_OPENMRS)
+        (concept1, _) = create_concept(user, source)
+        (concept2, _) = create_concept(user, source)
+        (concept3, _) = create_concept(user, source)
+
+        existing = create_mapping(user, source, concept1, concept2, "Same As")
+        pair_index = MappingPairIndex(source)
+        self.assertTrue(pair_index.has_other_mapping(Mapping(parent=source, from_concept=concept1, to_concept=concept2)))
+        self.assertFalse(pair_index.has_other_mapping(existing))
+
+        mapping = Mapping(
+            created_by=user,
+            updated_by=user,
+            parent=source,
+            map_type='Is Subset of',
+            from_concept=concept1,
+            to_concept=concept2,
+            public_access=ACCESS_TYPE_VIEW,
+        )
+        mapping.pair_index = pair_index
+        errors = Mapping.persist_new(mapping, user, parent_resource=source)
+        self.assertTrue(OPENMRS_SINGLE_MAPPING_BETWEEN_TWO_CONCEPTS in errors["__all__"])
+
+        existing.to_concept = concept3
+        pair_index.update(existing)
+        mapping.pair_index = pair_index
+        errors = Mapping.persist_new(mapping, user, parent_resource=source)
+        self.assertEqual(len(errors), 0)
+        pair_index.update(mapping)
+
+        mapping.retired = True
+        pair_index.update(mapping)
+        self.assertFalse(pair_index.has_other_mapping(Mapping(parent=source, from_concept=concept1, to_concept=concept2)))
+
+    def test_unretire_in_bulk_should_leave_out_mappings_whose_pair_is_taken(self):
+        user = create_user()
+
+        source = create_source(user, validation_schema=CUSTOM_VALIDATION_SCHEMA_OPENMRS)
+        (concept1, _) = create_concept(user, source)
+        (concept2, _) = create_concept(user, source)
+        (concept3, _) = create_concept(user, source)
+
+        clashing = create_mapping(user, source, concept1, concept2, "Same As")
+        other = create_mapping(user, source, concept1, concept3, "Same As")
+        Mapping.change_retired_in_bulk([clashing, other], True, user)
+        create_mapping(user, source, concept1, concept2, "Same As")
+
+        (versions, errors) = Mapping.change_retired_in_bulk([clashing, other], False, user)
+
+        self.assertEquals([version.versioned_object_id for version in versions], [other.id])
+        self.assertTrue(OPENMRS_SINGLE_MAPPING_BETWEEN_TWO_CONCEPTS in errors[clashing.id])
+        self.assertTrue(Mapping.objects.get(id=clashing.id).retired)
+        self.assertFalse(Mapping.objects.get(id=other.id).retired)
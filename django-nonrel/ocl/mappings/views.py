@@ -8,9 +8,10 @@ from concepts.permissions import CanEditParentDictionary, CanViewParentDictionar
 from mappings.filters import PublicMappingsSearchFilter, SourceRestrictedMappingsFilter, CollectionRestrictedMappingFilter
 from mappings.models import Mapping, MappingVersion
 from mappings.serializers import MappingCreateSerializer, MappingUpdateSerializer, MappingDetailSerializer, MappingListSerializer, \
-    MappingVersionDetailSerializer, MappingVersionListSerializer
+    MappingVersionDetailSerializer, MappingVersionListSerializer, MappingVersionStoredListSerializer
 from oclapi.mixins import ListWithHeadersMixin
 from oclapi.models import ACCESS_TYPE_NONE
+from oclapi.search_indexes import LIST_PAYLOAD_FIELD
 from oclapi.views import ConceptDictionaryMixin, BaseAPIView, parse_updated_since_param, VersionedResourceChildMixin
 from sources.models import SourceVersion
 from orgs.models import Organization
@@ -177,6 +178,9 @@ class MappingVersionsListView(MappingVersionMixin, VersionedResourceChildMixin,
         self.filter_backends = [CollectionRestrictedMappingFilter] if 'collection' in kwargs else [SourceRestrictedMappingsFilter]
         self.include_retired = request.QUERY_PARAMS.get(INCLUDE_RETIRED_PARAM, False)
         self.updated_since = parse_updated_since_param(request)
+        if not request.QUERY_PARAMS.get('csv'):
+            self.search_payload_field = LIST_PAYLOAD_FIELD
+            self.serializer_class = MappingVersionStoredListSerializer
         return self.list(request, *args, **kwargs)
 
     def get_queryset(self):
@@ -304,7 +308,13 @@ class MappingListAllView(BaseAPIView, ListWithHeadersMixin, MappingVersionCsvMix
 
     def get(self, request, *args, **kwargs):
         self.include_retired = request.QUERY_PARAMS.get(INCLUDE_RETIRED_PARAM, False)
-        self.serializer_class = MappingVersionDetailSerializer if self.is_verbose(request) else MappingVersionListSerializer
+        if self.is_verbose(request):
+            self.serializer_class = MappingVersionDetailSerializer
+        elif request.QUERY_PARAMS.get('csv'):
+            self.serializer_class = MappingVersionListSerializer
+        else:
+            self.search_payload_field = LIST_PAYLOAD_FIELD
+            self.serializer_class = MappingVersionStoredListSerializer
         self.limit = request.QUERY_PARAMS.get(LIMIT_PARAM, 25)
         return self.list(request, *args, **kwargs)
 
@@ -5,26 +5,38 @@ from rest_framework.filters import BaseFilterBackend
 
 
 class SearchQuerySetWrapper(object):
+    """
+    Hands out the objects of search results. With a payload field, results hand out the representation stored in
+    that field instead, and only results indexed without it are loaded from the database.
+    """
 
-    def __init__(self, sqs, limit_iter=True):
+    def __init__(self, sqs, limit_iter=True, payload_field=None):
         self.sqs = sqs
         self.sqs._fill_cache(0, settings.HAYSTACK_ITERATOR_LOAD_PER_QUERY or 25)
         self.limit_iter = limit_iter
+        self.payload_field = payload_field
         self.facets = sqs.facet_counts()
 
     def __len__(self):
         return len(self.sqs)
 
+    def _item(self, result):
+        if self.payload_field:
+            payload = getattr(result, self.payload_field, None)
+            if payload is not None:
+                return payload
+        return result.object
+
     def __getitem__(self, item):
         result = self.sqs.__getitem__(item)
         if isinstance(result, list):
-            return [r.object for r in result]
-        return result.object
+            return [self._item(r) for r in result]
+        return self._item(result)
 
     def __iter__(self):
         iteration = self.sqs[0:10] if self.limit_iter else self.sqs
         for result in iteration:
-            yield result.object
+            yield self._item(result)
 
 
 class BaseHaystackSearchFilter(BaseFilterBackend):
@@ -129,7 +141,7 @@ class BaseHaystackSearchFilter(BaseFilterBackend):
             sqs = sqs.models(view.model)
             if hasattr(sqs, 'load_all_queryset'):
                 sqs = sqs.load_all_queryset(view.model, queryset)
-            return SearchQuerySetWrapper(sqs)
+            return SearchQuerySetWrapper(sqs, payload_field=getattr(view, 'search_payload_field', None))
 
         if hasattr(view, 'default_order_by'):
             queryset = queryset.order_by(view.default_order_by)
@@ -1,11 +1,16 @@
 from optparse import make_option
+import bz2
+import gzip
+import json
 import logging
 import os
 from django.core.management import BaseCommand, CommandError
+from django.db.models.signals import post_save
 import haystack
 from haystack.signals import BaseSignalProcessor
 from rest_framework.authtoken.models import Token
 from oclapi.permissions import HasPrivateAccess
+from oclapi.utils import update_all_in_index
 from sources.models import Source
 from cProfile import Profile
 
@@ -60,6 +65,11 @@ class ImportActionHelper(object):
                 combined_action_value -= individual_action_value
         return combined_action_text
 
+    @classmethod
+    def get_action_counts(cls, action_count):
+        """ Returns the action counts keyed by the names of the actions """
+        return dict((cls.get_action_string(action_value), num) for action_value, num in action_count.items())
+
     @classmethod
     def get_progress_descriptor(cls, str_import_type, current_num, total_num, action_count):
         """ Returns a string with the current counts of the import process """
@@ -69,6 +79,215 @@ class ImportActionHelper(object):
         str_descriptor += ' ****\n\n'
         return str_descriptor
 
+    @classmethod
+    def get_total_estimate(cls, input_file, current_num):
+        """
+        Estimates the total number of records from the position within the input file, so that progress
+        can be reported without reading the file twice. Returns 'Unknown' if the position is not available.
+        """
+        offset = getattr(input_file, 'offset', None)
+        size = getattr(input_file, 'size', None)
+        if not offset or not size:
+            return 'Unknown'
+        return max(current_num, int(round(current_num * float(size) / offset)))
+
+
+class InputFile(object):
+    """
+    Reads a JSON lines input file in a single pass. Gzip and bz2 compressed files are decompressed while streaming.
+    Keeps track of the position within the (compressed) file, which is compared to its size to report progress.
+    """
+    GZIP_MAGIC = '\x1f\x8b'
+    BZ2_MAGIC = 'BZh'
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, file_name):
+        self.size = os.path.getsize(file_name)
+        self.raw = open(file_name, 'rb')
+        magic = self.raw.read(3)
+        self.raw.seek(0)
+        self.compression = None
+        self.stream = self.raw
+        self.lines = None
+        if magic.startswith(self.GZIP_MAGIC):
+            self.compression = 'gzip'
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='rb')
+        elif magic == self.BZ2_MAGIC:
+            self.compression = 'bz2'
+
+    @property
+    def offset(self):
+        return self.raw.tell()
+
+    def __iter__(self):
+        # Keep a single iterator, so that lines buffered while skipping are not lost
+        if self.lines is None:
+            if self.compression == 'bz2':
+                self.lines = self._iter_bz2_lines()
+            else:
+                self.lines = iter(self.stream.readline, '')
+        return self.lines
+
+    def skip_to(self, position):
+        """ Continues reading at the given position within the decompressed content """
+        if self.compression is None:
+            self.raw.seek(position)
+        else:
+            ImportCheckpoint.skip_lines(self, position)
+
+    def _iter_bz2_lines(self):
+        decompressor = bz2.BZ2Decompressor()
+        remainder = ''
+        for block in iter(lambda: self.raw.read(self.BLOCK_SIZE), ''):
+            data = ''
+            while block:
+                try:
+                    data += decompressor.decompress(block)
+                except EOFError:
+                    # Concatenated bz2 streams (e.g. written by pbzip2) need a new decompressor each
+                    decompressor = bz2.BZ2Decompressor()
+                    continue
+                block = decompressor.unused_data
+                if block:
+                    decompressor = bz2.BZ2Decompressor()
+            lines = (remainder + data).split('\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if remainder:
+            yield remainder
+
+    def close(self):
+        if self.stream is not self.raw:
+            self.stream.close()
+        self.raw.close()
+
+
+class ImportCheckpoint(object):
+    """
+    Persists the progress of an import every few lines, so that a crashed import can be resumed
+    from the last checkpoint instead of starting from scratch.
+    """
+
+    def __init__(self, file_name, every=1000):
+        self.file_name = file_name
+        self.every = every
+
+    def exists(self):
+        return os.path.exists(self.file_name)
+
+    def load(self):
+        """ Returns the state of the last checkpoint, or None if there is none """
+        if not self.exists():
+            return None
+        with open(self.file_name, 'rb') as checkpoint_file:
+            state = json.load(checkpoint_file)
+        # JSON only has string keys
+        state['action_count'] = dict((int(action), num) for action, num in state['action_count'].items())
+        return state
+
+    def is_due(self, lines_before, lines_after):
+        """ Whether a checkpoint boundary was passed while handling the lines in between """
+        return lines_after // self.every > lines_before // self.every
+
+    def save(self, source_version_id, position, lines_handled, action_count, remaining_ids, index_updater=None):
+        state = {
+            'source_version_id': source_version_id,
+            'position': position,
+            'lines_handled': lines_handled,
+            'action_count': action_count,
+            'remaining_ids': list(remaining_ids),
+            'touched_ids': index_updater.get_state() if index_updater else {},
+        }
+        # Write to a temporary file first, so that a crash while saving does not corrupt the last checkpoint
+        temp_file_name = self.file_name + '.tmp'
+        with open(temp_file_name, 'wb') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.rename(temp_file_name, self.file_name)
+
+    def clear(self):
+        if self.exists():
+            os.remove(self.file_name)
+
+    @staticmethod
+    def skip_to(input_file, position):
+        """ Moves the input file to the position of a checkpoint """
+        if hasattr(input_file, 'skip_to'):
+            input_file.skip_to(position)
+        else:
+            ImportCheckpoint.skip_lines(input_file, position)
+
+    @staticmethod
+    def skip_lines(input_file, position):
+        skipped = 0
+        lines = iter(input_file)
+        while skipped < position:
+            skipped += len(next(lines))
+
+
+class ImportIndexUpdater(object):
+    """
+    Records the IDs of the versions that are saved during an import while the search index is not updated inline,
+    so that only those are reindexed at the end of the import instead of rebuilding the whole index.
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, *models):
+        self.version_ids = dict((model, set()) for model in models)
+
+    @staticmethod
+    def is_needed():
+        """ Whether the import command disabled inline indexing """
+        return type(haystack.signal_processor) is BaseSignalProcessor
+
+    def start(self):
+        for model in self.version_ids:
+            post_save.connect(self.record_save, sender=model, weak=False)
+
+    def stop(self):
+        for model in self.version_ids:
+            post_save.disconnect(self.record_save, sender=model)
+
+    def record_save(self, sender, instance=None, **kwargs):
+        self.version_ids[sender].add(instance.id)
+
+    def add(self, model, version_ids):
+        """ Records versions that were written without a post_save signal, e.g. by a bulk insert """
+        self.version_ids[model].update(version_ids)
+
+    def get_state(self):
+        return dict((model.__name__, list(version_ids)) for model, version_ids in self.version_ids.items())
+
+    def restore(self, state):
+        for model, version_ids in self.version_ids.items():
+            version_ids.update(state.get(model.__name__, []))
+
+    def update_index(self):
+        """ Reindexes the recorded versions in batches, returns the number of versions """
+        total = 0
+        for model, version_ids in self.version_ids.items():
+            version_ids = list(version_ids)
+            for start in range(0, len(version_ids), self.BATCH_SIZE):
+                update_all_in_index(model, model.objects.filter(id__in=version_ids[start:start + self.BATCH_SIZE]))
+            total += len(version_ids)
+        return total
+
+
+class ImportJobCheckpoint(ImportCheckpoint):
+    """ Checkpoint of an import run by the import API, which also reports the progress on the import job """
+
+    def __init__(self, job, every=1000):
+        super(ImportJobCheckpoint, self).__init__(job.checkpoint_file_name, every)
+        self.job = job
+
+    def save(self, source_version_id, position, lines_handled, action_count, remaining_ids, index_updater=None):
+        super(ImportJobCheckpoint, self).save(source_version_id, position, lines_handled, action_count, remaining_ids,
+                                              index_updater)
+        self.job.position = position
+        self.job.lines_handled = lines_handled
+        self.job.action_count = ImportActionHelper.get_action_counts(action_count)
+        self.job.save()
+
 
 class MockRequest(object):
     """ Mock request """
@@ -117,12 +336,28 @@ class ImportCommand(BaseCommand):
                     action='store',
                     dest='keep_haystack',
                     default=False,
-                    help='Keep the inline indexing logic, so that we dont run reindex at the end.'),
+                    help='Keep the inline indexing logic, instead of reindexing the concepts and mappings saved by the import at the end.'),
         make_option('--error-output-file',
                     action='store',
                     dest='error_output_file',
                     default=None,
-                    help="Name of the csv file to redirect validation errors to")
+                    help="Name of the csv file to redirect validation errors to"),
+        make_option('--checkpoint-every',
+                    action='store',
+                    type='int',
+                    dest='checkpoint_every',
+                    default=1000,
+                    help='Number of lines after which the progress of the import is persisted.'),
+        make_option('--checkpoint-file',
+                    action='store',
+                    dest='checkpoint_file',
+                    default=None,
+                    help='Name of the file to persist the progress to. Defaults to the input file name + .checkpoint'),
+        make_option('--resume',
+                    action='store_true',
+                    dest='resume',
+                    default=False,
+                    help='Continue the import from the last checkpoint.'),
     )
 
 
@@ -173,22 +408,23 @@ class ImportCommand(BaseCommand):
         if not permission.has_object_permission(MockRequest(user), None, source):
             raise CommandError('User does not have permission to edit source.')
 
-        # Get total record count
+        # Stream the file in a single pass, progress is reported against the file size
         logger.info('Import begins user %s source %s' % (user, source))
         try:
-            with open(input_filename, 'rb') as input_file:
-                total = sum(1 for line in input_file)
-                options['total'] = total
-                self.stdout.write('Importing %d record(s)...\n' % total)
-                logger.info('Importing %d record(s)...' % total)
+            input_file = InputFile(input_filename)
         except IOError:
             raise CommandError('Could not open input file %s' % input_filename)
+        options['total'] = 0
+
+        checkpoint_file = options.get('checkpoint_file') or input_filename + '.checkpoint'
+        options['checkpoint'] = ImportCheckpoint(checkpoint_file, options.get('checkpoint_every') or 1000)
+        if options.get('resume') and not options['checkpoint'].exists():
+            self.stdout.write('No checkpoint found at %s, starting from the beginning...\n' % checkpoint_file)
+            options['resume'] = False
+
+        self.stdout.write('Importing %s (%d bytes)...\n' % (input_filename, input_file.size))
+        logger.info('Importing %s (%d bytes)...' % (input_filename, input_file.size))
 
-        # Open the file a second time to pass to the import function
-        try:
-            input_file = open(input_filename, 'rb')
-        except IOError:
-            raise CommandError('Could not open input file %s' % input_filename)
         if not options['keep_haystack']:
             haystack.signal_processor = BaseSignalProcessor(haystack.connections, haystack.connection_router)
 
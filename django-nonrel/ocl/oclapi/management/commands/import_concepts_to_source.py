@@ -1,16 +1,39 @@
 """ import_concepts_to_source - Command to import JSON lines concept file into OCL """
+from optparse import make_option
 from concepts.importer import ConceptsImporter, ValidationLogger
 from oclapi.management.commands import ImportCommand
 
 class Command(ImportCommand):
     """ Command to import JSON lines concept file into OCL """
     help = 'Import concepts from a JSON file into a source'
+    option_list = ImportCommand.option_list + (
+        make_option('--chunk-size',
+                    action='store',
+                    type='int',
+                    dest='chunk_size',
+                    default=None,
+                    help='Number of lines to read at once; concepts of each chunk are looked up with a single query.'),
+        make_option('--workers',
+                    action='store',
+                    type='int',
+                    dest='workers',
+                    default=None,
+                    help='Number of processes to import with; membership of the source version is updated once at the end.'),
+        make_option('--validate-only',
+                    action='store_true',
+                    dest='validate_only',
+                    default=False,
+                    help='Validate the whole file against the source and report the errors, without importing anything.'),
+    )
 
     def do_import(self, user, source, input_file, options):
         """ Performs the import of JSON lines concept file into OCL """
         validation_logger = None
         output_file_name = options.get('error_output_file', False)
         if output_file_name:
-            validation_logger = ValidationLogger(output_file_name=output_file_name)
+            validation_logger = ValidationLogger(output_file_name=output_file_name, append=options.get('resume'))
         importer = ConceptsImporter(source, input_file, user, self.stdout, self.stderr, validation_logger=validation_logger)
-        importer.import_concepts(**options)
\ No newline at end of file
+        if options.get('validate_only'):
+            importer.validate_concepts(**options)
+        else:
+            importer.import_concepts(**options)
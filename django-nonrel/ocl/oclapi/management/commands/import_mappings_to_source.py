@@ -1,4 +1,5 @@
 """ import_mappings_to_source - Command to import JSON lines mapping file into OCL """
+from optparse import make_option
 from mappings.importer import MappingsImporter
 from oclapi.management.commands import ImportCommand
 
@@ -8,6 +9,14 @@ __author__ = 'misternando,paynejd'
 class Command(ImportCommand):
     """ Command to import JSON lines mapping file into OCL """
     help = 'Import mappings from a JSON file into a source'
+    option_list = ImportCommand.option_list + (
+        make_option('--chunk-size',
+                    action='store',
+                    type='int',
+                    dest='chunk_size',
+                    default=None,
+                    help='Number of lines to read at once; existing mappings of each chunk are looked up with a single query.'),
+    )
 
     def do_import(self, user, source, input_file, options):
         """ Perform the mapping import """
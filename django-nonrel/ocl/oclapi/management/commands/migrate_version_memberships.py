@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management import BaseCommand
+from django.db import connections
+
+from collection.models import CollectionVersion
+from oclapi.models import VersionMembers
+from sources.models import SourceVersion
+
+
+class Command(BaseCommand):
+    help = 'Move the concepts and mappings lists embedded in source and collection versions to VersionMembership'
+    option_list = BaseCommand.option_list + (
+        make_option('--test',
+                    action='store_true',
+                    dest='test_mode',
+                    default=False,
+                    help='Test mode. Do not update database.'),
+    )
+
+    def handle(self, *args, **options):
+        test_mode = options['test_mode']
+        for version_model in [SourceVersion, CollectionVersion]:
+            collection = connections[version_model.objects.db].get_collection(version_model._meta.db_table)
+            query = {'$or': [{'concepts': {'$exists': True}}, {'mappings': {'$exists': True}}]}
+            for document in collection.find(query, fields=['concepts', 'mappings']):
+                version = version_model.objects.get(id=unicode(document['_id']))
+                for attribute in ['concepts', 'mappings']:
+                    members = VersionMembers(version, attribute)
+                    members.reset(document.get(attribute) or [])
+                    self.stdout.write('%s %s: %d %s\n' % (version_model.__name__, version.id, len(members), attribute))
+                    if not test_mode:
+                        members.save()
+                if not test_mode:
+                    collection.update({'_id': document['_id']}, {'$unset': {'concepts': '', 'mappings': ''}})
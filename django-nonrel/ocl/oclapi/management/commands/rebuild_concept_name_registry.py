@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management import BaseCommand
+
+from concepts.models import Concept, ConceptNameEntry
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the registry of concept names used by the OpenMRS validation schema'
+    option_list = BaseCommand.option_list + (
+        make_option('--source',
+                    action='store',
+                    dest='source_id',
+                    default=None,
+                    help='ID of the source to rebuild the registry for. Defaults to all sources.'),
+        make_option('--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=1000,
+                    help='Number of concepts to register at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        source_id = options['source_id']
+        batch_size = options['batch_size']
+
+        concepts = Concept.objects.all()
+        if source_id:
+            ConceptNameEntry.objects.filter(source_id=source_id).delete()
+            concepts = concepts.filter(parent_id=source_id)
+        else:
+            ConceptNameEntry.objects.all().delete()
+
+        count = 0
+        batch = []
+        for concept in concepts.order_by('id').iterator():
+            batch.append(concept)
+            if len(batch) == batch_size:
+                ConceptNameEntry.register(batch)
+                count += len(batch)
+                batch = []
+        ConceptNameEntry.register(batch)
+        count += len(batch)
+        self.stdout.write('Registered the names of %d concepts\n' % count)
@@ -0,0 +1,74 @@
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+from threading import local
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+
+from oclapi.reindex import REINDEX_MODELS, get_partitions, reindex_partition, clear_markers, finish_reindex
+
+
+def reset_connections():
+    # Forked workers open database connections of their own instead of sharing the sockets of the parent process
+    connections._connections = local()
+
+
+def run_partition(args):
+    return args[:2], reindex_partition(*args)
+
+
+class Command(BaseCommand):
+    help = 'Reindex concept and mapping versions source by source, in parallel worker processes'
+    args = '[concepts|mappings ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--source',
+                    action='append',
+                    dest='source_ids',
+                    default=None,
+                    help='ID of a source to reindex. Can be repeated. Defaults to all sources.'),
+        make_option('--processes',
+                    action='store',
+                    dest='processes',
+                    type='int',
+                    default=cpu_count(),
+                    help='Number of worker processes. Defaults to the number of cores.'),
+        make_option('--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=1000,
+                    help='Number of concepts or mappings whose versions are indexed at a time.'),
+        make_option('--restart',
+                    action='store_true',
+                    dest='restart',
+                    default=False,
+                    help='Ignore the resume markers of a previous run and reindex every partition from the start.'),
+    )
+
+    def handle(self, *args, **options):
+        model_names = args or sorted(REINDEX_MODELS.keys())
+        unknown = [model_name for model_name in model_names if model_name not in REINDEX_MODELS]
+        if unknown:
+            raise CommandError('Cannot reindex %s' % ', '.join(unknown))
+
+        partitions = get_partitions(model_names, options['source_ids'])
+        if options['restart']:
+            clear_markers(partitions)
+        self.stdout.write('Reindexing %d partitions in %d processes\n' % (len(partitions), options['processes']))
+
+        pool = Pool(options['processes'], initializer=reset_connections)
+        total = 0
+        try:
+            args = [(model_name, source_id, options['batch_size']) for model_name, source_id in partitions]
+            for (model_name, source_id), num_indexed in pool.imap_unordered(run_partition, args):
+                total += num_indexed
+                self.stdout.write('%s of source %s: %d versions\n' % (model_name, source_id, num_indexed))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        # The markers are only kept to resume an interrupted run
+        finish_reindex(partitions)
+        self.stdout.write('Reindexed %d versions\n' % total)
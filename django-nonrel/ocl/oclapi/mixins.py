@@ -43,6 +43,7 @@ class ListWithHeadersMixin(ListModelMixin):
     facets = None
     default_filters = {'is_active': True}
     object_list = None
+    search_payload_field = None
 
     def is_verbose(self, request):
         return request.QUERY_PARAMS.get(self.verbose_param, False)
@@ -1,16 +1,20 @@
 import re
+from bson import ObjectId
 from django.contrib.auth.models import User
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
-from django.db import models
-from django.db.models.signals import post_save, pre_save
+from django.db import connections, models, router
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from djangotoolbox.fields import DictField, ListField
+import haystack
+from haystack.signals import BaseSignalProcessor
 from rest_framework.authtoken.models import Token
 
-from oclapi.utils import reverse_resource, reverse_resource_version
+from oclapi.utils import reverse_resource, reverse_resource_version, update_all_in_index
 from oclapi.settings.common import Common
 from django.db.models import get_model
 
@@ -26,6 +30,14 @@ ACCESS_TYPE_CHOICES = ((ACCESS_TYPE_VIEW, 'View'),
                        (ACCESS_TYPE_EDIT, 'Edit'),
                        (ACCESS_TYPE_NONE, 'None'))
 
+# Number of times a change to a source or collection version is applied before giving up on concurrent writers
+MAX_REVISION_CONFLICT_ATTEMPTS = 5
+
+
+class RevisionConflictError(Exception):
+    """ Raised when a source or collection version was saved by another writer since it was read """
+    pass
+
 
 class BaseModel(models.Model):
     """
@@ -216,6 +228,62 @@ class ResourceVersionModel(BaseModel):
         except:
             return None
 
+    @classmethod
+    def mnemonic_of_clone(cls, clone):
+        return clone.id
+
+    @classmethod
+    def persist_clones_in_bulk(cls, clones, user, parent_resource_version, child_list_attribute):
+        """
+        Inserts versions cloned from the latest versions of their resources with one bulk insert, marks the versions
+        they replace as no longer latest with one update and replaces them in the parent resource version with a single
+        save, instead of calling persist_clone for each of them. Returns the errors.
+        """
+        errors = dict()
+        if not clones:
+            return errors
+
+        # Bulk inserts skip the model signals, so IDs, mnemonics and other stamped attributes are assigned up front
+        for clone in clones:
+            clone.id = unicode(ObjectId())
+            clone.mnemonic = cls.mnemonic_of_clone(clone)
+            clone.version_created_by = user.username
+            pre_save.send(sender=cls, instance=clone, raw=False, using=None, update_fields=None)
+        clone_ids = [clone.id for clone in clones]
+        replacements = dict((clone.previous_version_id, clone.id) for clone in clones)
+
+        errored_action = 'inserting new versions'
+        persisted = False
+        try:
+            cls.objects.bulk_create(clones)
+
+            errored_action = "updating 'is_latest_version' attribute on previous versions"
+            cls.objects.filter(id__in=replacements.keys()).update(is_latest_version=False)
+
+            errored_action = 'replacing previous versions in latest version of parent resource'
+            parent_resource_version.replace_members(child_list_attribute, replacements)
+
+            persisted = True
+        finally:
+            if not persisted:
+                errors['non_field_errors'] = ['An error occurred while %s.' % errored_action]
+                cls.objects.filter(id__in=replacements.keys()).update(is_latest_version=True)
+                cls.objects.filter(id__in=clone_ids).delete()
+
+        if type(haystack.signal_processor) is not BaseSignalProcessor:
+            update_all_in_index(cls, cls.objects.filter(id__in=clone_ids + replacements.keys()))
+        return errors
+
+    @classmethod
+    def deactivate_in_bulk(cls, version_ids):
+        """ Deactivates the active versions among the IDs with one update, and returns their IDs """
+        version_ids = list(cls.objects.filter(id__in=list(version_ids), is_active=True).values_list('id', flat=True))
+        if version_ids:
+            cls.objects.filter(id__in=version_ids).update(is_active=False)
+            if type(haystack.signal_processor) is not BaseSignalProcessor:
+                update_all_in_index(cls, cls.objects.filter(id__in=version_ids))
+        return version_ids
+
 
 CUSTOM_VALIDATION_SCHEMA_OPENMRS = 'OpenMRS'
 LOOKUP_CONCEPT_CLASSES = ['Concept Class', 'Datatype', 'NameType', 'DescriptionType', 'MapType', 'Locale']
@@ -311,11 +379,6 @@ class ConceptContainerModel(SubResourceBaseModel):
         if not parent_resource:
             errors['parent'] = 'Source parent cannot be None.'
 
-        if cls.validation_is_necessary(obj):
-            failed_concept_validations = cls.validate_child_concepts(obj) or []
-            if len(failed_concept_validations) > 0:
-                errors.update({'failed_concept_validations': failed_concept_validations})
-
         try:
             obj.full_clean()
         except ValidationError as e:
@@ -343,14 +406,15 @@ class ConceptContainerModel(SubResourceBaseModel):
                and Concept.objects.filter(parent_id=obj.id).count() > 0
 
     @classmethod
-    def validate_child_concepts(cls, obj):
+    def validate_child_concepts(cls, obj, concepts=None):
         # If source is being configured to have a validation schema
-        # we need to validate all concepts
+        # we need to validate all concepts (or the given chunk of them)
         # according to the new schema
         from concepts.models import Concept
         from concepts.validators import ValidatorSpecifier
 
-        concepts = Concept.objects.filter(parent_id=obj.id, is_active=True, retired=False).all()
+        if concepts is None:
+            concepts = Concept.objects.filter(parent_id=obj.id, is_active=True, retired=False).all()
         failed_concept_validations = []
 
         validator = ValidatorSpecifier()\
@@ -370,6 +434,213 @@ class ConceptContainerModel(SubResourceBaseModel):
         return failed_concept_validations
 
 
+class VersionMembership(models.Model):
+    """
+    Membership of a concept or mapping version in a source or collection version. Kept in its own collection,
+    so that large versions neither outgrow their documents nor get rewritten on every single edit.
+    """
+    container_version_id = models.TextField()
+    attribute = models.TextField()
+    resource_version_id = models.TextField(db_index=True)
+
+    class MongoMeta:
+        indexes = [
+            [('container_version_id', 1), ('attribute', 1), ('_id', 1)],
+            [('container_version_id', 1), ('attribute', 1), ('resource_version_id', 1)],
+        ]
+
+    @classmethod
+    def container_version_ids(cls, attribute, resource_version_ids):
+        """ Returns the IDs of the container versions that have any of the resource versions as members """
+        return list(set(cls.objects.filter(
+            attribute=attribute, resource_version_id__in=resource_version_ids
+        ).values_list('container_version_id', flat=True)))
+
+
+class VersionMembers(object):
+    """
+    List of the member IDs of a container version, read from VersionMembership only when needed.
+    Appends, replacements and removals are written as targeted updates when the container version is saved,
+    while assigning a whole new list rewrites the membership.
+    """
+
+    def __init__(self, container_version, attribute):
+        self.container_version = container_version
+        self.attribute = attribute
+        self._ids = None
+        self._rewrite = False
+        self._changes = []
+
+    def reset(self, ids):
+        self._ids = list(ids or [])
+        self._rewrite = True
+        self._changes = []
+
+    def _memberships(self):
+        return VersionMembership.objects.filter(
+            container_version_id=self.container_version.id, attribute=self.attribute)
+
+    def _load(self):
+        if self._ids is None:
+            ids = []
+            if self.container_version.id:
+                ids = list(self._memberships().order_by('id').values_list('resource_version_id', flat=True))
+            for change in self._changes:
+                self._apply_change(ids, *change)
+            self._ids = ids
+        return self._ids
+
+    @staticmethod
+    def _apply_change(ids, action, value, new_value=None):
+        if action == 'append':
+            ids.extend(value)
+        elif action == 'replace':
+            ids[ids.index(value)] = new_value
+        elif action == 'remove':
+            ids.remove(value)
+        elif action == 'replace_many':
+            ids[:] = [value.get(resource_version_id, resource_version_id) for resource_version_id in ids]
+
+    def _change(self, action, value, new_value=None):
+        if self._ids is not None:
+            self._apply_change(self._ids, action, value, new_value)
+        if not self._rewrite:
+            self._changes.append((action, value, new_value))
+
+    def append(self, resource_version_id):
+        self._change('append', [resource_version_id])
+
+    def extend(self, resource_version_ids):
+        self._change('append', list(resource_version_ids))
+
+    def replace(self, resource_version_id, new_resource_version_id):
+        """ Replaces a member in place, returns False if it is not a member """
+        if resource_version_id not in self:
+            return False
+        self._change('replace', resource_version_id, new_resource_version_id)
+        return True
+
+    def replace_many(self, replacements):
+        """ Replaces the members that are keys of the dict by their values, with one delete and one insert on save """
+        self._change('replace_many', dict(replacements))
+
+    def remove(self, resource_version_id):
+        if resource_version_id not in self:
+            raise ValueError('%s is not a member' % resource_version_id)
+        self._change('remove', resource_version_id)
+
+    def __setitem__(self, index, resource_version_id):
+        self._change('replace', self._load()[index], resource_version_id)
+
+    def save(self):
+        """ Writes the pending changes, called after the container version itself has been saved """
+        if self._rewrite:
+            self._memberships().delete()
+            self._insert(self._ids)
+        else:
+            for action, value, new_value in self._changes:
+                if action == 'append':
+                    self._insert(value)
+                elif action == 'replace':
+                    self._memberships().filter(resource_version_id=value).update(resource_version_id=new_value)
+                elif action == 'remove':
+                    self._memberships().filter(resource_version_id=value).delete()
+                elif action == 'replace_many':
+                    replaced_ids = list(self._memberships().filter(
+                        resource_version_id__in=value.keys()).values_list('resource_version_id', flat=True))
+                    self._memberships().filter(resource_version_id__in=replaced_ids).delete()
+                    self._insert([value[resource_version_id] for resource_version_id in replaced_ids])
+        self._rewrite = False
+        self._changes = []
+
+    def _insert(self, resource_version_ids):
+        if resource_version_ids:
+            VersionMembership.objects.bulk_create([
+                VersionMembership(container_version_id=self.container_version.id, attribute=self.attribute,
+                                  resource_version_id=resource_version_id)
+                for resource_version_id in resource_version_ids])
+
+    def index(self, resource_version_id):
+        return self._load().index(resource_version_id)
+
+    def count(self, resource_version_id):
+        return self._load().count(resource_version_id)
+
+    def __contains__(self, resource_version_id):
+        if self._ids is None and not self._changes:
+            return bool(self.container_version.id) and \
+                self._memberships().filter(resource_version_id=resource_version_id).exists()
+        return resource_version_id in self._load()
+
+    def __nonzero__(self):
+        if self._ids is None and not self._changes:
+            return bool(self.container_version.id) and self._memberships().exists()
+        return bool(self._load())
+
+    def __len__(self):
+        if self._ids is None and not self._changes:
+            return self._memberships().count() if self.container_version.id else 0
+        return len(self._load())
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+    def __add__(self, other):
+        return self._load() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self._load()
+
+    def __eq__(self, other):
+        return self._load() == list(other) if isinstance(other, (list, tuple, VersionMembers)) else False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._load())
+
+
+def members_property(attribute):
+    """ Exposes the members of a container version as a list-like attribute, e.g. SourceVersion.concepts """
+    def get_members(self):
+        key = '_%s_members' % attribute
+        if key not in self.__dict__:
+            self.__dict__[key] = VersionMembers(self, attribute)
+        return self.__dict__[key]
+
+    def set_members(self, ids):
+        members = get_members(self)
+        if ids is not members:
+            members.reset(ids)
+
+    return property(get_members, set_members)
+
+
+class IndexDigest(models.Model):
+    """
+    Digest of the fields of a search document as it was last sent to Solr, by the identifier of the document.
+    Lets the search backend skip the documents that a save did not change.
+    """
+    identifier = models.TextField(unique=True)
+    digest = models.TextField()
+
+    @classmethod
+    def get_digests(cls, identifiers):
+        return dict(cls.objects.filter(identifier__in=list(identifiers)).values_list('identifier', 'digest'))
+
+    @classmethod
+    def set_digests(cls, digests):
+        # Workers indexing the same document concurrently each upsert it, so a document never has two digests
+        # and never goes without one
+        collection = connections[cls.objects.db].get_collection(cls._meta.db_table)
+        for identifier, digest in digests.items():
+            collection.update({'identifier': identifier}, {'$set': {'digest': digest}}, upsert=True)
+
+
 class ConceptContainerVersionModel(ResourceVersionModel):
     name = models.TextField()
     full_name = models.TextField(null=True, blank=True)
@@ -379,9 +650,115 @@ class ConceptContainerVersionModel(ResourceVersionModel):
     description = models.TextField(null=True, blank=True)
     external_id = models.TextField(null=True, blank=True)
 
+    revision = models.IntegerField(default=0)
+
+    concepts = members_property('concepts')
+    mappings = members_property('mappings')
+
     class Meta(ResourceVersionModel.Meta):
         abstract = True
 
+    def save(self, *args, **kwargs):
+        if self.id and not kwargs.get('force_insert'):
+            self.save_revision(using=kwargs.get('using'))
+        else:
+            super(ConceptContainerVersionModel, self).save(*args, **kwargs)
+        self.concepts.save()
+        self.mappings.save()
+
+    def save_revision(self, using=None):
+        """
+        Writes the version only if it is still at the revision that was read, and moves it to the next revision.
+        Raises RevisionConflictError, without writing anything, if another writer saved the version in between.
+        """
+        model = type(self)
+        using = using or router.db_for_write(model, instance=self)
+        expected_revision = self.revision or 0
+        self.revision = expected_revision + 1
+        pre_save.send(sender=model, instance=self, raw=False, using=using, update_fields=None)
+        # The processing flag is written by set_processing alone, so a stale copy cannot reset it
+        values = [(field, None, field.pre_save(self, False)) for field in self._meta.local_fields
+                  if not field.primary_key and field.name != '_ocl_processing']
+
+        unchanged = Q(revision=expected_revision)
+        if not expected_revision:
+            # Versions saved before revisions were introduced have none
+            unchanged |= Q(revision__isnull=True)
+        if not model._base_manager.using(using).filter(unchanged, pk=self.pk)._update(values):
+            self.revision = expected_revision
+            raise RevisionConflictError('%s %s was changed by another writer.' % (model.__name__, self.id))
+        post_save.send(sender=model, instance=self, created=False, raw=False, using=using, update_fields=None)
+
+    def reload(self):
+        """ Replaces the attributes of the version by the stored ones, dropping any unsaved membership changes """
+        stored = type(self).objects.get(id=self.id)
+        for field in self._meta.fields:
+            setattr(self, field.attname, getattr(stored, field.attname))
+        for attribute in ['concepts', 'mappings']:
+            self.__dict__.pop('_%s_members' % attribute, None)
+
+    def set_processing(self, processing):
+        """
+        Flags the version as being processed by a background task. Only the flag is written, so that it neither
+        conflicts with nor overwrites the saves of other writers in the meantime.
+        """
+        self._ocl_processing = processing
+        if '_ocl_processing' in self._meta.get_all_field_names():
+            type(self).objects.filter(id=self.id).update(_ocl_processing=processing)
+
+    def retry_on_conflict(self, write):
+        """
+        Calls write, which changes and saves the version, and returns its result. If another writer saved the version
+        first, reloads it and calls write again, so that concurrent changes to the same version are not lost.
+        """
+        attempt = 1
+        while True:
+            try:
+                return write()
+            except RevisionConflictError:
+                if attempt >= MAX_REVISION_CONFLICT_ATTEMPTS:
+                    raise
+                attempt += 1
+                self.reload()
+
+    def add_members(self, attribute, resource_version_ids):
+        def write():
+            getattr(self, attribute).extend(resource_version_ids)
+            self.save()
+        self.retry_on_conflict(write)
+
+    def remove_members(self, attribute, resource_version_ids):
+        def write():
+            members = getattr(self, attribute)
+            for resource_version_id in resource_version_ids:
+                if resource_version_id in members:
+                    members.remove(resource_version_id)
+            self.save()
+        self.retry_on_conflict(write)
+
+    def replace_members(self, attribute, replacements):
+        """ Replaces member versions by the versions that replace them, with a single save """
+        def write():
+            getattr(self, attribute).replace_many(replacements)
+            self.save()
+        self.retry_on_conflict(write)
+
+    def update_member_version(self, attribute, resource_version):
+        """
+        Replaces the previous version of a concept or mapping version by it in the members, or adds it if the previous
+        version is not a member. Returns whether it replaced the previous version.
+        """
+        previous_version = resource_version.previous_version
+
+        def write():
+            members = getattr(self, attribute)
+            replaced = bool(previous_version) and members.replace(previous_version.id, resource_version.id)
+            if not replaced:
+                members.append(resource_version.id)
+            self.save()
+            return replaced
+        return self.retry_on_conflict(write)
+
     @property
     def owner(self):
         return self.versioned_object.owner
@@ -510,6 +887,11 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
     if instance and created:
         Token.objects.create(user=instance)
 
+@receiver(post_delete)
+def delete_memberships(sender, instance, **kwargs):
+    if issubclass(sender, ConceptContainerVersionModel):
+        VersionMembership.objects.filter(container_version_id=instance.id).delete()
+
 @receiver(pre_save)
 def stamp_uri(sender, instance, **kwargs):
     if issubclass(sender, BaseModel):
@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+from uuid import uuid4
+
+from django.conf import settings
+from django.db.models import get_model
+from haystack.utils import loading
+
+from oclapi.utils import keyset_batches
+
+__author__ = 'misternando'
+
+logger = logging.getLogger('oclapi')
+
+# Resources whose versions are reindexed per source, by the models holding their versioned objects
+REINDEX_MODELS = {
+    'concepts': ('concepts', 'Concept'),
+    'mappings': ('mappings', 'Mapping'),
+}
+
+
+class ReindexStateFile(object):
+    """ JSON file in the reindex state directory, which the workers of a reindex read and write """
+    file_name = None
+
+    def exists(self):
+        return os.path.exists(self.file_name)
+
+    def load_state(self):
+        try:
+            with open(self.file_name, 'rb') as state_file:
+                return json.load(state_file)
+        except IOError:
+            # Not written yet, or cleared by the worker that finished the reindex
+            return None
+
+    def save_state(self, state):
+        # Write to a temporary file first, so that a crash while saving does not corrupt the last state
+        temp_file_name = '%s.%d.tmp' % (self.file_name, os.getpid())
+        with open(temp_file_name, 'wb') as state_file:
+            json.dump(state, state_file)
+        os.rename(temp_file_name, self.file_name)
+
+    def clear(self):
+        try:
+            os.remove(self.file_name)
+        except OSError:
+            pass
+
+
+class ReindexMarker(ReindexStateFile):
+    """
+    Persists how far the reindex of a partition got, so that an interrupted reindex resumes after the last
+    indexed batch. Every partition has a file of its own, so partitions reindexed in parallel never share one.
+    """
+
+    def __init__(self, state_dir, model_name, source_id):
+        self.file_name = os.path.join(state_dir, '%s-%s.json' % (model_name, source_id))
+
+    def load(self):
+        """ Returns the state of the last batch, or None if the partition was not started """
+        return self.load_state()
+
+    def save(self, last_id, num_indexed, done=False):
+        self.save_state({
+            'last_id': last_id,
+            'num_indexed': num_indexed,
+            'done': done,
+        })
+
+
+class ReindexRun(ReindexStateFile):
+    """
+    The partitions of a reindex fanned out to celery tasks, which the tasks look up by the ID of the run instead of
+    each carrying the whole list.
+    """
+
+    def __init__(self, state_dir, run_id):
+        self.file_name = os.path.join(state_dir, 'run-%s.json' % run_id)
+
+    def load(self):
+        """ Returns the (model name, source ID) pairs of the run, or None if the run is over """
+        partitions = self.load_state()
+        return None if partitions is None else [tuple(partition) for partition in partitions]
+
+    def save(self, partitions):
+        self.save_state(partitions)
+
+
+def get_partitions(model_names, source_ids=None):
+    """ Returns a (model name, source ID) pair for every model and source """
+    if not source_ids:
+        source_ids = get_model('sources', 'Source').objects.order_by('id').values_list('id', flat=True)
+    return [(model_name, source_id) for model_name in model_names for source_id in source_ids]
+
+
+def get_markers(partitions, state_dir=None):
+    state_dir = state_dir or settings.REINDEX_STATE_DIR
+    return [ReindexMarker(state_dir, model_name, source_id) for model_name, source_id in partitions]
+
+
+def clear_markers(partitions, state_dir=None):
+    """ Makes the next reindex of the partitions start from scratch """
+    for marker in get_markers(partitions, state_dir):
+        marker.clear()
+
+
+def finish_reindex(partitions, state_dir=None):
+    """
+    Clears the markers of the partitions once all of them are done, so that the next reindex indexes them again.
+    Returns whether they were all done.
+    """
+    markers = get_markers(partitions, state_dir)
+    if not all((marker.load() or {}).get('done') for marker in markers):
+        return False
+    for marker in markers:
+        marker.clear()
+    return True
+
+
+def start_run(partitions, state_dir=None):
+    """ Saves the partitions of a reindex that is fanned out to celery tasks, and returns the ID of the run """
+    state_dir = state_dir or settings.REINDEX_STATE_DIR
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    run_id = uuid4().hex
+    ReindexRun(state_dir, run_id).save(partitions)
+    return run_id
+
+
+def finish_run(run_id, state_dir=None):
+    """
+    Clears the markers and the partitions of a run once all of its partitions are done. Returns whether they were,
+    which is true for only one of the tasks of the run, unless several finish at the same time.
+    """
+    run = ReindexRun(state_dir or settings.REINDEX_STATE_DIR, run_id)
+    partitions = run.load()
+    if partitions is None or not finish_reindex(partitions, state_dir):
+        return False
+    run.clear()
+    return True
+
+
+def reindex_partition(model_name, source_id, batch_size=1000, state_dir=None):
+    """
+    Reindexes the versions of the concepts or mappings of a source. The concepts or mappings are walked in id order,
+    batch_size at a time, and the position is saved after every batch. A partition that was started before resumes
+    after its last batch, and one that is done is not indexed again until the markers are cleared. Every version is
+    sent to Solr, whatever its index digest, so that a reindex restores a core that lost documents.
+    Returns the number of versions indexed.
+    """
+    state_dir = state_dir or settings.REINDEX_STATE_DIR
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    marker = ReindexMarker(state_dir, model_name, source_id)
+    state = marker.load() or {'last_id': None, 'num_indexed': 0, 'done': False}
+    if state['done']:
+        logger.info('Reindex of %s of source %s already done: %d versions' % (model_name, source_id,
+                                                                              state['num_indexed']))
+        return state['num_indexed']
+
+    model = get_model(*REINDEX_MODELS[model_name])
+    version_model = model.get_version_model()
+    # A connection of its own, since worker processes must not share the sockets of the process that forked them
+    connection = loading.ConnectionHandler(settings.HAYSTACK_CONNECTIONS)['default']
+    backend = connection.get_backend()
+    index = connection.get_unified_index().get_index(version_model)
+
+    last_id, num_indexed = state['last_id'], state['num_indexed']
+    for batch in keyset_batches(model.objects.filter(parent_id=source_id), batch_size, after_id=last_id):
+        versions = list(version_model.objects.filter(versioned_object_id__in=[obj.id for obj in batch]))
+        if versions:
+            backend.update(index, versions, force=True)
+        last_id = batch[-1].id
+        num_indexed += len(versions)
+        marker.save(last_id, num_indexed)
+        logger.info('Reindexed %d versions of %s of source %s' % (num_indexed, model_name, source_id))
+    marker.save(last_id, num_indexed, done=True)
+    return num_indexed
@@ -1,5 +1,12 @@
+import json
+
 from haystack.backends.solr_backend import SolrSearchBackend, SolrEngine
+from haystack.constants import ID
 from haystack.fields import CharField, MultiValueField
+from haystack.utils import get_identifier
+from pysolr import SolrError
+
+from oclapi.models import IndexDigest
 
 __author__ = 'misternando'
 
@@ -12,8 +19,75 @@ class FilterField(MultiValueField):
     field_type = 'lowercase'
 
 
+class StoredPayloadField(CharField):
+    """ Stored only field holding a JSON document, which search results hand back decoded """
+
+    def __init__(self, **kwargs):
+        kwargs.update({'indexed': False, 'stored': True, 'null': True})
+        super(StoredPayloadField, self).__init__(**kwargs)
+
+    def convert(self, value):
+        if value is None:
+            return None
+        return json.loads(value)
+
+
 class OCLSolrBackend(SolrSearchBackend):
 
+    def update(self, index, iterable, commit=True, force=False):
+        # Lets the index read what the documents of the batch need with a few queries for the whole batch
+        objs = list(iterable)
+        if hasattr(index, 'start_batch'):
+            index.start_batch(objs)
+        docs = []
+        try:
+            for obj in objs:
+                try:
+                    docs.append(index.full_prepare(obj))
+                except UnicodeDecodeError:
+                    if not self.silently_fail:
+                        raise
+                    self.log.error(u"UnicodeDecodeError while preparing object for update", exc_info=True,
+                                   extra={'data': {'index': index, 'object': get_identifier(obj)}})
+        finally:
+            if hasattr(index, 'end_batch'):
+                index.end_batch()
+
+        # Documents whose fields are as they were when last indexed are not sent again, unless forced to, since
+        # Solr may have lost them
+        digests = {}
+        if hasattr(index, 'get_digest'):
+            digests = dict((doc[ID], index.get_digest(doc)) for doc in docs)
+            if not force:
+                indexed_digests = IndexDigest.get_digests(digests.keys())
+                docs = [doc for doc in docs if indexed_digests.get(doc[ID]) != digests[doc[ID]]]
+                digests = dict((doc[ID], digests[doc[ID]]) for doc in docs)
+        if not docs:
+            return
+
+        try:
+            self.conn.add(docs, commit=commit, boost=index.get_field_weights())
+        except (IOError, SolrError) as e:
+            if not self.silently_fail:
+                raise
+            self.log.error("Failed to add documents to Solr: %s", e)
+            return
+        IndexDigest.set_digests(digests)
+
+    def remove(self, obj_or_string, commit=True):
+        super(OCLSolrBackend, self).remove(obj_or_string, commit=commit)
+        IndexDigest.objects.filter(identifier=get_identifier(obj_or_string)).delete()
+
+    def clear(self, models=[], commit=True):
+        super(OCLSolrBackend, self).clear(models=models, commit=commit)
+        # Documents of the cleared models have to be sent again, whatever their digests
+        if models:
+            for model in models:
+                IndexDigest.objects.filter(
+                    identifier__startswith='%s.%s.' % (model._meta.app_label, model._meta.module_name)).delete()
+        else:
+            IndexDigest.objects.all().delete()
+
     def build_schema(self, fields):
         content_field_name = ''
         schema_fields = []
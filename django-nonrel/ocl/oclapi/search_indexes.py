@@ -1,9 +1,105 @@
+import json
+from collections import defaultdict
+
+from django.db.models import get_model
 from haystack.indexes import SearchIndex
+from rest_framework.utils.encoders import JSONEncoder
+
+from oclapi.models import VersionMembership
+from oclapi.utils import content_digest
 
 __author__ = 'misternando'
 
+# Stored field with the list representation of a document, which search responses can serve without loading it
+LIST_PAYLOAD_FIELD = 'list_payload'
+
+
+class MembershipMap(object):
+    """
+    Source versions, collection versions and collections that the concept or mapping versions of an indexing batch
+    belong to, read with a few queries for the whole batch instead of scanning the containers for every document
+    """
+
+    def __init__(self, attribute, versions):
+        self.version_ids = set(version.id for version in versions)
+        self.container_version_ids = defaultdict(set)
+        memberships = VersionMembership.objects.filter(
+            attribute=attribute, resource_version_id__in=list(self.version_ids)
+        ).values_list('resource_version_id', 'container_version_id')
+        for resource_version_id, container_version_id in memberships:
+            self.container_version_ids[resource_version_id].add(container_version_id)
+
+        container_version_ids = list(set().union(*self.container_version_ids.values()))
+        self.source_version_ids = set(get_model('sources', 'SourceVersion').objects.filter(
+            id__in=container_version_ids).values_list('id', flat=True))
+        self.collection_version_ids = set(get_model('collection', 'CollectionVersion').objects.filter(
+            id__in=container_version_ids).values_list('id', flat=True))
+
+        # Collections refer to a version by its URI, or to the latest version by the URI of the versioned object
+        self.expressions = dict((version.id, self._expressions_of(version)) for version in versions)
+        expressions = set().union(*self.expressions.values())
+        self.collection_ids = defaultdict(set)
+        collections = get_model('collection', 'Collection').objects.raw_query(
+            {'references.expression': {'$in': list(expressions)}})
+        for collection in collections:
+            for reference in collection.references:
+                if reference.expression in expressions:
+                    self.collection_ids[reference.expression].add(collection.id)
+
+    @staticmethod
+    def _expressions_of(version):
+        expressions = set([version.uri])
+        if version.is_latest_version and version.versioned_object:
+            expressions.add(version.versioned_object.uri)
+        return expressions
+
+    def __contains__(self, version):
+        return version.id in self.version_ids
+
+    def source_versions_of(self, version):
+        return list(self.container_version_ids[version.id] & self.source_version_ids)
+
+    def collection_versions_of(self, version):
+        return list(self.container_version_ids[version.id] & self.collection_version_ids)
+
+    def collections_of(self, version):
+        return list(set().union(*[self.collection_ids[expression] for expression in self.expressions[version.id]]))
+
 
 class OCLSearchIndex(SearchIndex):
+    # Members attribute of the source and collection versions that hold the indexed versions, if any
+    membership_attribute = None
+    membership_map = None
 
     def get_updated_field(self):
         return 'updated_at'
+
+    def start_batch(self, objs):
+        """ Called by the search backend before it prepares a batch of documents """
+        if self.membership_attribute and objs:
+            self.membership_map = MembershipMap(self.membership_attribute, objs)
+
+    def end_batch(self):
+        self.membership_map = None
+
+    def get_membership_map(self, obj):
+        if self.membership_map is not None and obj in self.membership_map:
+            return self.membership_map
+        return MembershipMap(self.membership_attribute, [obj])
+
+    def get_digest(self, prepared_data):
+        """
+        Digest of a prepared document, which tells the search backend whether the document changed since it was
+        last indexed. Leaves out the update timestamp, which every save changes.
+        """
+        excluded = [field.index_fieldname for field in self.fields.values()
+                    if field.model_attr == self.get_updated_field()]
+        return content_digest(dict((name, value) for name, value in prepared_data.items() if name not in excluded),
+                              cls=JSONEncoder)
+
+    def serialize_payload(self, obj, serializer_class, excluded_fields=(), extra=None):
+        data = serializer_class(obj).data
+        for field_name in excluded_fields:
+            data.pop(field_name, None)
+        data.update(extra or {})
+        return json.dumps(data, cls=JSONEncoder)
@@ -100,3 +100,43 @@ class ResourceVersionSerializer(serializers.Serializer):
             'model_name': model_meta.object_name.lower()
         }
         return self._default_view_name % format_kwargs
+
+
+class StoredPayloadSerializer(serializers.Serializer):
+    """
+    Serializes search results that carry the representation stored in the search index as is,
+    and the objects of the results indexed without it with the fallback serializer.
+    Fields that go stale in the index are filled into the stored representations by complete_payloads,
+    once for all the results of a response.
+    """
+    fallback_serializer_class = None
+
+    def __init__(self, *args, **kwargs):
+        super(StoredPayloadSerializer, self).__init__(*args, **kwargs)
+        self.stored_payloads = []
+
+    def to_native(self, obj):
+        if isinstance(obj, dict):
+            self.stored_payloads.append(obj)
+            return obj
+        return self.fallback_serializer_class(obj, context=self.context).data
+
+    def complete_payloads(self, payloads):
+        pass
+
+    def complete_stored_payloads(self):
+        payloads, self.stored_payloads = self.stored_payloads, []
+        if payloads:
+            self.complete_payloads(payloads)
+
+    def field_to_native(self, obj, field_name):
+        # The results of a page are serialized as a field of the pagination serializer
+        native = super(StoredPayloadSerializer, self).field_to_native(obj, field_name)
+        self.complete_stored_payloads()
+        return native
+
+    @property
+    def data(self):
+        data = super(StoredPayloadSerializer, self).data
+        self.complete_stored_payloads()
+        return data
@@ -215,17 +215,28 @@ class Common(Configuration):
     # RealtimeSignalProcessor will update the index for every mongo update, sometimes at
     # the cost of performance. BaseSignalProcessor does not update the index at all, which
     # means the index must be updated manually (e.g. using the haystack update_index command).
-    HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+    # QueuedSignalProcessor queues the updated objects in redis, and a celery task indexes them
+    # SEARCH_INDEX_QUEUE_WINDOW seconds later, once per object however many times it was saved.
+    HAYSTACK_SIGNAL_PROCESSOR = 'oclapi.signals.QueuedSignalProcessor'
     HAYSTACK_ITERATOR_LOAD_PER_QUERY = 25
     HAYSTACK_SEARCH_RESULTS_PER_PAGE = 25
 
     # Celery settings
     CELERY_RESULT_BACKEND = 'redis://redis.openconceptlab.org:6379/0'
+    SEARCH_INDEX_QUEUE_URL = 'redis://redis.openconceptlab.org:6379/0'
+    SEARCH_INDEX_QUEUE_WINDOW = 2
     # Set these in your postactivate hook if you use virtualenvwrapper
     AWS_ACCESS_KEY_ID=os.environ.get('AWS_ACCESS_KEY_ID', '')
     AWS_SECRET_ACCESS_KEY=os.environ.get('AWS_SECRET_ACCESS_KEY', '')
     AWS_STORAGE_BUCKET_NAME=os.environ.get('AWS_STORAGE_BUCKET_NAME', '')
 
+    # Directory the files uploaded to the import API are spooled to; must be shared by the API and the celery workers
+    IMPORT_SPOOL_DIR = os.environ.get('IMPORT_SPOOL_DIR', os.path.join(BASE_DIR, 'imports'))
+
+    # Directory the reindex command and tasks keep the resume markers of their partitions in; must be shared by the
+    # celery workers, so that a redelivered partition resumes and the last partition of a run clears the markers
+    REINDEX_STATE_DIR = os.environ.get('REINDEX_STATE_DIR', os.path.join(BASE_DIR, 'reindex'))
+
     # Model that stores auxiliary user profile attributes.
     # A user must have a profile in order to access the system.
     # (A profile is created automatically for any user created using the 'POST /users' endpoint.)
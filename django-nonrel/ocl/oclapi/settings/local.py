@@ -57,4 +57,5 @@ class IntegrationTest(Common):
 
     BROKER_URL = 'redis://localhost:6379/0'
     CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
+    SEARCH_INDEX_QUEUE_URL = 'redis://localhost:6379/0'
     INSTALLED_APPS = Common.INSTALLED_APPS
@@ -0,0 +1,138 @@
+from collections import defaultdict
+import logging
+
+import redis
+from django.conf import settings
+from django.db import models
+from django.db.models import get_model
+from haystack.exceptions import NotHandled
+from haystack.signals import BaseSignalProcessor
+
+from oclapi.utils import haystack_connections, update_all_in_index
+
+__author__ = 'misternando'
+
+logger = logging.getLogger('oclapi')
+
+
+class SearchIndexQueue(object):
+    """
+    Redis sets of the objects whose search documents have to be updated or removed. An object saved several times
+    before the queue is flushed is queued once, and a flush sends the documents of each model to Solr in batches.
+    """
+    UPDATE_KEY = 'ocl:search_index:update'
+    REMOVE_KEY = 'ocl:search_index:remove'
+    SCHEDULED_KEY = 'ocl:search_index:scheduled'
+
+    def __init__(self, url=None, window=None):
+        self.redis = redis.StrictRedis.from_url(url or settings.SEARCH_INDEX_QUEUE_URL)
+        self.window = settings.SEARCH_INDEX_QUEUE_WINDOW if window is None else window
+
+    @staticmethod
+    def get_identifier(instance):
+        return '%s.%s.%s' % (instance._meta.app_label, instance._meta.module_name, instance.pk)
+
+    def add(self, key, instance):
+        self.redis.sadd(key, self.get_identifier(instance))
+        # Only the first object queued within a window schedules a flush. The flag expires in case the flush is lost.
+        if self.redis.set(self.SCHEDULED_KEY, 1, nx=True, ex=self.window + 60):
+            from tasks import flush_search_index_queue
+            flush_search_index_queue.apply_async(countdown=self.window)
+
+    @staticmethod
+    def get_processing_key(key):
+        return key + ':processing'
+
+    def take(self, key):
+        """
+        Moves the queued identifiers into the processing set of the key, where they stay until the flush succeeds.
+        The identifiers of a flush that died before finishing are taken again with them.
+        """
+        processing_key = self.get_processing_key(key)
+        pipe = self.redis.pipeline()
+        pipe.sunionstore(processing_key, processing_key, key)
+        pipe.delete(key)
+        pipe.smembers(processing_key)
+        _, _, identifiers = pipe.execute()
+        return identifiers
+
+    def release(self, key, identifiers=None):
+        """ Drops the processing set of the key, putting the given identifiers back into the queue """
+        pipe = self.redis.pipeline()
+        if identifiers:
+            pipe.sadd(key, *identifiers)
+        pipe.delete(self.get_processing_key(key))
+        pipe.execute()
+
+    def flush(self):
+        """ Updates and removes the queued search documents, and returns the number of objects flushed """
+        # Objects queued from now on schedule the next flush
+        self.redis.delete(self.SCHEDULED_KEY)
+        removed = self.take(self.REMOVE_KEY)
+        updated = self.take(self.UPDATE_KEY) - removed
+        try:
+            backend = haystack_connections['default'].get_backend()
+            for identifier in removed:
+                backend.remove(identifier)
+
+            ids_by_model = defaultdict(list)
+            for identifier in updated:
+                app_label, module_name, pk = identifier.split('.', 2)
+                ids_by_model[get_model(app_label, module_name)].append(pk)
+            for model, ids in ids_by_model.items():
+                update_all_in_index(model, model.objects.filter(id__in=ids))
+        except Exception:
+            # Queued again rather than left in the processing sets, which a concurrent flush may drop on success
+            self.release(self.REMOVE_KEY, removed)
+            self.release(self.UPDATE_KEY, updated)
+            raise
+        self.release(self.REMOVE_KEY)
+        self.release(self.UPDATE_KEY)
+        return len(removed) + len(updated)
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """
+    Queues the objects saved or deleted during a request, instead of posting every save to Solr inline like
+    RealtimeSignalProcessor. A celery task flushes the queue SEARCH_INDEX_QUEUE_WINDOW seconds after the first
+    object is queued, so the repeated saves of an edit update its document once.
+    """
+    queue = None
+
+    def setup(self):
+        models.signals.post_save.connect(self.handle_save)
+        models.signals.post_delete.connect(self.handle_delete)
+
+    def teardown(self):
+        models.signals.post_save.disconnect(self.handle_save)
+        models.signals.post_delete.disconnect(self.handle_delete)
+
+    def get_queue(self):
+        if self.queue is None:
+            self.queue = SearchIndexQueue()
+        return self.queue
+
+    def is_indexed(self, sender):
+        try:
+            self.connections['default'].get_unified_index().get_index(sender)
+        except NotHandled:
+            return False
+        return True
+
+    def handle_save(self, sender, instance, **kwargs):
+        if not self.is_indexed(sender):
+            return
+        try:
+            self.get_queue().add(SearchIndexQueue.UPDATE_KEY, instance)
+        except redis.RedisError:
+            logger.warning('Could not queue %s, updating it inline' % SearchIndexQueue.get_identifier(instance))
+            super(QueuedSignalProcessor, self).handle_save(sender, instance, **kwargs)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        if not self.is_indexed(sender):
+            return
+        try:
+            self.get_queue().add(SearchIndexQueue.REMOVE_KEY, instance)
+        except redis.RedisError:
+            logger.warning('Could not queue %s, removing it inline' % SearchIndexQueue.get_identifier(instance))
+            super(QueuedSignalProcessor, self).handle_delete(sender, instance, **kwargs)
@@ -1,10 +1,22 @@
+import bz2
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
 from django.contrib.auth.models import User
-from oclapi.models import ACCESS_TYPE_EDIT
+from mock import mock
+from oclapi.management.commands import ImportActionHelper, ImportCheckpoint, InputFile, ImportIndexUpdater
+from oclapi.models import ACCESS_TYPE_EDIT, IndexDigest
 from orgs.models import Organization
 from sources.models import Source, SourceVersion
 from users.models import UserProfile
 from test_helper.base import OclApiBaseTestCase
-from oclapi.utils import compact, extract_values
+from oclapi.reindex import ReindexMarker, ReindexRun, finish_reindex, start_run, finish_run
+from oclapi.search_backends import OCLSolrBackend
+from oclapi.signals import SearchIndexQueue
+from oclapi.utils import compact, extract_values, LRUCache, keyset_batches, content_digest
 
 class ResourceVersionModelBaseTest(OclApiBaseTestCase):
 
@@ -102,3 +114,242 @@ class UtilsTest(OclApiBaseTestCase):
         self.assertListEqual(extract_values({'k1': 1, 'k2': '2', 'k3': None, 'k4': 'foobar'}, ['k2', 'k1', 'k3']), ['2', 1, None])
         self.assertListEqual(extract_values({'k1': '2'}, ['k1']), ['2'])
         self.assertListEqual(extract_values({'k1': 1}, ['k1']), [1])
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEquals(len(cache), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertIsNone(cache.get('b'))
+        self.assertEquals(cache.get('c'), 3)
+
+
+class InputFileTest(OclApiBaseTestCase):
+    def setUp(self):
+        super(InputFileTest, self).setUp()
+        self.lines = ''.join('{"id": "%04d"}\n' % i for i in range(1000))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(InputFileTest, self).tearDown()
+
+    def read_all(self, file_name):
+        input_file = InputFile(file_name)
+        content = ''.join(input_file)
+        self.assertEquals(input_file.offset, input_file.size)
+        input_file.close()
+        return content
+
+    def test_read_uncompressed_file(self):
+        file_name = os.path.join(self.directory, 'concepts.json')
+        with open(file_name, 'wb') as out:
+            out.write(self.lines)
+        self.assertEquals(self.read_all(file_name), self.lines)
+
+    def test_read_gzip_file(self):
+        file_name = os.path.join(self.directory, 'concepts.json.gz')
+        out = gzip.open(file_name, 'wb')
+        out.write(self.lines)
+        out.close()
+        self.assertEquals(self.read_all(file_name), self.lines)
+
+    def test_read_concatenated_bz2_file(self):
+        file_name = os.path.join(self.directory, 'concepts.json.bz2')
+        with open(file_name, 'wb') as out:
+            out.write(bz2.compress(self.lines[:5000]) + bz2.compress(self.lines[5000:]))
+        self.assertEquals(self.read_all(file_name), self.lines)
+
+    def test_total_estimate(self):
+        file_name = os.path.join(self.directory, 'concepts.json')
+        with open(file_name, 'wb') as out:
+            out.write(self.lines)
+        input_file = InputFile(file_name)
+        lines = iter(input_file)
+        for _ in range(10):
+            next(lines)
+        self.assertEquals(ImportActionHelper.get_total_estimate(input_file, 10), 1000)
+        self.assertEquals(ImportActionHelper.get_total_estimate(object(), 10), 'Unknown')
+        input_file.close()
+
+
+class ImportCheckpointTest(OclApiBaseTestCase):
+    def setUp(self):
+        super(ImportCheckpointTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = ImportCheckpoint(os.path.join(self.directory, 'concepts.json.checkpoint'), every=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(ImportCheckpointTest, self).tearDown()
+
+    def test_save_and_load(self):
+        self.assertIsNone(self.checkpoint.load())
+        self.checkpoint.save('version1', 1024, 200, {ImportActionHelper.IMPORT_ACTION_ADD: 200}, set(['a', 'b']))
+        state = self.checkpoint.load()
+        self.assertEquals(state['source_version_id'], 'version1')
+        self.assertEquals(state['position'], 1024)
+        self.assertEquals(state['lines_handled'], 200)
+        self.assertEquals(state['action_count'], {ImportActionHelper.IMPORT_ACTION_ADD: 200})
+        self.assertItemsEqual(state['remaining_ids'], ['a', 'b'])
+
+        self.checkpoint.clear()
+        self.assertFalse(self.checkpoint.exists())
+
+    def test_is_due(self):
+        self.assertTrue(self.checkpoint.is_due(99, 100))
+        self.assertTrue(self.checkpoint.is_due(90, 110))
+        self.assertFalse(self.checkpoint.is_due(100, 199))
+
+
+class ImportIndexUpdaterTest(ResourceVersionModelBaseTest):
+    def test_records_versions_saved_while_started(self):
+        updater = ImportIndexUpdater(SourceVersion)
+        version = SourceVersion.get_head_of(self.source)
+        updater.start()
+        version.save()
+        updater.stop()
+        SourceVersion.get_head_of(self.source).save()
+        updater.add(SourceVersion, ['bulk'])
+        self.assertEquals(updater.version_ids[SourceVersion], set([version.id, 'bulk']))
+
+        restored = ImportIndexUpdater(SourceVersion)
+        restored.restore(json.loads(json.dumps(updater.get_state())))
+        self.assertEquals(restored.version_ids, updater.version_ids)
+
+
+class KeysetBatchesTest(OclApiBaseTestCase):
+    def test_batches_cover_queryset_in_id_order(self):
+        ids = [Organization.objects.create(name='org%d' % i, mnemonic='org%d' % i).id for i in range(5)]
+        batches = list(keyset_batches(Organization.objects.all(), 2))
+        self.assertEquals(map(len, batches), [2, 2, 1])
+        self.assertEquals([org.id for batch in batches for org in batch], sorted(ids))
+
+        resumed = list(keyset_batches(Organization.objects.all(), 2, after_id=batches[0][-1].id))
+        self.assertEquals([org.id for batch in resumed for org in batch], sorted(ids)[2:])
+
+
+class ReindexMarkerTest(OclApiBaseTestCase):
+    def setUp(self):
+        super(ReindexMarkerTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.marker = ReindexMarker(self.directory, 'concepts', 'source1')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(ReindexMarkerTest, self).tearDown()
+
+    def test_save_and_load(self):
+        self.assertIsNone(self.marker.load())
+        self.marker.save('concept1', 3)
+        self.assertEquals(self.marker.load(), {'last_id': 'concept1', 'num_indexed': 3, 'done': False})
+        self.marker.save('concept2', 5, done=True)
+        self.assertTrue(self.marker.load()['done'])
+        self.assertFalse(ReindexMarker(self.directory, 'mappings', 'source1').exists())
+
+        self.marker.clear()
+        self.assertFalse(self.marker.exists())
+
+    def test_finish_reindex_should_clear_markers_once_every_partition_is_done(self):
+        partitions = [('concepts', 'source1'), ('mappings', 'source1')]
+        self.marker.save('concept2', 5, done=True)
+        other = ReindexMarker(self.directory, 'mappings', 'source1')
+        other.save('mapping1', 2)
+        self.assertFalse(finish_reindex(partitions, self.directory))
+        self.assertTrue(self.marker.exists())
+
+        other.save('mapping2', 4, done=True)
+        self.assertTrue(finish_reindex(partitions, self.directory))
+        self.assertFalse(self.marker.exists())
+        self.assertFalse(other.exists())
+
+    def test_finish_run_should_clear_the_run_once_every_partition_is_done(self):
+        run_id = start_run([('concepts', 'source1')], self.directory)
+        self.assertEquals(ReindexRun(self.directory, run_id).load(), [('concepts', 'source1')])
+        self.assertFalse(finish_run(run_id, self.directory))
+
+        self.marker.save('concept2', 5, done=True)
+        self.assertTrue(finish_run(run_id, self.directory))
+        self.assertFalse(self.marker.exists())
+        self.assertIsNone(ReindexRun(self.directory, run_id).load())
+        self.assertFalse(finish_run(run_id, self.directory))
+
+
+class SearchIndexQueueTest(ResourceVersionModelBaseTest):
+    @mock.patch('oclapi.signals.update_all_in_index')
+    @mock.patch('oclapi.signals.haystack_connections')
+    def test_flush_updates_queued_objects_by_model(self, haystack_connections, update_all_in_index):
+        version_id = SourceVersion.get_head_of(self.source).id
+        queue = SearchIndexQueue(url='redis://localhost:6379/0', window=0)
+        queue.redis = mock.Mock()
+        queue.take = mock.Mock(side_effect=[
+            set(['sources.sourceversion.removed']),
+            set(['sources.sourceversion.%s' % version_id, 'sources.sourceversion.removed']),
+        ])
+
+        self.assertEquals(queue.flush(), 2)
+        queue.redis.delete.assert_called_once_with(SearchIndexQueue.SCHEDULED_KEY)
+        haystack_connections['default'].get_backend().remove.assert_called_once_with('sources.sourceversion.removed')
+        model, qs = update_all_in_index.call_args[0]
+        self.assertEquals(model, SourceVersion)
+        self.assertEquals([version.id for version in qs], [version_id])
+
+    @mock.patch('oclapi.signals.update_all_in_index')
+    @mock.patch('oclapi.signals.haystack_connections')
+    def test_failed_flush_should_queue_objects_again(self, haystack_connections, update_all_in_index):
+        version_id = SourceVersion.get_head_of(self.source).id
+        queue = SearchIndexQueue(url='redis://localhost:6379/0', window=0)
+        queue.redis = mock.Mock()
+        queue.take = mock.Mock(side_effect=[set(), set(['sources.sourceversion.%s' % version_id])])
+        queue.release = mock.Mock()
+        update_all_in_index.side_effect = IOError('Solr is down')
+
+        self.assertRaises(IOError, queue.flush)
+        queue.release.assert_any_call(SearchIndexQueue.UPDATE_KEY, set(['sources.sourceversion.%s' % version_id]))
+
+
+class IndexDigestTest(OclApiBaseTestCase):
+    def setUp(self):
+        super(IndexDigestTest, self).setUp()
+        IndexDigest.objects.all().delete()
+        self.backend = OCLSolrBackend('default', URL='http://localhost:8983/solr/collection1')
+        self.backend.conn = mock.Mock()
+        self.names = {'concepts.conceptversion.1': 'one', 'concepts.conceptversion.2': 'two'}
+        self.index = mock.Mock(spec=['full_prepare', 'get_digest', 'get_field_weights'])
+        self.index.full_prepare.side_effect = lambda identifier: {'id': identifier, 'name': self.names[identifier]}
+        self.index.get_digest.side_effect = content_digest
+
+    def sent_ids(self):
+        docs = self.backend.conn.add.call_args[0][0]
+        self.backend.conn.add.reset_mock()
+        return sorted(doc['id'] for doc in docs)
+
+    def test_update_should_skip_unchanged_documents(self):
+        self.backend.update(self.index, sorted(self.names.keys()))
+        self.assertEquals(self.sent_ids(), ['concepts.conceptversion.1', 'concepts.conceptversion.2'])
+
+        self.backend.update(self.index, sorted(self.names.keys()))
+        self.assertFalse(self.backend.conn.add.called)
+
+        self.names['concepts.conceptversion.2'] = 'changed'
+        self.backend.update(self.index, sorted(self.names.keys()))
+        self.assertEquals(self.sent_ids(), ['concepts.conceptversion.2'])
+
+        self.backend.remove('concepts.conceptversion.1')
+        self.backend.update(self.index, sorted(self.names.keys()))
+        self.assertEquals(self.sent_ids(), ['concepts.conceptversion.1'])
+
+        self.backend.update(self.index, sorted(self.names.keys()), force=True)
+        self.assertEquals(self.sent_ids(), ['concepts.conceptversion.1', 'concepts.conceptversion.2'])
+
+    def test_set_digests_should_keep_one_digest_per_document(self):
+        IndexDigest.set_digests({'concepts.conceptversion.1': 'a', 'concepts.conceptversion.2': 'b'})
+        IndexDigest.set_digests({'concepts.conceptversion.1': 'c'})
+
+        self.assertEquals(IndexDigest.objects.filter(identifier='concepts.conceptversion.1').count(), 1)
+        self.assertEquals(IndexDigest.get_digests(sorted(self.names.keys())),
+                          {'concepts.conceptversion.1': 'c', 'concepts.conceptversion.2': 'b'})
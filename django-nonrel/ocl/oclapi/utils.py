@@ -1,9 +1,12 @@
+import hashlib
 import json
 import os
 import tarfile
 import tempfile
 import gzip
 
+from collections import OrderedDict
+
 from boto.s3.key import Key
 from boto.s3.connection import S3Connection
 from haystack.utils import loading
@@ -233,18 +236,64 @@ def update_all_in_index(model, qs):
 
 
 def do_update(connection, backend, index, qs, batch_size=1000):
-    total = qs.count()
-    for start in range(0, total, batch_size):
-        end = min(start + batch_size, total)
+    for batch in keyset_batches(qs, batch_size):
+        backend.update(index, batch)
+
+        # Clear out the DB connections queries because it bloats up RAM.
+        connection.queries = []
+
 
+def keyset_batches(qs, batch_size, after_id=None):
+    """
+    Yields the objects of a queryset in lists of batch_size, ordered by id. Each batch starts after the last id of
+    the previous one, so that late batches are as fast as early ones, unlike offset slices which Mongo skips through.
+    """
+    while True:
         # Get a clone of the QuerySet so that the cache doesn't bloat up
         # in memory. Useful when reindexing large amounts of data.
-        small_cache_qs = qs.all()
-        current_qs = small_cache_qs[start:end]
-        backend.update(index, current_qs)
+        batch_qs = qs.all()
+        if after_id is not None:
+            batch_qs = batch_qs.filter(id__gt=after_id)
+        batch = list(batch_qs.order_by('id')[:batch_size])
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        after_id = batch[-1].id
 
-        # Clear out the DB connections queries because it bloats up RAM.
-        connection.queries = []
+
+def content_digest(content, cls=None):
+    return hashlib.sha1(json.dumps(content, sort_keys=True, separators=(',', ':'), cls=cls)).hexdigest()
+
+
+class LRUCache(object):
+    """
+    Dictionary-like cache which holds at most max_size entries, evicting the least recently used one first.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
 
 
 def compact(_list):
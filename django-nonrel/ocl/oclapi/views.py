@@ -9,7 +9,8 @@ from rest_framework.generics import RetrieveUpdateDestroyAPIView, ListAPIView
 from rest_framework.mixins import ListModelMixin, CreateModelMixin
 from rest_framework.response import Response
 from oclapi.mixins import PathWalkerMixin
-from oclapi.models import ResourceVersionModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, ACCESS_TYPE_NONE
+from oclapi.models import ResourceVersionModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, ACCESS_TYPE_NONE, \
+    RevisionConflictError
 from oclapi.permissions import HasPrivateAccess, CanEditConceptDictionary, CanViewConceptDictionary, HasOwnership
 from users.models import UserProfile
 
@@ -48,6 +49,7 @@ class BaseAPIView(generics.GenericAPIView):
     1. Adds a hook for a post-initialize step
     2. De-couples the lookup field name (in the URL) from the "filter by" field name (in the queryset)
     3. Performs a soft delete on destroy()
+    4. Answers 409 when a source or collection version was changed by another writer while the request was handled
     """
     pk_field = 'mnemonic'
     user_is_self = False
@@ -82,6 +84,11 @@ class BaseAPIView(generics.GenericAPIView):
         obj.save()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    def handle_exception(self, exc):
+        if isinstance(exc, RevisionConflictError):
+            return Response({'detail': str(exc)}, status=status.HTTP_409_CONFLICT)
+        return super(BaseAPIView, self).handle_exception(exc)
+
 
 class SubResourceMixin(BaseAPIView, PathWalkerMixin):
     """
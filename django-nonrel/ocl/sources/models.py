@@ -1,14 +1,18 @@
+import os
+
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.db import models
+from bson import ObjectId
+from django.db import connections, models
 from django.db.models import Max
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from djangotoolbox.fields import ListField, DictField
+from djangotoolbox.fields import DictField, ListField
 from oclapi.models import ConceptContainerModel, ConceptContainerVersionModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW
-from oclapi.utils import S3ConnectionFactory, get_class
+from oclapi.utils import S3ConnectionFactory, get_class, reverse_resource
 
 SOURCE_TYPE = 'Source'
 
@@ -44,6 +48,25 @@ class Source(ConceptContainerModel):
     def get_version_model(cls):
         return SourceVersion
 
+    @classmethod
+    def persist_changes(cls, obj, updated_by, **kwargs):
+        # Validating every concept against a new schema can take longer than a request,
+        # so the schema is only applied by a schema validation job once all of them pass
+        requested_schema = None
+        stored_schema = Source.objects.get(id=obj.id).custom_validation_schema
+        # The stored schema only changes once a job applies it, so a request for the stored schema, None included,
+        # is a change as well. Unfinished jobs must not apply their schema over it.
+        if getattr(obj, 'schema_requested', False) or obj.custom_validation_schema != stored_schema:
+            SchemaValidationJob.supersede_pending(obj.id)
+        if cls.validation_is_necessary(obj):
+            requested_schema = obj.custom_validation_schema
+            obj.custom_validation_schema = stored_schema
+        errors = super(Source, cls).persist_changes(obj, updated_by, **kwargs)
+        if requested_schema and not errors:
+            obj.schema_validation_job = SchemaValidationJob.objects.create(
+                source=obj, custom_validation_schema=requested_schema, created_by=updated_by.username)
+        return errors
+
     @staticmethod
     def get_url_kwarg():
         return 'source'
@@ -55,8 +78,6 @@ SOURCE_VERSION_TYPE = 'Source Version'
 class SourceVersion(ConceptContainerVersionModel):
     source_type = models.TextField(blank=True)
     custom_validation_schema = models.TextField(blank=True, null=True)
-    concepts = ListField()
-    mappings = ListField()
     retired = models.BooleanField(default=False)
     active_concepts = models.IntegerField(default=0)
     active_mappings = models.IntegerField(default=0)
@@ -64,32 +85,16 @@ class SourceVersion(ConceptContainerVersionModel):
     source_snapshot = DictField(null=True, blank=True)
 
     def update_concept_version(self, concept_version):
-        previous_version = concept_version.previous_version
-        save_previous_version = False
-        if previous_version and previous_version.id in self.concepts:
-            save_previous_version = True
-            index = self.concepts.index(previous_version.id)
-            self.concepts[index] = concept_version.id
-        else:
-            self.concepts.append(concept_version.id)
-        self.save()
+        save_previous_version = self.update_member_version('concepts', concept_version)
         concept_version.save()
         if save_previous_version:
-            previous_version.save()
+            concept_version.previous_version.save()
 
     def update_mapping_version(self, mapping_version):
-        previous_version = mapping_version.previous_version
-        save_previous_version = False
-        if previous_version and previous_version.id in self.mappings:
-            save_previous_version = True
-            index = self.mappings.index(previous_version.id)
-            self.mappings[index] = mapping_version.id
-        else:
-            self.mappings.append(mapping_version.id)
-        self.save()
+        save_previous_version = self.update_member_version('mappings', mapping_version)
         mapping_version.save()
         if save_previous_version:
-            previous_version.save()
+            mapping_version.previous_version.save()
 
 
     def seed_concepts(self):
@@ -210,6 +215,213 @@ class SourceVersion(ConceptContainerVersionModel):
 
         )
 
+IMPORT_TYPE_CONCEPTS = 'concepts'
+IMPORT_TYPE_MAPPINGS = 'mappings'
+IMPORT_TYPE_CHOICES = ((IMPORT_TYPE_CONCEPTS, 'Concepts'), (IMPORT_TYPE_MAPPINGS, 'Mappings'))
+
+IMPORT_JOB_PENDING = 'PENDING'
+IMPORT_JOB_STARTED = 'STARTED'
+IMPORT_JOB_SUCCESS = 'SUCCESS'
+IMPORT_JOB_FAILURE = 'FAILURE'
+
+
+class ImportJob(models.Model):
+    """
+    An import of a JSON lines file into a source, run by a Celery worker. The uploaded file, the output of the
+    importer and the validation error report are spooled to IMPORT_SPOOL_DIR, which the workers have to share.
+    """
+    source = models.ForeignKey(Source, related_name='import_jobs')
+    import_type = models.TextField(choices=IMPORT_TYPE_CHOICES)
+    status = models.TextField(default=IMPORT_JOB_PENDING)
+    created_by = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    options = DictField(null=True, blank=True)
+    file_size = models.IntegerField(default=0)
+    position = models.IntegerField(default=0)
+    lines_handled = models.IntegerField(default=0)
+    action_count = DictField(null=True, blank=True)
+    message = models.TextField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    @property
+    def spool_dir(self):
+        return os.path.join(settings.IMPORT_SPOOL_DIR, self.id)
+
+    @property
+    def input_file_name(self):
+        return os.path.join(self.spool_dir, 'input.json')
+
+    @property
+    def checkpoint_file_name(self):
+        return os.path.join(self.spool_dir, 'input.json.checkpoint')
+
+    @property
+    def output_file_name(self):
+        return os.path.join(self.spool_dir, 'output.log')
+
+    @property
+    def error_file_name(self):
+        return os.path.join(self.spool_dir, 'errors.log')
+
+    @property
+    def validation_report_file_name(self):
+        return os.path.join(self.spool_dir, 'validation_errors.csv')
+
+    @property
+    def is_finished(self):
+        return self.status in [IMPORT_JOB_SUCCESS, IMPORT_JOB_FAILURE]
+
+    @property
+    def progress(self):
+        """ Share of the uploaded file that was handled, as of the last checkpoint """
+        if self.status == IMPORT_JOB_SUCCESS:
+            return 1.0
+        if not self.file_size:
+            return 0.0
+        return min(1.0, float(self.position) / self.file_size)
+
+    @property
+    def url(self):
+        return reverse_resource(self.source, 'source-import-detail', kwargs={'job': self.id})
+
+    @property
+    def errors_url(self):
+        return reverse_resource(self.source, 'source-import-errors', kwargs={'job': self.id})
+
+    @property
+    def validation_report_url(self):
+        if self.import_type != IMPORT_TYPE_CONCEPTS:
+            return None
+        return reverse_resource(self.source, 'source-import-validation-report', kwargs={'job': self.id})
+
+
+class SchemaValidationJob(models.Model):
+    """
+    Validation of the concepts of a source against a custom validation schema requested for it.
+    Celery workers validate the concepts in chunks, and the last chunk to finish applies the schema if all passed.
+    """
+    CHUNK_SIZE = 1000
+
+    source = models.ForeignKey(Source, related_name='schema_validation_jobs')
+    custom_validation_schema = models.TextField()
+    status = models.TextField(default=IMPORT_JOB_PENDING)
+    created_by = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    num_concepts = models.IntegerField(default=0)
+    num_chunks = models.IntegerField(default=0)
+    # Indexes of the chunks validated so far, a set so that a chunk delivered twice is counted once
+    done_chunks = ListField(models.IntegerField())
+    num_failed = models.IntegerField(default=0)
+    message = models.TextField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    @property
+    def is_finished(self):
+        return self.status in [IMPORT_JOB_SUCCESS, IMPORT_JOB_FAILURE]
+
+    @property
+    def chunks_done(self):
+        return len(set(self.done_chunks or []))
+
+    @property
+    def progress(self):
+        if self.is_finished:
+            return 1.0
+        if not self.num_chunks:
+            return 0.0
+        return float(self.chunks_done) / self.num_chunks
+
+    @property
+    def failures(self):
+        return SchemaValidationFailure.objects.filter(job_id=self.id)
+
+    @property
+    def url(self):
+        return reverse_resource(self.source, 'source-schema-validation-detail', kwargs={'job': self.id})
+
+    @property
+    def failures_url(self):
+        return reverse_resource(self.source, 'source-schema-validation-failures', kwargs={'job': self.id})
+
+    def split(self, chunk_size=None):
+        """ Returns the IDs of the concepts to validate in chunks, and marks the job as started """
+        from concepts.models import Concept
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        concept_ids = list(Concept.objects.filter(
+            parent_id=self.source_id, is_active=True, retired=False).values_list('id', flat=True))
+        chunks = [concept_ids[i:i + chunk_size] for i in range(0, len(concept_ids), chunk_size)]
+        self.num_concepts = len(concept_ids)
+        self.num_chunks = len(chunks)
+        self.status = IMPORT_JOB_STARTED
+        # Does not revive a job that was superseded in the meantime
+        SchemaValidationJob.objects.filter(id=self.id, status=IMPORT_JOB_PENDING).update(
+            num_concepts=self.num_concepts, num_chunks=self.num_chunks, status=self.status)
+        return chunks
+
+    def validate_chunk(self, chunk_index, concept_ids):
+        """
+        Records the concepts of the chunk that fail validation. Returns True if it was the last chunk to finish, which
+        is the case for one call only, even if a chunk is delivered again.
+        """
+        from concepts.models import Concept
+        source = self.source
+        source.custom_validation_schema = self.custom_validation_schema
+        concepts = list(Concept.objects.filter(id__in=concept_ids))
+        failures = [SchemaValidationFailure(job_id=self.id, **failure)
+                    for failure in Source.validate_child_concepts(source, concepts)]
+        # A chunk delivered again replaces the failures it recorded the first time
+        SchemaValidationFailure.objects.filter(
+            job_id=self.id, mnemonic__in=[concept.mnemonic for concept in concepts]).delete()
+        if failures:
+            SchemaValidationFailure.objects.bulk_create(failures)
+
+        # Chunks finish in any order across workers, so the chunk is added atomically, and the job as it was
+        # before tells whether this call completed it
+        collection = connections[SchemaValidationJob.objects.db].get_collection(SchemaValidationJob._meta.db_table)
+        job = collection.find_and_modify({'_id': ObjectId(self.id)}, {'$addToSet': {'done_chunks': chunk_index}})
+        done_chunks = set(job.get('done_chunks') or [])
+        return chunk_index not in done_chunks and len(done_chunks) + 1 >= job['num_chunks']
+
+    @classmethod
+    def supersede_pending(cls, source_id):
+        """ Fails the unfinished jobs of a source, whose schema was changed after they were requested """
+        cls.objects.filter(source_id=source_id, status__in=[IMPORT_JOB_PENDING, IMPORT_JOB_STARTED]).update(
+            status=IMPORT_JOB_FAILURE, message='Superseded by a later change of the validation schema.')
+
+    def finish(self):
+        """ Applies the schema to the source if all concepts passed, unless a later change superseded this job """
+        unfinished = SchemaValidationJob.objects.filter(id=self.id, status__in=[IMPORT_JOB_PENDING, IMPORT_JOB_STARTED])
+        num_failed = self.failures.count()
+        if num_failed:
+            message = '%d of %d concepts failed validation against the %s schema.' % (
+                num_failed, self.num_concepts, self.custom_validation_schema)
+            unfinished.update(status=IMPORT_JOB_FAILURE, message=message, num_failed=num_failed)
+        else:
+            # Source.persist_changes supersedes the job before it saves another schema, in which case the job is no
+            # longer unfinished and its schema is not applied
+            message = 'Applied the %s schema.' % self.custom_validation_schema
+            if unfinished.update(status=IMPORT_JOB_SUCCESS, message=message):
+                Source.objects.filter(id=self.source_id).update(custom_validation_schema=self.custom_validation_schema)
+                SourceVersion.objects.filter(versioned_object_id=self.source_id, mnemonic=HEAD).update(
+                    custom_validation_schema=self.custom_validation_schema)
+        stored = SchemaValidationJob.objects.get(id=self.id)
+        self.status, self.message, self.num_failed = stored.status, stored.message, stored.num_failed
+
+
+class SchemaValidationFailure(models.Model):
+    """ A concept that failed validation in a schema validation job """
+    job_id = models.TextField(db_index=True)
+    mnemonic = models.TextField()
+    url = models.TextField()
+    errors = DictField()
+
+
 @receiver(post_save)
 def propagate_owner_status(sender, instance=None, created=False, **kwargs):
     if created:
@@ -6,9 +6,9 @@ from mappings.models import Mapping
 from oclapi.fields import HyperlinkedResourceVersionIdentityField
 from oclapi.models import NAMESPACE_REGEX
 from oclapi.serializers import ResourceVersionSerializer
-from sources.models import Source, SourceVersion
+from sources.models import Source, SourceVersion, ImportJob, SchemaValidationJob, SchemaValidationFailure
 from oclapi.models import ACCESS_TYPE_CHOICES, DEFAULT_ACCESS_TYPE
-from tasks import update_children_for_resource_version
+from tasks import update_children_for_resource_version, validate_source_schema
 from oclapi.settings.common import Common
 from django.db import transaction
 
@@ -38,6 +38,7 @@ class SourceCreateOrUpdateSerializer(serializers.Serializer):
         source.description = attrs.get('description', source.description)
         source.source_type = attrs.get('source_type', source.source_type)
         source.custom_validation_schema = attrs.get('custom_validation_schema', source.custom_validation_schema)
+        source.schema_requested = 'custom_validation_schema' in attrs
         source.public_access = attrs.get('public_access', source.public_access or DEFAULT_ACCESS_TYPE)
         source.default_locale = attrs.get('default_locale', source.default_locale or Common.DEFAULT_LOCALE)
         source.website = attrs.get('website', source.website)
@@ -128,9 +129,15 @@ class SourceDetailSerializer(SourceCreateOrUpdateSerializer):
         if errors:
             self._errors.update(errors)
         else:
-            head_obj = obj.get_head();
-            head_obj.update_version_data(obj)
-            head_obj.save();
+            head_obj = obj.get_head()
+
+            def write():
+                head_obj.update_version_data(obj)
+                head_obj.save()
+            head_obj.retry_on_conflict(write)
+            job = getattr(obj, 'schema_validation_job', None)
+            if job:
+                validate_source_schema.delay(job.id)
 
 
 
@@ -288,3 +295,51 @@ class SourceVersionCreateSerializer(SourceVersionCreateOrUpdateSerializer):
                 self._errors.update(errors)
             else:
                 update_children_for_resource_version.delay(obj.id, 'source')
+
+
+class ImportJobSerializer(serializers.Serializer):
+    id = serializers.CharField(read_only=True)
+    type = serializers.CharField(source='import_type', read_only=True)
+    status = serializers.CharField(read_only=True)
+    progress = serializers.FloatField(read_only=True)
+    lines_handled = serializers.IntegerField(read_only=True)
+    file_size = serializers.IntegerField(read_only=True)
+    action_count = serializers.WritableField(read_only=True)
+    options = serializers.WritableField(read_only=True)
+    message = serializers.CharField(read_only=True)
+    created_by = serializers.CharField(read_only=True)
+    created_on = serializers.DateTimeField(source='created_at', read_only=True)
+    updated_on = serializers.DateTimeField(source='updated_at', read_only=True)
+    url = serializers.CharField(read_only=True)
+    errors_url = serializers.CharField(read_only=True)
+    validation_report_url = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = ImportJob
+
+
+class SchemaValidationJobSerializer(serializers.Serializer):
+    id = serializers.CharField(read_only=True)
+    custom_validation_schema = serializers.CharField(read_only=True)
+    status = serializers.CharField(read_only=True)
+    progress = serializers.FloatField(read_only=True)
+    num_concepts = serializers.IntegerField(read_only=True)
+    num_failed = serializers.IntegerField(read_only=True)
+    message = serializers.CharField(read_only=True)
+    created_by = serializers.CharField(read_only=True)
+    created_on = serializers.DateTimeField(source='created_at', read_only=True)
+    updated_on = serializers.DateTimeField(source='updated_at', read_only=True)
+    url = serializers.CharField(read_only=True)
+    failures_url = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = SchemaValidationJob
+
+
+class SchemaValidationFailureSerializer(serializers.Serializer):
+    mnemonic = serializers.CharField(read_only=True)
+    url = serializers.CharField(read_only=True)
+    errors = serializers.WritableField(read_only=True)
+
+    class Meta:
+        model = SchemaValidationFailure
@@ -16,9 +16,9 @@ from concepts.models import Concept, LocalizedText
 from concepts.validation_messages import OPENMRS_SHORT_NAME_CANNOT_BE_PREFERRED
 from concepts.validators import message_with_name_details
 from oclapi.models import ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, LOOKUP_SOURCES
-from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
+from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS, VersionMembership, RevisionConflictError
 from orgs.models import Organization
-from sources.models import Source, SourceVersion
+from sources.models import Source, SourceVersion, SchemaValidationJob, IMPORT_JOB_FAILURE, IMPORT_JOB_SUCCESS
 from test_helper.base import OclApiBaseTestCase, create_concept, create_source, create_user, create_localized_text
 from users.models import UserProfile
 
@@ -682,6 +682,75 @@ class SourceVersionTest(SourceBaseTest):
 
         self.assertEquals(source_version2.concepts, self.source1.get_head().concepts)
 
+    def test_concepts_are_stored_as_version_memberships(self):
+        source_version = SourceVersion(name='version1', mnemonic='version1', versioned_object=self.source1,
+                                       concepts=['a', 'b'], created_by=self.user1, updated_by=self.user1)
+        source_version.full_clean()
+        source_version.save()
+        memberships = VersionMembership.objects.filter(container_version_id=source_version.id, attribute='concepts')
+        self.assertEquals(['a', 'b'], list(memberships.order_by('id').values_list('resource_version_id', flat=True)))
+
+        source_version = SourceVersion.objects.get(id=source_version.id)
+        self.assertTrue(source_version.concepts.replace('a', 'c'))
+        self.assertFalse(source_version.concepts.replace('x', 'y'))
+        source_version.concepts.append('d')
+        source_version.save()
+
+        source_version = SourceVersion.objects.get(id=source_version.id)
+        self.assertTrue('b' in source_version.concepts)
+        self.assertFalse('a' in source_version.concepts)
+        self.assertEquals(['c', 'b', 'd'], source_version.concepts)
+        self.assertEquals([], source_version.mappings)
+
+        source_version.delete()
+        self.assertFalse(memberships.exists())
+
+    def test_save_of_stale_version_should_raise_revision_conflict(self):
+        source_version = SourceVersion(name='version1', mnemonic='version1', versioned_object=self.source1,
+                                       created_by=self.user1, updated_by=self.user1)
+        source_version.full_clean()
+        source_version.save()
+
+        stale_version = SourceVersion.objects.get(id=source_version.id)
+        source_version.description = 'first'
+        source_version.save()
+        stale_version.description = 'second'
+
+        with self.assertRaises(RevisionConflictError):
+            stale_version.save()
+        self.assertEquals('first', SourceVersion.objects.get(id=source_version.id).description)
+        self.assertEquals(1, SourceVersion.objects.get(id=source_version.id).revision)
+
+    def test_processing_flag_should_not_conflict_with_saves(self):
+        source_version = SourceVersion(name='version1', mnemonic='version1', versioned_object=self.source1,
+                                       created_by=self.user1, updated_by=self.user1)
+        source_version.full_clean()
+        source_version.save()
+
+        processing_version = SourceVersion.objects.get(id=source_version.id)
+        processing_version.set_processing(True)
+        source_version.description = 'changed'
+        source_version.save()
+        processing_version.set_processing(False)
+
+        stored_version = SourceVersion.objects.get(id=source_version.id)
+        self.assertEquals('changed', stored_version.description)
+        self.assertFalse(stored_version._ocl_processing)
+
+    def test_membership_change_of_stale_version_should_be_retried(self):
+        source_version = SourceVersion(name='version1', mnemonic='version1', versioned_object=self.source1,
+                                       concepts=['a'], created_by=self.user1, updated_by=self.user1)
+        source_version.full_clean()
+        source_version.save()
+
+        stale_version = SourceVersion.objects.get(id=source_version.id)
+        source_version.add_members('concepts', ['b'])
+        stale_version.add_members('concepts', ['c'])
+
+        source_version = SourceVersion.objects.get(id=source_version.id)
+        self.assertEquals(['a', 'b', 'c'], source_version.concepts)
+        self.assertEquals(2, source_version.revision)
+
     def test_head_sibling(self):
         source_version1 = SourceVersion(
             name='head',
@@ -1274,6 +1343,14 @@ class SourceVersionListViewTest(SourceBaseTest):
         self.assertEquals(content[0]['id'], 'HEAD')
 
 
+def run_schema_validation(job, chunk_size=1):
+    """ Runs the chunks of a schema validation job in turn, as the Celery workers would """
+    for chunk_index, concept_ids in enumerate(job.split(chunk_size)):
+        if job.validate_chunk(chunk_index, concept_ids):
+            job.finish()
+    return SchemaValidationJob.objects.get(id=job.id)
+
+
 class SourceChangeSchemaTest(SourceBaseTest):
 
     def test_changing_schema_to_openmrs_should_fail_given_duplicate_preferred_names(self):
@@ -1287,8 +1364,12 @@ class SourceChangeSchemaTest(SourceBaseTest):
         source.custom_validation_schema = CUSTOM_VALIDATION_SCHEMA_OPENMRS
 
         errors = Source.persist_changes(source, user)
+        self.assertEquals(len(errors), 0)
 
-        self.assertGreater(len(errors), 0)
+        job = run_schema_validation(source.schema_validation_job)
+
+        self.assertEquals(IMPORT_JOB_FAILURE, job.status)
+        self.assertIsNone(Source.objects.get(id=source.id).custom_validation_schema)
 
     def test_changing_schema_to_none_should_always_pass(self):
         user = create_user()
@@ -1305,6 +1386,27 @@ class SourceChangeSchemaTest(SourceBaseTest):
 
         self.assertEquals(len(errors), 0)
 
+    def test_changing_schema_to_openmrs_should_apply_schema_once_concepts_pass(self):
+        user = create_user()
+        source = create_source(user=user)
+
+        create_concept(user, source=source, mnemonic='Concept1',
+                       names=[create_localized_text('name 1', locale_preferred=True)])
+        create_concept(user, source=source, mnemonic='Concept2',
+                       names=[create_localized_text('name 2', locale_preferred=True)])
+
+        source.custom_validation_schema = CUSTOM_VALIDATION_SCHEMA_OPENMRS
+        Source.persist_changes(source, user)
+
+        self.assertIsNone(Source.objects.get(id=source.id).custom_validation_schema)
+
+        job = run_schema_validation(source.schema_validation_job)
+
+        self.assertEquals(IMPORT_JOB_SUCCESS, job.status)
+        self.assertEquals(2, job.num_concepts)
+        self.assertEquals(CUSTOM_VALIDATION_SCHEMA_OPENMRS, Source.objects.get(id=source.id).custom_validation_schema)
+        self.assertEquals(CUSTOM_VALIDATION_SCHEMA_OPENMRS, source.get_head().custom_validation_schema)
+
     def test_should_list_errors_under_failed_validations_field_on_fail(self):
         user = create_user()
         source = create_source(user=user)
@@ -1315,10 +1417,54 @@ class SourceChangeSchemaTest(SourceBaseTest):
 
         source.custom_validation_schema = CUSTOM_VALIDATION_SCHEMA_OPENMRS
 
-        errors = Source.persist_changes(source, user)
+        Source.persist_changes(source, user)
+        job = run_schema_validation(source.schema_validation_job)
+
+        self.assertEquals(job.num_failed, 2)
+        self.assertEquals(job.failures.count(), 2)
+
+    def test_chunk_delivered_twice_should_be_counted_once(self):
+        user = create_user()
+        source = create_source(user=user)
+
+        non_unique_preferred_name = create_localized_text('Non Unique Preferred Name', locale_preferred=True)
+        create_concept(user, source=source, mnemonic='Concept1', names=[non_unique_preferred_name])
+        create_concept(user, source=source, mnemonic='Concept2', names=[non_unique_preferred_name])
 
-        self.assertTrue('failed_concept_validations' in errors)
-        self.assertEquals(len(errors['failed_concept_validations']), 2)
+        source.custom_validation_schema = CUSTOM_VALIDATION_SCHEMA_OPENMRS
+        Source.persist_changes(source, user)
+        job = source.schema_validation_job
+        chunks = job.split(1)
+
+        self.assertFalse(job.validate_chunk(0, chunks[0]))
+        self.assertFalse(job.validate_chunk(0, chunks[0]))
+        self.assertTrue(job.validate_chunk(1, chunks[1]))
+        self.assertFalse(job.validate_chunk(1, chunks[1]))
+        job.finish()
+
+        self.assertEquals(job.num_failed, 2)
+        self.assertEquals(job.failures.count(), 2)
+
+    def test_changing_schema_to_none_should_supersede_pending_job(self):
+        user = create_user()
+        source = create_source(user=user)
+
+        create_concept(user, source=source, mnemonic='Concept1',
+                       names=[create_localized_text('name 1', locale_preferred=True)])
+
+        source.custom_validation_schema = CUSTOM_VALIDATION_SCHEMA_OPENMRS
+        Source.persist_changes(source, user)
+        job = source.schema_validation_job
+
+        source.custom_validation_schema = None
+        source.schema_requested = True
+        Source.persist_changes(source, user)
+        self.assertEquals(IMPORT_JOB_FAILURE, SchemaValidationJob.objects.get(id=job.id).status)
+
+        job.finish()
+
+        self.assertEquals(IMPORT_JOB_FAILURE, job.status)
+        self.assertIsNone(Source.objects.get(id=source.id).custom_validation_schema)
 
     def test_concept_validation_error_should_include_concept_mnemonic_url_error(self):
         user = create_user()
@@ -1329,12 +1475,13 @@ class SourceChangeSchemaTest(SourceBaseTest):
 
         source.custom_validation_schema = CUSTOM_VALIDATION_SCHEMA_OPENMRS
 
-        errors = Source.persist_changes(source, user)
+        Source.persist_changes(source, user)
+        job = run_schema_validation(source.schema_validation_job)
 
-        self.assertTrue('failed_concept_validations' in errors)
-        self.assertEquals(len(errors['failed_concept_validations']), 1)
+        self.assertEquals(job.failures.count(), 1)
 
-        validation_error = errors['failed_concept_validations'][0]
+        failure = job.failures[0]
+        validation_error = {'mnemonic': failure.mnemonic, 'url': failure.url, 'errors': failure.errors}
 
         expected_errors = {
                 'mnemonic': 'Concept1',
@@ -1,6 +1,6 @@
 from django.conf.urls import patterns, url, include
 from sources.feeds import SourceFeed
-from sources.views import SourceListView, SourceRetrieveUpdateDestroyView, SourceVersionRetrieveUpdateView, SourceVersionChildListView, SourceVersionListView, SourceVersionRetrieveUpdateDestroyView, SourceExtrasView, SourceExtraRetrieveUpdateDestroyView, SourceVersionExportView
+from sources.views import SourceListView, SourceRetrieveUpdateDestroyView, SourceVersionRetrieveUpdateView, SourceVersionChildListView, SourceVersionListView, SourceVersionRetrieveUpdateDestroyView, SourceExtrasView, SourceExtraRetrieveUpdateDestroyView, SourceVersionExportView, SourceImportJobListView, SourceImportJobRetrieveView, SourceImportJobErrorsView, SourceImportJobValidationReportView, SourceBulkConceptsView, SourceBulkActionView, SourceSchemaValidationJobListView, SourceSchemaValidationJobRetrieveView, SourceSchemaValidationFailureListView
 
 __author__ = 'misternando'
 
@@ -14,6 +14,15 @@ urlpatterns = patterns('',
     url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/mappings/', include('mappings.urls')),
     url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/extras/$', SourceExtrasView.as_view(), name='source-extras'),
     url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/extras/(?P<extra>[_a-zA-Z0-9\-\.]+)/$', SourceExtraRetrieveUpdateDestroyView.as_view(), name='source-extra'),
+    url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/import/$', SourceImportJobListView.as_view(), name='source-import-list'),
+    url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/import/(?P<job>[a-f0-9]+)/$', SourceImportJobRetrieveView.as_view(), name='source-import-detail'),
+    url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/import/(?P<job>[a-f0-9]+)/errors/$', SourceImportJobErrorsView.as_view(), name='source-import-errors'),
+    url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/import/(?P<job>[a-f0-9]+)/validation_errors/$', SourceImportJobValidationReportView.as_view(), name='source-import-validation-report'),
+    url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/bulk_concepts/$', SourceBulkConceptsView.as_view(), name='source-bulk-concepts'),
+    url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/bulk_actions/$', SourceBulkActionView.as_view(), name='source-bulk-actions'),
+    url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/schema_validations/$', SourceSchemaValidationJobListView.as_view(), name='source-schema-validation-list'),
+    url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/schema_validations/(?P<job>[a-f0-9]+)/$', SourceSchemaValidationJobRetrieveView.as_view(), name='source-schema-validation-detail'),
+    url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/schema_validations/(?P<job>[a-f0-9]+)/failures/$', SourceSchemaValidationFailureListView.as_view(), name='source-schema-validation-failures'),
     url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/(?P<version>[a-zA-Z0-9\-\.]+)/$', SourceVersionRetrieveUpdateDestroyView.as_view(), name='sourceversion-detail'),
     url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/(?P<version>[a-zA-Z0-9\-\.]+)/children/$', SourceVersionChildListView.as_view(), {'list_children': True}, name='sourceversion-child-list'),
     url(r'^(?P<source>[a-zA-Z0-9\-\.]+)/(?P<version>[a-zA-Z0-9\-\.]+)/export/$', SourceVersionExportView.as_view(), name='sourceversion-export'),
@@ -1,14 +1,20 @@
+import json
 import logging
+import os
+from StringIO import StringIO
 
+from bson import ObjectId
 from django.conf import settings
+from django.core.management.base import OutputWrapper
 from django.db import IntegrityError
 from django.db.models import Q
 from django.db.models.query import EmptyQuerySet
-from django.http import HttpResponse, HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseForbidden, StreamingHttpResponse
 from rest_framework import mixins, status
-from rest_framework.generics import RetrieveAPIView, UpdateAPIView, get_object_or_404, DestroyAPIView
+from rest_framework.generics import RetrieveAPIView, UpdateAPIView, get_object_or_404, DestroyAPIView, ListAPIView
 from django.shortcuts import get_list_or_404
 from rest_framework.response import Response
+from concepts.importer import ConceptsImporter
 from concepts.models import ConceptVersion, Concept
 from mappings.models import Mapping
 from collection.models import CollectionVersion
@@ -16,18 +22,26 @@ from concepts.serializers import ConceptVersionDetailSerializer
 from mappings.models import MappingVersion
 from mappings.serializers import MappingVersionDetailSerializer
 from oclapi.mixins import ListWithHeadersMixin
+from oclapi.models import VersionMembership
 from oclapi.permissions import HasAccessToVersionedObject, CanEditConceptDictionaryVersion, CanViewConceptDictionary, CanViewConceptDictionaryVersion, CanEditConceptDictionary
-from oclapi.views import ResourceVersionMixin, ResourceAttributeChildMixin, ConceptDictionaryUpdateMixin, ConceptDictionaryCreateMixin, ConceptDictionaryExtrasView, ConceptDictionaryExtraRetrieveUpdateDestroyView, parse_updated_since_param, parse_boolean_query_param
+from oclapi.views import SubResourceMixin, ResourceVersionMixin, ResourceAttributeChildMixin, ConceptDictionaryUpdateMixin, ConceptDictionaryCreateMixin, ConceptDictionaryExtrasView, ConceptDictionaryExtraRetrieveUpdateDestroyView, parse_updated_since_param, parse_boolean_query_param
 from sources.filters import SourceSearchFilter
-from sources.models import Source, SourceVersion
-from sources.serializers import SourceCreateSerializer, SourceListSerializer, SourceDetailSerializer, SourceVersionDetailSerializer, SourceVersionListSerializer, SourceVersionCreateSerializer, SourceVersionUpdateSerializer
-from tasks import export_source
+from sources.models import Source, SourceVersion, ImportJob, SchemaValidationJob, IMPORT_TYPE_CONCEPTS, IMPORT_TYPE_MAPPINGS
+from sources.serializers import SourceCreateSerializer, SourceListSerializer, SourceDetailSerializer, SourceVersionDetailSerializer, SourceVersionListSerializer, SourceVersionCreateSerializer, SourceVersionUpdateSerializer, ImportJobSerializer, SchemaValidationJobSerializer, SchemaValidationFailureSerializer
+from tasks import export_source, import_source_file
 from celery_once import AlreadyQueued
 from users.models import UserProfile
 from orgs.models import Organization
 from django.db.models import Q
 
 INCLUDE_CONCEPTS_PARAM = 'includeConcepts'
+IMPORT_TYPE_PARAM = 'type'
+UPLOAD_BLOCK_SIZE = 64 * 1024
+BULK_CONCEPTS_LIMIT = 10000
+BULK_ACTION_RETIRE = 'retire'
+BULK_ACTION_UNRETIRE = 'unretire'
+BULK_ACTION_DEACTIVATE = 'deactivate'
+BULK_ACTIONS = [BULK_ACTION_RETIRE, BULK_ACTION_UNRETIRE, BULK_ACTION_DEACTIVATE]
 INCLUDE_MAPPINGS_PARAM = 'includeMappings'
 LIMIT_PARAM = 'limit'
 INCLUDE_RETIRED_PARAM = 'includeRetired'
@@ -112,6 +126,16 @@ class SourceRetrieveUpdateDestroyView(SourceBaseView,
 
         return Response(data)
 
+    def update(self, request, *args, **kwargs):
+        response = super(SourceRetrieveUpdateDestroyView, self).update(request, *args, **kwargs)
+        job = getattr(self.object, 'schema_validation_job', None)
+        if job and response.status_code == status.HTTP_200_OK:
+            # The requested schema is applied once the concepts of the source pass validation against it
+            response.data['schema_validation_job'] = SchemaValidationJobSerializer(job).data
+            response.status_code = status.HTTP_202_ACCEPTED
+            response['Location'] = job.url
+        return response
+
     def destroy(self, request, *args, **kwargs):
         resource_used_message = '''This source cannot be deleted because others have created mapping or references that point to it.
         To delete this source, you must first delete all linked mappings and references and try again.'''
@@ -138,14 +162,14 @@ class SourceRetrieveUpdateDestroyView(SourceBaseView,
 
         # Check if concepts from this source are in any collection
         collections = CollectionVersion.objects.filter(
-            Q(concepts__in=concept_version_ids) | Q(concepts__in=concept_ids)
+            id__in=VersionMembership.container_version_ids('concepts', concept_version_ids + concept_ids)
         )
         if collections:
             return Response({'detail': resource_used_message}, status=status.HTTP_400_BAD_REQUEST)
 
         # Check if mappings from this source are in any collection
         collections = CollectionVersion.objects.filter(
-            Q(mappings__in=mapping_version_ids) | Q(mappings__in=mapping_ids)
+            id__in=VersionMembership.container_version_ids('mappings', mapping_version_ids + mapping_ids)
         )
         if collections:
             return Response({'detail': resource_used_message}, status=status.HTTP_400_BAD_REQUEST)
@@ -447,3 +471,215 @@ class SourceVersionExportView(ResourceAttributeChildMixin):
         except AlreadyQueued:
             return 409
 
+
+class SourceImportJobMixin(SubResourceMixin):
+    """ Base view of the import jobs of a source, which only users that can edit the source have access to """
+    permission_classes = (CanEditConceptDictionary,)
+    serializer_class = ImportJobSerializer
+    levels = 1
+
+    def initialize(self, request, path_info_segment, **kwargs):
+        self.parent_path_info = self.get_parent_in_path(path_info_segment, levels=self.levels)
+        self.parent_resource = self.get_object_for_path(self.parent_path_info, self.request)
+        self.check_object_permissions(request, self.parent_resource)
+
+    def get_queryset(self):
+        return ImportJob.objects.filter(source_id=self.parent_resource.id)
+
+    def get_job(self):
+        return get_object_or_404(self.get_queryset(), id=self.kwargs.get('job'))
+
+
+class SourceImportJobListView(SourceImportJobMixin, ListAPIView):
+
+    def post(self, request, *args, **kwargs):
+        import_type = request.QUERY_PARAMS.get(IMPORT_TYPE_PARAM)
+        if import_type not in [IMPORT_TYPE_CONCEPTS, IMPORT_TYPE_MAPPINGS]:
+            return Response({IMPORT_TYPE_PARAM: ['Must be one of: %s, %s.' % (IMPORT_TYPE_CONCEPTS, IMPORT_TYPE_MAPPINGS)]},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        job = ImportJob(source=self.parent_resource, import_type=import_type, created_by=request.user.username,
+                        options=self.get_import_options(request))
+        job.save()
+        job.file_size = self.spool_upload(request, job)
+        if not job.file_size:
+            job.delete()
+            return Response({'detail': 'Must upload a JSON lines file.'}, status=status.HTTP_400_BAD_REQUEST)
+        job.save()
+
+        import_source_file.delay(job.id)
+        serializer = self.get_serializer(job)
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED, headers={'Location': job.url})
+
+    def get_import_options(self, request):
+        options = {
+            'test_mode': parse_boolean_query_param(request, 'test', 'false') or False,
+            'deactivate_old_records': parse_boolean_query_param(request, 'deactivate_old_records', 'false') or False,
+            'new_version': request.QUERY_PARAMS.get('new_version') or False,
+        }
+        chunk_size = request.QUERY_PARAMS.get('chunk_size')
+        if chunk_size and chunk_size.isdigit():
+            options['chunk_size'] = int(chunk_size)
+        return options
+
+    def spool_upload(self, request, job):
+        """
+        Writes the uploaded file to the spool directory of the job block by block, so that large files are never held
+        in memory. Accepts a multipart upload in the 'file' field, or the JSON lines as the request body.
+        """
+        if request.META.get('CONTENT_TYPE', '').startswith('multipart/form-data'):
+            upload = request.FILES.get('file')
+            blocks = upload.chunks(UPLOAD_BLOCK_SIZE) if upload else []
+        else:
+            stream = request.stream
+            blocks = iter(lambda: stream.read(UPLOAD_BLOCK_SIZE), '') if stream else []
+
+        os.makedirs(job.spool_dir)
+        size = 0
+        with open(job.input_file_name, 'wb') as input_file:
+            for block in blocks:
+                input_file.write(block)
+                size += len(block)
+        return size
+
+
+class SourceImportJobRetrieveView(SourceImportJobMixin, RetrieveAPIView):
+    levels = 2
+
+    def get_object(self, queryset=None):
+        return self.get_job()
+
+
+class SourceImportJobReportView(SourceImportJobMixin, RetrieveAPIView):
+    """ Streams a file written by the import, e.g. its error output """
+    levels = 3
+    report = None
+    content_type = 'text/plain'
+
+    def retrieve(self, request, *args, **kwargs):
+        file_name = getattr(self.get_job(), self.report)
+        if not os.path.exists(file_name):
+            return HttpResponse(status=status.HTTP_204_NO_CONTENT)
+        return StreamingHttpResponse(open(file_name, 'rb'), content_type=self.content_type)
+
+
+class SourceImportJobErrorsView(SourceImportJobReportView):
+    report = 'error_file_name'
+
+
+class SourceImportJobValidationReportView(SourceImportJobReportView):
+    report = 'validation_report_file_name'
+    content_type = 'text/csv'
+
+
+class SourceBulkConceptsView(SourceImportJobMixin):
+    """
+    Adds or updates the concepts of a source from a JSON array, or JSON lines, of concept payloads in the format of the
+    concepts import, and returns the result of each payload in the same order
+    """
+
+    def post(self, request, *args, **kwargs):
+        try:
+            items = self.get_items(request)
+        except ValueError as exc:
+            return Response({'detail': 'Invalid JSON: %s' % exc.args[0]}, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(items, list) or not items:
+            return Response({'detail': 'Must post a JSON array or JSON lines of concepts.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > BULK_CONCEPTS_LIMIT:
+            return Response({'detail': 'Cannot post more than %d concepts at once, use the import API instead.' %
+                                       BULK_CONCEPTS_LIMIT}, status=status.HTTP_400_BAD_REQUEST)
+
+        importer = ConceptsImporter(self.parent_resource, None, request.user, OutputWrapper(StringIO()),
+                                    OutputWrapper(StringIO()), save_validation_errors=False)
+        return Response(importer.import_items(items), status=status.HTTP_200_OK)
+
+    def get_items(self, request):
+        """ Reads a JSON array of the default parsers, or one JSON object per line of the request body """
+        if request.META.get('CONTENT_TYPE', '').startswith('application/json'):
+            return request.DATA
+        stream = request.stream
+        return [json.loads(line) for line in stream if line.strip()] if stream else []
+
+
+class SourceBulkActionView(SourceImportJobMixin):
+    """
+    Retires, un-retires or deactivates concepts (by mnemonic) and mappings (by ID) of a source at once, creating their
+    new versions in bulk, e.g. {"action": "retire", "concepts": ["1", "2"], "update_comment": "Deprecated"}.
+    Concepts or mappings that fail are listed under errors while the others are changed, and only if none could be
+    changed the response is a 400.
+    """
+
+    def post(self, request, *args, **kwargs):
+        action = request.DATA.get('action')
+        if action not in BULK_ACTIONS:
+            return Response({'action': ['Must be one of: %s.' % ', '.join(BULK_ACTIONS)]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        concept_mnemonics = request.DATA.get('concepts') or []
+        mapping_ids = request.DATA.get('mappings') or []
+        if not isinstance(concept_mnemonics, list) or not isinstance(mapping_ids, list):
+            return Response({'detail': 'Concepts and mappings must be lists.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        concepts = list(Concept.objects.filter(parent_id=self.parent_resource.id, mnemonic__in=concept_mnemonics))
+        # IDs that are not ObjectIds cannot be queried, and are reported as not found
+        mappings = list(Mapping.objects.filter(
+            parent_id=self.parent_resource.id,
+            id__in=[mapping_id for mapping_id in mapping_ids if ObjectId.is_valid(mapping_id)]))
+        not_found = {
+            'concepts': sorted(set(map(unicode, concept_mnemonics)) - set(concept.mnemonic for concept in concepts)),
+            'mappings': sorted(set(map(unicode, mapping_ids)) - set(mapping.id for mapping in mappings)),
+        }
+
+        errors = {}
+        if action == BULK_ACTION_DEACTIVATE:
+            # Deactivates the latest concept versions, as the import does for concepts missing from its file
+            version_ids = ConceptVersion.objects.filter(
+                versioned_object_id__in=[concept.id for concept in concepts], is_latest_version=True
+            ).values_list('id', flat=True)
+            num_concepts = len(ConceptVersion.deactivate_in_bulk(version_ids))
+            num_mappings = len(Mapping.deactivate_in_bulk([mapping.id for mapping in mappings]))
+        else:
+            retired = action == BULK_ACTION_RETIRE
+            update_comment = request.DATA.get('update_comment')
+            concept_versions, concept_errors = Concept.change_retired_in_bulk(concepts, retired, request.user,
+                                                                              update_comment=update_comment)
+            mapping_versions, mapping_errors = Mapping.change_retired_in_bulk(mappings, retired, request.user,
+                                                                              update_comment=update_comment)
+            errors = dict((key, value) for key, value in [('concepts', concept_errors), ('mappings', mapping_errors)]
+                          if value)
+            num_concepts, num_mappings = len(concept_versions), len(mapping_versions)
+
+        if errors and not (num_concepts or num_mappings):
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        response = {'action': action, 'concepts': num_concepts, 'mappings': num_mappings, 'not_found': not_found}
+        if errors:
+            response['errors'] = errors
+        return Response(response, status=status.HTTP_200_OK)
+
+
+class SourceSchemaValidationJobMixin(SourceImportJobMixin):
+    """ Base view of the schema validation jobs of a source """
+    serializer_class = SchemaValidationJobSerializer
+
+    def get_queryset(self):
+        return SchemaValidationJob.objects.filter(source_id=self.parent_resource.id)
+
+
+class SourceSchemaValidationJobListView(SourceSchemaValidationJobMixin, ListAPIView):
+    pass
+
+
+class SourceSchemaValidationJobRetrieveView(SourceSchemaValidationJobMixin, RetrieveAPIView):
+    levels = 2
+
+    def get_object(self, queryset=None):
+        return self.get_job()
+
+
+class SourceSchemaValidationFailureListView(SourceSchemaValidationJobMixin, ListAPIView):
+    """ Lists the concepts that failed validation, as the chunks of the job report them """
+    serializer_class = SchemaValidationFailureSerializer
+    levels = 3
+
+    def get_queryset(self):
+        return self.get_job().failures
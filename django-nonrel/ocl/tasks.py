@@ -11,13 +11,21 @@ from configurations import importer
 
 importer.install()
 
+from django.contrib.auth.models import User
+from django.core.management.base import OutputWrapper
 from celery import Celery
 from celery.utils.log import get_task_logger
 from celery_once import QueueOnce
+from concepts.importer import ConceptsImporter, ValidationLogger
 from concepts.models import ConceptVersion, Concept
+from mappings.importer import MappingsImporter
 from mappings.models import Mapping, MappingVersion
 from oclapi.utils import update_all_in_index, write_export_file
-from sources.models import SourceVersion
+from oclapi.management.commands import ImportActionHelper, ImportJobCheckpoint, InputFile
+from oclapi.reindex import get_partitions, reindex_partition, clear_markers, start_run, finish_run
+from oclapi.signals import SearchIndexQueue
+from sources.models import SourceVersion, ImportJob, SchemaValidationJob, IMPORT_TYPE_CONCEPTS, IMPORT_JOB_STARTED, \
+    IMPORT_JOB_SUCCESS, IMPORT_JOB_FAILURE
 from collection.models import CollectionVersion, CollectionReference, CollectionReferenceUtils
 from concepts.views import ConceptVersionListView
 from mappings.views import MappingListView
@@ -50,17 +58,124 @@ def export_collection(version_id):
     logger.info('Export complete!')
 
 
+@celery.task(acks_late=True)
+def import_source_file(job_id):
+    """
+    Runs an import job of the import API. The job is acknowledged late, so that the import is resumed from its
+    last checkpoint by another worker if this one dies.
+    """
+    job = ImportJob.objects.get(id=job_id)
+    if job.is_finished:
+        return
+    job.status = IMPORT_JOB_STARTED
+    job.save()
+    logger.info('Importing %s of job %s into source %s...' % (job.import_type, job.id, job.source.mnemonic))
+
+    checkpoint = ImportJobCheckpoint(job)
+    options = dict(job.options or {})
+    options.update({'checkpoint': checkpoint, 'resume': checkpoint.exists()})
+    user = User.objects.get(username=job.created_by)
+    input_file = InputFile(job.input_file_name)
+    stdout = OutputWrapper(open(job.output_file_name, 'a'))
+    stderr = OutputWrapper(open(job.error_file_name, 'a'))
+    try:
+        if job.import_type == IMPORT_TYPE_CONCEPTS:
+            validation_logger = ValidationLogger(output_file_name=job.validation_report_file_name,
+                                                 append=options['resume'])
+            importer = ConceptsImporter(job.source, input_file, user, stdout, stderr, validation_logger=validation_logger)
+            importer.import_concepts(**options)
+            job.lines_handled = importer.lines_handled
+        else:
+            importer = MappingsImporter(job.source, input_file, stdout, stderr, user)
+            importer.import_mappings(**options)
+            job.lines_handled = importer.count
+        job.action_count = ImportActionHelper.get_action_counts(importer.action_count)
+        job.position = job.file_size
+        job.status = IMPORT_JOB_SUCCESS
+        logger.info('Import job %s complete!' % job.id)
+    except Exception as exc:
+        logger.exception('Import job %s failed' % job.id)
+        job.status = IMPORT_JOB_FAILURE
+        job.message = '%s' % exc
+    finally:
+        input_file.close()
+        stdout.close()
+        stderr.close()
+    job.save()
+
+
+@celery.task
+def validate_source_schema(job_id):
+    """ Splits the concepts of a source into chunks, which are validated against the requested schema in parallel """
+    job = SchemaValidationJob.objects.get(id=job_id)
+    if job.is_finished:
+        return
+    chunks = job.split()
+    logger.info('Validating %d concepts of source %s against the %s schema in %d chunks...' %
+                (job.num_concepts, job.source.mnemonic, job.custom_validation_schema, job.num_chunks))
+    if not chunks:
+        job.finish()
+        return
+    for chunk_index, concept_ids in enumerate(chunks):
+        validate_source_schema_chunk.delay(job.id, chunk_index, concept_ids)
+
+
+@celery.task(acks_late=True)
+def validate_source_schema_chunk(job_id, chunk_index, concept_ids):
+    job = SchemaValidationJob.objects.get(id=job_id)
+    if job.validate_chunk(chunk_index, concept_ids):
+        job.finish()
+        logger.info('Schema validation job %s complete: %s' % (job.id, job.message))
+
+
+@celery.task(bind=True, max_retries=10, default_retry_delay=30)
+def flush_search_index_queue(self):
+    """
+    Updates the search documents of the objects queued by QueuedSignalProcessor since the last flush. A failed flush
+    leaves the objects queued, and is retried.
+    """
+    try:
+        num_flushed = SearchIndexQueue().flush()
+    except Exception as exc:
+        logger.warning('Could not flush the search index queue: %s' % exc)
+        raise self.retry(exc=exc)
+    logger.info('Flushed %d objects from the search index queue' % num_flushed)
+
+
+@celery.task
+def reindex(model_names, source_ids=None, batch_size=1000, restart=False):
+    """ Splits the reindex of concept and mapping versions by source, and reindexes the sources in parallel """
+    partitions = get_partitions(model_names, source_ids)
+    # Cleared here rather than in reindex_source, so that a redelivered partition resumes instead of starting over
+    if restart:
+        clear_markers(partitions)
+    run_id = start_run(partitions)
+    logger.info('Reindexing %s in %d partitions, run %s...' % (', '.join(model_names), len(partitions), run_id))
+    for model_name, source_id in partitions:
+        reindex_source.delay(model_name, source_id, batch_size, run_id)
+
+
+@celery.task(acks_late=True)
+def reindex_source(model_name, source_id, batch_size=1000, run_id=None):
+    """
+    Reindexes one partition. If the worker dies, another one resumes it from its resume marker. The last partition of
+    the run to finish clears the markers of all of them.
+    """
+    num_indexed = reindex_partition(model_name, source_id, batch_size)
+    logger.info('Reindexed %d versions of %s of source %s' % (num_indexed, model_name, source_id))
+    if run_id and finish_run(run_id):
+        logger.info('Reindex run %s complete' % run_id)
+
+
 @celery.task
 def update_children_for_resource_version(version_id, _type):
     _resource = resource(version_id, _type)
-    _resource._ocl_processing = True
-    _resource.save()
+    _resource.set_processing(True)
     versions = ConceptVersion.objects.filter(id__in=_resource.concepts)
     update_all_in_index(ConceptVersion, versions)
     mappingVersions = MappingVersion.objects.filter(id__in=_resource.mappings)
     update_all_in_index(MappingVersion, mappingVersions)
-    _resource._ocl_processing = False
-    _resource.save()
+    _resource.set_processing(False)
 
 
 def resource(version_id, type):
@@ -73,8 +188,7 @@ def resource(version_id, type):
 @celery.task
 def update_collection_in_solr(version_id, references):
     cv = CollectionVersion.objects.get(id=version_id)
-    cv._ocl_processing = True
-    cv.save()
+    cv.set_processing(True)
     concepts, mappings = [], [],
 
     for ref in references:
@@ -92,8 +206,7 @@ def update_collection_in_solr(version_id, references):
     if len(mapping_versions) > 0:
         update_all_in_index(MappingVersion, mapping_versions)
 
-    cv._ocl_processing = False
-    cv.save()
+    cv.set_processing(False)
 
 
 def _get_version_ids(resources, klass):
@@ -103,8 +216,7 @@ def _get_version_ids(resources, klass):
 @celery.task
 def delete_resources_from_collection_in_solr(version_id, concepts, mappings):
     cv = CollectionVersion.objects.get(id=version_id)
-    cv._ocl_processing = True
-    cv.save()
+    cv.set_processing(True)
 
     if len(concepts) > 0:
         index_resource(concepts, Concept, ConceptVersion, 'mnemonic__in')
@@ -112,8 +224,7 @@ def delete_resources_from_collection_in_solr(version_id, concepts, mappings):
     if len(mappings) > 0:
         index_resource(mappings, Mapping, MappingVersion, 'id__in')
 
-    cv._ocl_processing = False
-    cv.save()
+    cv.set_processing(False)
 
 
 @celery.task